@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""Map exporter
+
+Headless batch export of maps to PNG, fe. for map previews or asset builds:
+
+    python export_maps.py [--dev] [--force] [--jobs N] [source ...]
+
+Every .map and .json file in the sources (default: data/maps) is rendered to
+<output>/<name>.png, spread over a pool of processes. name is the path of
+the file relative to its source folder, or the file name for sources that
+are files. Two map files with the same name are an error, they would
+overwrite each other's PNG. Maps whose file, export settings and sprites did
+not change since the previous export are skipped, the hashes of those are
+kept in <output>/manifest.json.
+"""
+
+
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha1
+from ode.constants import *
+from ode.map import Map
+from ode.render import rasterize
+from PIL import Image
+import argparse
+import glob
+import json
+import os
+
+
+MAP_EXTENSIONS = [".map", ".json"]
+MANIFEST = "manifest.json"
+
+
+def find_maps(sources: list) -> dict:
+    """Returns the map files in sources, which are files or folders (searched
+    recursively), as a dict of name -> map file, see the module docstring.
+
+    Raises:
+        ValueError: if two different map files have the same name
+    """
+    result = {}
+    for source in sources:
+        if os.path.isdir(source):
+            filenames = []
+            for extension in MAP_EXTENSIONS:
+                filenames.extend(glob.glob(os.path.join(source, "**", f"*{extension}"), recursive=True))
+            names = [os.path.relpath(filename, source) for filename in filenames]
+        elif os.path.splitext(source)[1] in MAP_EXTENSIONS:
+            filenames = [source]
+            names = [os.path.basename(source)]
+        else:
+            continue
+        for name, filename in zip(names, filenames):
+            name = name.replace(os.sep, "/")
+            other = result.setdefault(name, filename)
+            if os.path.abspath(other) != os.path.abspath(filename):
+                raise ValueError(f"Map files {other} and {filename} would both be exported to {name}.png")
+    return dict(sorted(result.items()))
+
+
+def sprites_hash() -> str:
+    """Returns a hash over all edge/floor sprites, so exports get redone when they change"""
+    digest = sha1()
+    for filename in sorted(glob.glob(f"{PATH_IMAGES_EDGE}*.png") + glob.glob(f"{PATH_IMAGES_FLOOR}*.png")):
+        with open(filename, "rb") as infile:
+            digest.update(filename.encode())
+            digest.update(infile.read())
+    return digest.hexdigest()
+
+
+def content_hash(filename: str, settings: str) -> str:
+    """Returns the hash of a map file together with its path and the export settings"""
+    digest = sha1(settings.encode())
+    # another file exported to the same target is a change as well
+    digest.update(os.path.abspath(filename).encode())
+    with open(filename, "rb") as infile:
+        digest.update(infile.read())
+    return digest.hexdigest()
+
+
+def load_map(filename: str) -> Map:
+    if filename.endswith(".json"):
+        return Map.from_json_file(filename)
+    return Map.load_blosc(filename)
+
+
+def export_map(filename: str, target: str, dev_mode=False, compress_level=1) -> str:
+    """Renders map file filename to PNG file target.
+
+    Module level, so it can run in a process pool.
+
+    Returns:
+        str: target
+    """
+    map = load_map(filename)
+    image = Image.fromarray(rasterize(map, dev_mode=dev_mode))
+    image.save(target, compress_level=compress_level)
+    return target
+
+
+def export_maps(
+    sources: list = [f"{PATH_DATA}maps/"],
+    output: str = PATH_EXPORT_MAPS,
+    dev_mode=False,
+    force=False,
+    jobs: int = None,
+    compress_level=1,
+) -> dict:
+    """Exports all maps in sources to PNG files in output, see the module docstring.
+
+    Args:
+        sources (list, optional): map files and/or folders with map files. Defaults to data/maps/.
+        output (str, optional): folder for the PNG files. Defaults to PATH_EXPORT_MAPS.
+        dev_mode (bool, optional): render in dev mode. Defaults to False.
+        force (bool, optional): export all maps, also the ones that did not change. Defaults to False.
+        jobs (int, optional): number of processes. Defaults to the number of CPUs.
+        compress_level (int, optional): PNG compression, 0-9. Defaults to 1, which is fast.
+
+    Returns:
+        dict: the target PNG file per map file, None for the maps that were
+              skipped. Maps that failed to export are left out.
+
+    Raises:
+        ValueError: if two map files would be exported to the same PNG file
+    """
+    os.makedirs(output, exist_ok=True)
+    manifest_file = os.path.join(output, MANIFEST)
+    manifest = {}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as infile:
+            manifest = json.load(infile)
+    settings = f"{TILESIZE} {int(dev_mode)} {compress_level} {sprites_hash()}"
+    # the manifest is keyed on the names, the targets, so the hash of a map
+    # file never stands for a PNG file of another one
+    maps = find_maps(sources)
+    hashes = {}
+    todo = {}
+    for name, filename in maps.items():
+        target = os.path.join(output, f"{name}.png")
+        hashes[name] = content_hash(filename, settings)
+        if force or manifest.get(name) != hashes[name] or not os.path.isfile(target):
+            todo[name] = target
+    result = {filename: None for filename in maps.values()}
+    if todo:
+        for target in todo.values():
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                name: executor.submit(export_map, maps[name], target, dev_mode, compress_level)
+                for name, target in todo.items()
+            }
+            for name, future in futures.items():
+                filename = maps[name]
+                try:
+                    result[filename] = future.result()
+                    manifest[name] = hashes[name]
+                except Exception as error:
+                    # one broken map should not stop the others
+                    print(f"failed:   {filename}: {error!r}")
+                    manifest.pop(name, None)
+                    del result[filename]
+    with open(manifest_file, "w") as outfile:
+        json.dump(manifest, outfile, indent=4)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export maps to PNG")
+    parser.add_argument("sources", nargs="*", default=[f"{PATH_DATA}maps/"], help="map files and/or folders")
+    parser.add_argument("-o", "--output", default=PATH_EXPORT_MAPS, help="folder for the PNG files")
+    parser.add_argument("--dev", action="store_true", help="render in dev mode")
+    parser.add_argument("-f", "--force", action="store_true", help="also export unchanged maps")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of processes")
+    parser.add_argument("--compress-level", type=int, default=1, help="PNG compression, 0-9")
+    args = parser.parse_args()
+    result = export_maps(args.sources, args.output, args.dev, args.force, args.jobs, args.compress_level)
+    for filename, target in result.items():
+        if target is None:
+            print(f"skipped:  {filename}")
+        else:
+            print(f"exported: {filename} -> {target}")
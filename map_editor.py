@@ -19,14 +19,29 @@ from tkinter import filedialog as fd
 from tkinter import messagebox as mb
 from PIL import Image, ImageTk
 from ode.map import Map, MapTile, Room
+from ode.history import MapHistory
+from ode.journal import MapJournal, snapshot
 from ode.constants import *
 from ode.util import timer, list_next
 from pprint import pprint
 import gc
 import json
+import numpy as np
+import os
+from threading import Thread
 from time import time
 
 
+# where maps that were not opened from or saved to a .map file get journaled
+AUTOSAVE_FILENAME = f"{PATH_AUTOSAVE}untitled.map"
+
+
+# edge codes of the styles that are only visible in one of dev mode and player view
+EDGE_DEV_ONLY_LUT = np.array(
+    [bool(flags & FLAG_VISIBLE) != bool(flags & FLAG_VISIBLE_DEV) for flags in EDGE_FLAGS]
+)
+
+
 class MenuBar(tk.Menu):
     def __init__(self, parent):
         super(MenuBar, self).__init__(parent)
@@ -41,6 +56,7 @@ class MenuBar(tk.Menu):
         self.add_cascade(label="File", menu=filemenu)
 
     def exit_program(self):
+        self.master.close()
         exit()
 
 
@@ -81,7 +97,9 @@ class MapEditor(tk.Frame):
             {"x": "Clear tile"},
             {"n": "Clear map"},
             {"h": "Randomize map"},
-            {"z": "Adjust surrounding"},
+            {"p": "Toggle player view"},
+            {"z": "Undo"},
+            {"y": "Redo"},
         ]
         self.key_list_x = self.canvas_padding * 2
         self.key_list_y = (
@@ -90,21 +108,6 @@ class MapEditor(tk.Frame):
             - self.canvas_padding
         )
 
-        self.auto_adjust = tk.BooleanVar()
-        self.auto_adjust_cb = tk.Checkbutton(
-            parent,
-            text="Autoadjust surrounding",
-            **self.label_dict,
-            variable=self.auto_adjust,
-            onvalue=True,
-            offvalue=False,
-        )
-        self.auto_adjust_cb.select()
-        self.auto_adjust_cb.place(
-            x=((self.map_width * TILESIZE) + (self.canvas_padding * 2)),
-            y=self.key_list_y - 20,
-        )
-
         self.draw_room_bool = tk.BooleanVar()
         self.draw_room_cb = tk.Checkbutton(
             parent,
@@ -162,16 +165,28 @@ class MapEditor(tk.Frame):
         )
         self.infoblock.grid(row=0, column=1)
         # self.infoblock.pack(padx=self.canvas_padding,pady=self.canvas_padding)
+        self.info_copied_item = self.infoblock.create_image(20, 20, anchor="nw")
+        self.info_hover_item = self.infoblock.create_image(20, 90, anchor="nw")
+        self.info_hover_key = None
 
         # BINDINGS
         self.set_bindings()
 
         self.map = Map(self.map_width, self.map_height, dev_mode=True)
+        self.journal = None
+        # the journal error that was shown already, see check_journal()
+        self.journal_error = None
+        self.history = None
         # self.map.randomize()
-        self.map = Map.from_json_file("./data/maps/1.json")
-        self.map.dev_mode = True
-        self.init_map()
-        self.update()
+        map = None
+        if MapJournal.pending(AUTOSAVE_FILENAME):
+            # edits left behind by a crash
+            try:
+                map = MapJournal.recover(AUTOSAVE_FILENAME)
+            except ValueError:
+                # crashed before the first snapshot, the new journal cleans up
+                pass
+        self.set_map(map if map is not None else Map.from_json_file("./data/maps/1.json"))
         self.draw_keybindings()
 
     def set_bindings(self):
@@ -191,8 +206,10 @@ class MapEditor(tk.Frame):
         self.canvas.bind_all("<v>", self.paste_tile)
         self.canvas.bind_all("<x>", self.clear_tile)
         self.canvas.bind_all("<n>", self.clear_map)
-        self.canvas.bind_all("<z>", self.fix_surrounding)
         self.canvas.bind_all("<h>", self.randomize)
+        self.canvas.bind_all("<p>", self.toggle_dev_mode)
+        self.canvas.bind_all("<z>", self.undo)
+        self.canvas.bind_all("<y>", self.redo)
         # self.canvas.bind_all("<r>", self.room_save)
         self.canvas.bind("<Motion>", self.canvas_motion_event)
 
@@ -207,7 +224,19 @@ class MapEditor(tk.Frame):
         )  # , initialdir="/"
         if filename:
             if filename.endswith(".map"):
-                self.map.save_blosc(filename)
+                if os.path.abspath(filename) == os.path.abspath(self.journal.filename):
+                    # the journal has all edits already, the snapshot follows in the background
+                    try:
+                        self.journal.save()
+                    except OSError as error:
+                        mb.showerror(title="Error", message=f"Saving failed: {error}")
+                    # a snapshot that failed before gets shown again if it still fails
+                    self.journal_error = None
+                    self.check_journal()
+                else:
+                    self.journal.close(wait=False)
+                    self.journal = MapJournal(self.map, filename)
+                    self.journal_error = None
             else:
                 mb.showerror(title="Error", message="Only .map files are allowed...")
         else:
@@ -220,8 +249,13 @@ class MapEditor(tk.Frame):
         )  # , initialdir="/"
         if filename:
             if filename.endswith(".json"):
-                with open(filename, "w") as outfile:
-                    outfile.write(self.map.dumps(separators=(",",":")))
+                # written from a copy, so the editor does not have to wait for it
+                Thread(
+                    target=snapshot(self.map).save_json,
+                    args=(filename,),
+                    kwargs={"separators": (",", ":")},
+                    daemon=True,
+                ).start()
             else:
                 mb.showerror(title="Error", message="Only .json files are allowed...")
         else:
@@ -234,8 +268,11 @@ class MapEditor(tk.Frame):
         )
         if filename:
             if filename.endswith(".map"):
-                self.map = Map.load_blosc(filename)
-                self.update()
+                if MapJournal.pending(filename):
+                    # edits left behind by a crash
+                    self.set_map(MapJournal.recover(filename), filename)
+                else:
+                    self.set_map(Map.load_blosc(filename), filename, saved=True)
             else:
                 mb.showerror(title="Error", message="Only .map files are allowed...")
         else:
@@ -249,29 +286,95 @@ class MapEditor(tk.Frame):
         if filename:
             if filename.endswith(".json"):
                 with open(filename) as infile:
-                    self.map = Map.from_json(**json.load(infile))
-                self.update()
+                    self.set_map(Map.from_json(**json.load(infile)))
             else:
                 mb.showerror(title="Error", message="Only .json files are allowed...")
         else:
             print("No file selected")
 
+    def set_map(self, map: Map, filename: str = AUTOSAVE_FILENAME, saved: bool = False):
+        """Makes map the edited map, journaled to map file filename (see
+        ode.journal). saved tells whether filename holds map already."""
+        if self.journal is not None:
+            # the journal of the same file has to be done before the next one starts
+            same_file = os.path.abspath(filename) == os.path.abspath(self.journal.filename)
+            self.journal.close(wait=same_file)
+        self.journal = MapJournal(map, filename, saved=saved)
+        self.journal_error = None
+        if self.history is not None:
+            self.history.close()
+        self.history = MapHistory(map)
+        self.map.unsubscribe(self.map_event)
+        self.map = map
+        self.map.dev_mode = True
+        self.map.subscribe(self.map_event)
+        self.init_map()
+        self.update()
+
+    def close(self):
+        """Writes the last edits to the map file, so no journal is left behind"""
+        if self.journal is not None:
+            self.journal.close()
+            self.check_journal()
+            self.journal = None
+
+    def check_journal(self):
+        """Shows the error of the latest snapshot of the journal if it failed.
+        The snapshots are written on the journal's worker thread, so this
+        gets called from update(). An error is shown once, not on every update."""
+        error = self.journal.error
+        if error is not None and self.journal_error is None:
+            mb.showerror(title="Error", message=f"Saving {self.journal.filename} failed: {error}")
+        self.journal_error = error
+
+    def map_event(self, change):
+        """Map.subscribe() callback, collects the tiles that need redrawing"""
+        self.dirty_tiles.update(change.tiles)
+        self.outline_room = None
+
+    def tile_changed(self):
+        """Finishes an edit of the hovered tile"""
+        if self.fix_edges:
+            self.map.fix_edges()
+        self.update()
+
     def randomize(self, _):
         self.map.randomize()
-        self.update(adjust=False)
+        self.update()
+
+    def undo(self, _):
+        """Undoes the latest edit, see ode.history"""
+        if self.history.undo():
+            self.update()
+
+    def redo(self, _):
+        """Redoes the latest undone edit"""
+        if self.history.redo():
+            self.update()
+
+    def toggle_dev_mode(self, _):
+        """Switches between the editor (dev mode) and the player view. Only
+        tiles with an edge that looks different in the other mode get redrawn."""
+        self.map.dev_mode = not self.map.dev_mode
+        self.map.require()
+        codes = self.map.codes
+        lut = EDGE_DEV_ONLY_LUT
+        differs = lut[codes.n] | lut[codes.e] | lut[codes.s] | lut[codes.w]
+        self.dirty_tiles.update(zip(*(axis.tolist() for axis in differs.nonzero())))
+        self.update()
 
     def canvas_click_event(self, _):
         self.map.tiles[self.x][self.y] = MapTile.random(dev_mode=True)
-        self.update()
+        self.tile_changed()
 
     def canvas_click_middle_event(self, _):
         pass
 
     def canvas_click_right_event(self, _):
         # self.rooms = self.map.get_rooms_all()
-        if self.hover_room not in self.rooms:
+        if self.hover_room is not None and self.hover_room not in self.rooms:
             self.rooms.append(self.hover_room)
-            self.update()
+            self.room_label_items.append(self.label_room(self.hover_room, "___"))
 
     def canvas_motion_event(self, event):
         """Sets the coordinates for drawing the hover indicator.
@@ -287,89 +390,109 @@ class MapEditor(tk.Frame):
 
     def execute_hover(self):
         self.hover_delay_waiting = False
-        self.update(adjust=False)
+        self.update()
 
     def clear_map(self, _):
         """Clear map"""
         self.map.clear()
-        self.update(adjust=False)
-
-    def fix_surrounding(self, _):
-        """Makes the surrounding tiles' edges match the current tile"""
-        self.map.adjust_surrounding(self.x, self.y)
-        self.update(adjust=False)
+        self.update()
 
     def copy_tile(self, _):
         """Copy current tile"""
         self.copy = MapTile(dev_mode=True, **self.map.tiles[self.x][self.y].dump)
         self.copy_changed = True
-        self.update(adjust=False)
+        self.update()
 
     def paste_tile(self, _):
         """Paste previously copied tile. (defaults to ode.ode_constants.EMPTY_TILE)"""
         self.map.tiles[self.x][self.y] = MapTile(dev_mode=True, **self.copy.dump)
-        self.update()
+        self.tile_changed()
 
     def clear_tile(self, _):
         """Paste ode.ode_constants.EMPTY_TILE (in other words, delete)"""
         self.map.tiles[self.x][self.y] = MapTile(dev_mode=True)
-        self.update()
+        self.tile_changed()
 
     def cycle_north(self, _):
         """Cycle north edge"""
         self.map.tiles[self.x][self.y].n.style = list_next(
             self.map.tiles[self.x][self.y].n.style, EDGE_LIST_SIMPLE
         )
-        self.update()
+        self.tile_changed()
 
     def cycle_west(self, _):
         """Cycle west edge"""
         self.map.tiles[self.x][self.y].w.style = list_next(
             self.map.tiles[self.x][self.y].w.style, EDGE_LIST_SIMPLE
         )
-        self.update()
+        self.tile_changed()
 
     def cycle_south(self, _):
         """Cycle south edge"""
         self.map.tiles[self.x][self.y].s.style = list_next(
             self.map.tiles[self.x][self.y].s.style, EDGE_LIST_SIMPLE
         )
-        self.update()
+        self.tile_changed()
 
     def cycle_east(self, _):
         """Cycle east edge"""
         self.map.tiles[self.x][self.y].e.style = list_next(
             self.map.tiles[self.x][self.y].e.style, EDGE_LIST_SIMPLE
         )
-        self.update()
+        self.tile_changed()
 
     def sepa_inv_north(self, _):
         self.map.tiles[self.x][self.y].n.style = SEPA_INV
-        self.update()
+        self.tile_changed()
 
     def sepa_inv_west(self, _):
         self.map.tiles[self.x][self.y].w.style = SEPA_INV
-        self.update()
+        self.tile_changed()
 
     def sepa_inv_south(self, _):
         self.map.tiles[self.x][self.y].s.style = SEPA_INV
-        self.update()
+        self.tile_changed()
 
     def sepa_inv_east(self, _):
         self.map.tiles[self.x][self.y].e.style = SEPA_INV
-        self.update()
+        self.tile_changed()
 
     def cycle_floor(self, _):
         """Cycle floor"""
         self.map.tiles[self.x][self.y].f.style = list_next(
             self.map.tiles[self.x][self.y].f.style, FLOOR_LIST_SIMPLE
         )
-        self.update()
+        self.tile_changed()
 
     def init_map(self):
-        self.imggrid_tk = [
-            [None for _ in range(self.map_width)] for _ in range(self.map_height)
+        """Creates the canvas items for the current map: one image item per
+        tile, plus the hover rectangle and room overlays on top of them.
+        These items are reused for the rest of the session."""
+        self.canvas.delete("all")
+        self.tile_photos = {}
+        self.tile_keys = [
+            [None for _ in range(self.map.height)] for _ in range(self.map.width)
+        ]
+        self.tile_items = [
+            [
+                self.canvas.create_image(x * TILESIZE, y * TILESIZE, anchor="nw")
+                for y in range(self.map.height)
+            ]
+            for x in range(self.map.width)
         ]
+        for x in range(self.map.width):
+            for y in range(self.map.height):
+                self.draw_tile(x, y)
+        self.dirty_tiles = set()
+        self.outline_items = []
+        self.outline_room = None
+        self.room_label_item = self.canvas.create_text(
+            0, 0, **self.room_text_dict, state="hidden"
+        )
+        self.room_label_items = [self.label_room(room, "___") for room in self.rooms]
+        self.hover_item = self.canvas.create_rectangle(
+            0, 0, 0, 0, outline=self.hover_color
+        )
 
     def draw_keybindings(self):
         self.infoblock.create_text(
@@ -385,13 +508,18 @@ class MapEditor(tk.Frame):
             )
 
     def draw_tile(self, x, y):
-        self.imggrid_tk[x][y] = ImageTk.PhotoImage(self.map.tiles[x][y].image)
-        self.canvas.create_image(
-            x * TILESIZE,
-            y * TILESIZE,
-            image=self.imggrid_tk[x][y],
-            anchor="nw",
-        )
+        """Points the canvas item of the tile at the right image, if it changed"""
+        tile = self.map.tiles[x][y]
+        key = (tile.f.code, tile.n.code, tile.e.code, tile.s.code, tile.w.code)
+        if EDGE_DEV_ONLY_LUT[list(key[1:])].any():
+            # looks different in dev mode
+            key += (self.map.dev_mode,)
+        if key == self.tile_keys[x][y]:
+            return
+        if key not in self.tile_photos:
+            self.tile_photos[key] = ImageTk.PhotoImage(tile.image)
+        self.canvas.itemconfig(self.tile_items[x][y], image=self.tile_photos[key])
+        self.tile_keys[x][y] = key
 
     # @timer
     def draw_room_outline(self, room: Room, text=""):
@@ -400,109 +528,99 @@ class MapEditor(tk.Frame):
         #     print("collect")
         #     self.gc_counter = 0
         #     gc.collect(2)
-        if not self.draw_room_bool.get():
+        if not self.draw_room_bool.get() or room is None:
+            for item in self.outline_items + [self.room_label_item]:
+                self.canvas.itemconfig(item, state="hidden")
+            self.outline_room = None
+            return
+        if room is self.outline_room:
             return
         # room = self.map.get_room((self.x, self.y), [])
 
+        lines = []
         for coord in room.coords:
             x, y = coord
-            if self.map.tiles[x][y]._n != "none":
-                self.canvas.create_line(
-                    x * TILESIZE - 2,
-                    y * TILESIZE - 2,
-                    (x + 1) * TILESIZE + 2,
-                    y * TILESIZE - 2,
-                    **self.line_settings,
-                )
-            if self.map.tiles[x][y]._s != "none":
-                self.canvas.create_line(
-                    x * TILESIZE - 2,
-                    (y + 1) * TILESIZE + 2,
-                    (x + 1) * TILESIZE + 2,
-                    (y + 1) * TILESIZE + 2,
-                    **self.line_settings,
-                )
-            if self.map.tiles[x][y]._e != "none":
-                self.canvas.create_line(
-                    (x + 1) * TILESIZE + 2,
-                    y * TILESIZE - 2,
-                    (x + 1) * TILESIZE + 2,
-                    (y + 1) * TILESIZE + 2,
-                    **self.line_settings,
-                )
-            if self.map.tiles[x][y]._w != "none":
-                self.canvas.create_line(
-                    x * TILESIZE - 2,
-                    y * TILESIZE - 2,
-                    x * TILESIZE - 2,
-                    (y + 1) * TILESIZE + 2,
-                    **self.line_settings,
-                )
-        for coord in room.coords:
-            self.draw_tile(*coord)
-        self.label_room(room, text)
-
-    @timer
-    def label_room(self, room: Room, text=""):
+            tile = self.map.tiles[x][y]
+            left, top = x * TILESIZE - 2, y * TILESIZE - 2
+            right, bottom = (x + 1) * TILESIZE + 2, (y + 1) * TILESIZE + 2
+            if tile.n.style != NONE:
+                lines.append((left, top, right, top))
+            if tile.s.style != NONE:
+                lines.append((left, bottom, right, bottom))
+            if tile.e.style != NONE:
+                lines.append((right, top, right, bottom))
+            if tile.w.style != NONE:
+                lines.append((left, top, left, bottom))
+        # reuse the line items of the previous outline, only create the missing ones
+        while len(self.outline_items) < len(lines):
+            self.outline_items.append(
+                self.canvas.create_line(0, 0, 0, 0, **self.line_settings)
+            )
+        for item, line in zip(self.outline_items, lines):
+            self.canvas.coords(item, *line)
+            self.canvas.itemconfig(item, state="normal")
+        for item in self.outline_items[len(lines):]:
+            self.canvas.itemconfig(item, state="hidden")
+        self.outline_room = room
+        self.label_room(room, text, self.room_label_item)
+
+    def label_room(self, room: Room, text="", item=None) -> int:
+        """Moves the label item to the room, creates a new one if item is None"""
         text = f"{text}\n{room.size}"
         x, y = room.first
         x = x * TILESIZE +2
         y = y * TILESIZE +2
         # print(x,y)
-        self.canvas.create_text(x, y, **self.room_text_dict, text=text)
+        if item is None:
+            return self.canvas.create_text(x, y, **self.room_text_dict, text=text)
+        self.canvas.coords(item, x, y)
+        self.canvas.itemconfig(item, text=text, state="normal")
+        return item
 
     @timer
-    def update(self, adjust=True):
-        start = time()
-        # self.label_hover_details_text.set(self.map.tiles[self.x][self.y].pretty_text)
-        if self.fix_edges:
-            self.map.fix_edges()
-        print(f"fix_edges: {time() - start}")
-        start = time()
-        if adjust and self.auto_adjust.get():
-            self.map.adjust_surrounding(self.x, self.y)
-        
-        for w in range(self.map.width):
-            for h in range(self.map.height):
-                self.draw_tile(w, h)
-        print(f"draw:      {time() - start}")
-        start = time()
+    def update(self):
+        """Redraws the tiles that changed since the previous update, and
+        updates the overlays: hover rectangle, room outline and info block.
+        The edits since the previous update become one undo point."""
+        self.history.commit()
+        self.check_journal()
+        for x, y in self.dirty_tiles:
+            self.draw_tile(x, y)
+        self.dirty_tiles.clear()
+
         if self.copy_changed:
-            if hasattr(self, "info_copied"):
-                del self.info_copied
             self.info_copied = ImageTk.PhotoImage(
                 self.copy.image.resize(
                     (TILESIZE * 2, TILESIZE * 2), Image.Resampling.BILINEAR
                 )
             )
+            self.infoblock.itemconfig(self.info_copied_item, image=self.info_copied)
             self.copy_changed = False
-        print(f"copy_cha:  {time() - start}")
-        start = time()
-        
+
         # del self.hover_room
-        if self.draw_room_bool:
-            self.hover_room = Room(coords=self.map.get_room((self.x, self.y), [], first=True))
-            self.draw_room_outline(self.hover_room)
+        if self.draw_room_bool.get():
+            self.hover_room = self.map.room_at(self.x, self.y)
+        self.draw_room_outline(self.hover_room)
         # print(len(self.map.room_list))
 
         x0 = (self.x * TILESIZE) - self.hover_boundary - 1
         y0 = (self.y * TILESIZE) - self.hover_boundary - 1
         x1 = (self.x * TILESIZE) + TILESIZE + self.hover_boundary + 1
         y1 = (self.y * TILESIZE) + TILESIZE + self.hover_boundary + 1
-        self.canvas.create_rectangle(x0, y0, x1, y1, outline=self.hover_color)
+        self.canvas.coords(self.hover_item, x0, y0, x1, y1)
+        self.canvas.tag_raise(self.hover_item)
         self.hover_delay = 0
         self.hover_delay_waiting = False
 
-        for room in self.rooms:
-            self.label_room(room, "___")
-
-        self.infoblock.create_image(20, 20, image=self.info_copied, anchor="nw")
-        self.info_hover = ImageTk.PhotoImage(
-            self.map.tiles[self.x][self.y].image.resize(
-                (TILESIZE * 2, TILESIZE * 2), Image.Resampling.BILINEAR
+        hover_key = (self.x, self.y, self.tile_keys[self.x][self.y])
+        if hover_key != self.info_hover_key:
+            self.info_hover = ImageTk.PhotoImage(
+                self.map.tiles[self.x][self.y].image.resize(
+                    (TILESIZE * 2, TILESIZE * 2), Image.Resampling.BILINEAR
+                )
             )
-        )
-        self.infoblock.create_image(20, 90, image=self.info_hover, anchor="nw")
+            self.infoblock.itemconfig(self.info_hover_item, image=self.info_hover)
+            self.info_hover_key = hover_key
 
 
 if __name__ == "__main__":
@@ -511,6 +629,12 @@ if __name__ == "__main__":
     root.config(bg="white")
     main = MapEditor(root)
 
+    def close_window():
+        main.close()
+        root.destroy()
+
+    root.protocol("WM_DELETE_WINDOW", close_window)
+
     main.pack(
         fill="both", expand=True, pady=main.canvas_padding, padx=main.canvas_padding
     )
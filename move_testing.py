@@ -1,7 +1,10 @@
 from turtle import width
 from ode.constants import *
+from ode.firstperson import FirstPersonView
+from ode.fov import FieldOfView
 from ode.map import Map
 from ode.party import Party
+from ode.render import FrameRenderer, TilePyramid
 from PIL import Image, ImageTk
 import tkinter as tk
 from functools import wraps
@@ -12,6 +15,18 @@ fsize = lambda x: x * TILESIZE
 
 
 class MapCanvas(tk.Canvas):
+    """Viewport on the map, centered on the party where possible.
+
+    The map is drawn from the chunks of a TilePyramid at the current zoom
+    level. Frames are rendered by a FrameRenderer on a worker thread and
+    double buffered: a new frame is pasted into the photo that is not on
+    screen, then the map item switches to it. Moving the party only moves
+    the persistent map and party items, so input never waits for rendering.
+    """
+
+    # ms between checks for finished frames
+    POLL_DELAY = 15
+
     def __init__(self, parent, *args, **kwargs):
         self.img_settings = {"anchor": "nw"}
 
@@ -24,12 +39,26 @@ class MapCanvas(tk.Canvas):
 
         super().__init__(parent, *args, self.custom_process_kwargs(**kwargs))
 
-        self.party_images = [
-            ImageTk.PhotoImage(Image.open(f"{PATH_IMAGES_PARTY}{facing}.png"))
-            for facing in FACING_LIST
+        self.view_width = int(kwargs.get("width", fsize(parent.map.width)))
+        self.view_height = int(kwargs.get("height", fsize(parent.map.height)))
+        self.pyramid = TilePyramid(parent.map)
+        self.renderer = FrameRenderer(self.pyramid)
+        self.level = TILESIZE
+        # front and back buffer, the map item shows buffers[front]
+        self.buffers = [
+            ImageTk.PhotoImage("RGB", (self.view_width, self.view_height)) for _ in range(2)
+        ]
+        self.front = 0
+        # (level, x, y) of the frame on screen
+        self.frame_origin = None
+        self.map_item = self.create_image(0, 0, **self.img_settings)
+        self.party_sprites = [
+            Image.open(f"{PATH_IMAGES_PARTY}{facing}.png") for facing in FACING_LIST
         ]
-        self.map_image = ImageTk.PhotoImage(parent.map.get_image())
+        self.party_images = {}
+        self.party_item = self.create_image(0, 0, **self.img_settings)
         self.custom_update()
+        self.poll_frames()
 
     def custom_process_kwargs(self, **kwargs) -> dict:
         """parse kwards, and return leftover"""
@@ -49,14 +78,97 @@ class MapCanvas(tk.Canvas):
         self.custom_process_kwargs(**kwargs)
         self.custom_update()
 
+    def zoom(self, steps: int):
+        """Moves steps levels up (in) or down (out) the pyramid"""
+        levels = TilePyramid.LEVELS
+        index = min(len(levels) - 1, max(0, levels.index(self.level) - steps))
+        if levels[index] != self.level:
+            self.level = levels[index]
+            self.custom_update()
+
+    def view_origin(self) -> tuple:
+        """Returns the map pixel (at the current level) in the top left of the view"""
+        width, height = self.pyramid.size(self.level)
+        origin = []
+        for party, size, view in [
+            (self.party_x, width, self.view_width),
+            (self.party_y, height, self.view_height),
+        ]:
+            center = party * self.level + self.level // 2 - view // 2
+            origin.append(max(0, min(size - view, center)))
+        return tuple(origin)
+
+    def party_image(self) -> ImageTk.PhotoImage:
+        key = (self.facing_index, self.level)
+        if key not in self.party_images:
+            self.party_images[key] = ImageTk.PhotoImage(
+                self.party_sprites[self.facing_index].resize(
+                    (self.level, self.level), Image.Resampling.BILINEAR
+                )
+            )
+        return self.party_images[key]
+
+    def place_map_item(self):
+        """Puts the frame on screen where it belongs in the current view,
+        so it scrolls along until the frame for the new view is there."""
+        if self.frame_origin is None:
+            return
+        level, x, y = self.frame_origin
+        x0, y0 = self.view_origin()
+        if level == self.level:
+            self.coords(self.map_item, x - x0, y - y0)
+            self.itemconfig(self.map_item, state="normal")
+        else:
+            self.itemconfig(self.map_item, state="hidden")
+
     def custom_update(self):
-        self.create_image(0, 0, image=self.map_image, **self.img_settings)
-        self.create_image(
-            fsize(self.party_x),
-            fsize(self.party_y),
-            image=self.party_images[self.facing_index],
-            **self.img_settings,
+        x0, y0 = self.view_origin()
+        if self.frame_origin != (self.level, x0, y0):
+            self.renderer.request(self.level, x0, y0, self.view_width, self.view_height)
+        self.place_map_item()
+        self.coords(
+            self.party_item, self.party_x * self.level - x0, self.party_y * self.level - y0
         )
+        self.itemconfig(self.party_item, image=self.party_image())
+
+    def poll_frames(self):
+        """Swaps in the newest frame of the renderer, if there is one"""
+        frame = self.renderer.latest()
+        if frame is not None:
+            (level, x, y, _, _), image = frame
+            back = 1 - self.front
+            self.buffers[back].paste(image)
+            self.itemconfig(self.map_item, image=self.buffers[back])
+            self.front = back
+            self.frame_origin = (level, x, y)
+            self.place_map_item()
+        self.after(self.POLL_DELAY, self.poll_frames)
+
+    def destroy(self):
+        self.renderer.close()
+        self.pyramid.close()
+        super().destroy()
+
+
+class DungeonCanvas(tk.Canvas):
+    """First person view of the party, see FirstPersonView.
+
+    Frames are rendered straight away on a move, a frame is just a few cached
+    slices pasted together, and go into one persistent photo.
+    """
+
+    def __init__(self, parent, map: Map, *args, theme: str = "monochrome", **kwargs):
+        self.map = map
+        self.view = FirstPersonView(theme)
+        self.view.warm()
+        kwargs.setdefault("width", self.view.width)
+        kwargs.setdefault("height", self.view.height)
+        super().__init__(parent, *args, highlightthickness=0, **kwargs)
+        self.photo = ImageTk.PhotoImage("RGB", self.view.size)
+        self.create_image(0, 0, anchor="nw", image=self.photo)
+
+    def custom_move(self, party: Party):
+        self.photo.paste(self.view.render(self.map, party.x, party.y, party.facing, self.map.dev_mode))
 
 
 class InfoBlock(tk.Frame):
@@ -112,21 +224,26 @@ class Movement(tk.Frame):
         self.party.facing = EAST
         self.party.x = 10
         self.party.y = 4
+        self.fov = FieldOfView(self.map)
         self.mapcanvas = MapCanvas(
             self,
-            width=fsize(self.map.width),
-            height=fsize(self.map.height),
+            width=min(fsize(self.map.width), 768),
+            height=min(fsize(self.map.height), 768),
             **self.party.dump_map_paint,
         )
+        self.dungeoncanvas = DungeonCanvas(self, self.map)
         self.mapgridinfo = InfoBlock(
             self,
             info_data=self.map.tiles[self.party.x][self.party.y].dump_long_dict,
             width=200,
         )
 
-        self.mapcanvas.grid(row=0, column=0)
-        self.mapgridinfo.grid(row=0, column=1)
+        self.mapcanvas.grid(row=0, column=0, rowspan=2)
+        self.dungeoncanvas.grid(row=0, column=1)
+        self.mapgridinfo.grid(row=1, column=1)
         self.create_bindings()
+        self.fov.update(self.party.x, self.party.y, self.party.facing)
+        self.dungeoncanvas.custom_move(self.party)
 
         # self.map_label = tk.Label(self, image = self.map_image, bg=TKINTER_TRANSPARENT_COLOR)
         # self.map_label.place(x=0, y=0)
@@ -136,7 +253,10 @@ class Movement(tk.Frame):
 
     def custom_update(self):
         # print(map.tiles[self.party.x][self.party.y].dump)
+        self.map.tiles[self.party.x][self.party.y].visited = True
+        self.fov.update(self.party.x, self.party.y, self.party.facing)
         self.mapcanvas.custom_move(**self.party.dump_map_paint)
+        self.dungeoncanvas.custom_move(self.party)
         self.mapgridinfo.custom_update(
             self.map.tiles[self.party.x][self.party.y].dump_long_dict
         )
@@ -146,6 +266,9 @@ class Movement(tk.Frame):
         self.mapcanvas.bind_all("<a>", self.move_turn_left)
         self.mapcanvas.bind_all("<s>", self.move_turn_around)
         self.mapcanvas.bind_all("<d>", self.move_turn_right)
+        self.mapcanvas.bind_all("<plus>", lambda _: self.mapcanvas.zoom(1))
+        self.mapcanvas.bind_all("<equal>", lambda _: self.mapcanvas.zoom(1))
+        self.mapcanvas.bind_all("<minus>", lambda _: self.mapcanvas.zoom(-1))
         self.mapcanvas.bind_all("<Escape>", exit)
 
     # def update_decorator(func):
@@ -186,7 +309,7 @@ class Movement(tk.Frame):
 
 if __name__ == "__main__":
     root = tk.Tk(className="oDE Movement Tester") # it seems to switch between lower/upper on the first character...
-    root.geometry("1024x768")
+    root.geometry("1280x768")
     # root.wm_attributes("-transparentcolor", TKINTER_TRANSPARENT_COLOR)
     root.option_add("*tearOff", False)
     root.config(bg="white")
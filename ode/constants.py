@@ -12,6 +12,11 @@ TKINTER_TRANSPARENT_COLOR = "#a7fdce"
 
 ##### PATHS
 PATH_SAVE = "saves/"
+PATH_AUTOSAVE = f"{PATH_SAVE}autosave/"
+PATH_CACHE = "cache/"
+PATH_CACHE_PYRAMID = f"{PATH_CACHE}pyramid/"
+PATH_EXPORT = "export/"
+PATH_EXPORT_MAPS = f"{PATH_EXPORT}maps/"
 PATH_DATA = "data/"
 PATH_MONSTERS = f"{PATH_DATA}monsters/"
 PATH_ATTACKS = f"{PATH_DATA}attack_strings/"
@@ -19,6 +24,13 @@ PATH_IMAGES = f"{PATH_DATA}images/"
 PATH_IMAGES_EDGE = f"{PATH_IMAGES}{TILESIZE}x{TILESIZE}/edge/"
 PATH_IMAGES_FLOOR = f"{PATH_IMAGES}{TILESIZE}x{TILESIZE}/floor/"
 PATH_MAP_IMAGES = f"{PATH_IMAGES}{TILESIZE}x{TILESIZE}/map/"
+# map sprite sets by tile size, see ode.sprites.MapSprites
+PATH_MAP_SPRITES = {
+    32: f"{PATH_IMAGES}map_32x32/",
+    24: PATH_MAP_IMAGES,
+    16: f"{PATH_IMAGES}map_16x16/",
+}
+PATH_DUNGEON_WALLS = f"{PATH_DATA}dungeon_walls/"
 PATH_DUMMY_IMAGE = f"{PATH_IMAGES}dummy.png"
 PATH_IMAGES_PARTY = f"{PATH_IMAGES}{TILESIZE}x{TILESIZE}/party/"
 
@@ -71,6 +83,57 @@ FLOOR_LIST_SOLID = [SOLID]
 FLOOR_LIST_PASSABLE = [FLOOR, PIT, STAIRS_UP, STAIRS_DOWN, TELEPORTER, NONE]
 FLOOR_LIST_PASSABLE_WARN = [PIT, TELEPORTER, NONE]
 
+##### STYLE REGISTRY
+# Every edge/floor style has an integer ID (its index in EDGE_LIST/FLOOR_LIST)
+# and one word of property flags, so "is this passable/solid/visible" is a
+# single mask test. ode.map stores these IDs in its code arrays.
+FLAG_VISIBLE = 1
+FLAG_VISIBLE_DEV = 2
+FLAG_SOLID = 4
+FLAG_SOLID_ROOM = 8
+FLAG_PASSABLE = 16
+FLAG_PASSABLE_WARN = 32
+
+EDGE_ID = {style: index for index, style in enumerate(EDGE_LIST)}
+EDGE_FLAGS = tuple(
+    (FLAG_VISIBLE if style in EDGE_LIST_VISIBLE else 0)
+    | (FLAG_VISIBLE_DEV if style in EDGE_LIST_VISIBLE_DEV else 0)
+    | (FLAG_SOLID if style in EDGE_LIST_SOLID else 0)
+    | (FLAG_SOLID_ROOM if style in EDGE_LIST_SOLID_ROOM else 0)
+    | (FLAG_PASSABLE if style in EDGE_LIST_PASSABLE else 0)
+    for style in EDGE_LIST
+)
+
+FLOOR_ID = {style: index for index, style in enumerate(FLOOR_LIST)}
+FLOOR_FLAGS = tuple(
+    (FLAG_VISIBLE if style in FLOOR_LIST_VISIBLE else 0)
+    | (FLAG_VISIBLE_DEV if style in FLOOR_LIST_VISIBLE_DEV else 0)
+    | (FLAG_SOLID if style in FLOOR_LIST_SOLID else 0)
+    | (FLAG_PASSABLE if style in FLOOR_LIST_PASSABLE else 0)
+    | (FLAG_PASSABLE_WARN if style in FLOOR_LIST_PASSABLE_WARN else 0)
+    for style in FLOOR_LIST
+)
+
+##### MAP CHANGE KINDS
+# see ode.map.MapChange and Map.subscribe()
+CHANGE_EDGE = "edge"
+CHANGE_FLOOR = "floor"
+CHANGE_REGION = "region"
+
+##### MAP FILES
+# see ode.mapfile. Maps of at least MAP_CHUNKED_MIN_TILES tiles are saved in
+# chunks of MAP_CHUNK_SIZE x MAP_CHUNK_SIZE tiles, so they can be opened lazily
+MAP_CHUNK_SIZE = 32
+MAP_CHUNKED_MIN_TILES = 256 * 256
+# edits in a map journal before it gets compacted into a snapshot, see ode.journal
+MAP_JOURNAL_COMPACT_AFTER = 1000
+# changes of at least that many tiles are written by the worker of a map journal
+MAP_JOURNAL_LARGE_REGION = 64 * 64
+# undo points kept by a map history, and the tiles per side of its copy on
+# write chunks, see ode.history
+MAP_UNDO_LEVELS = 500
+MAP_UNDO_CHUNK_SIZE = 16
+
 ##### FACINGS
 NORTH = 'north'
 EAST = 'east'
@@ -81,6 +144,13 @@ WEST = 'west'
 # note that the order needs to be NESW due to rotation functions/methods
 # as the index determines the degree of rotation
 FACING_LIST = [NORTH, EAST, SOUTH, WEST]
+# facing -> (forward, right) as map (dx, dy)
+FACING_VECTORS = {
+    NORTH: ((0, -1), (1, 0)),
+    EAST: ((1, 0), (0, 1)),
+    SOUTH: ((0, 1), (-1, 0)),
+    WEST: ((-1, 0), (0, -1)),
+}
 
 ##### SOME OTHER RANDOM CONSTANTS
 ORI_N = "_n"
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""Exploration state of a map
+
+Which tiles the party has visited and seen is progress, not dungeon, so it
+is kept out of the map geometry: a Map holds an Exploration with one bitset
+for visited and one for seen, and saves it on its own. A bitset is one bit
+per tile, packed 8 to a byte, so even before compression a 50x50 map takes
+2 x 313 bytes. Updates and counts work on whole arrays of tiles at once.
+
+Tile (x, y) is bit x * height + y, the same order as the [x, y] indexed
+NumPy arrays of ode.map.TileCodes.
+"""
+
+
+import blosc
+import numpy as np
+import struct
+
+
+# number of set bits per byte value
+POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+class Bitset:
+    """Fixed size set of ints in [0, size), as packed bits.
+
+    The bits are in np.packbits() order, so np.unpackbits() turns them back
+    into one bool per index.
+    """
+
+    __slots__ = ("size", "bits")
+
+    def __init__(self, size: int, bits: np.ndarray = None):
+        self.size = size
+        if bits is None:
+            bits = np.zeros((size + 7) // 8, dtype=np.uint8)
+        elif len(bits) != (size + 7) // 8:
+            raise ValueError(f"Expected {(size + 7) // 8} bytes for {size} bits, got {len(bits)}")
+        self.bits = bits
+
+    @classmethod
+    def from_array(cls, array: np.ndarray) -> "Bitset":
+        """Returns the Bitset of the True values in bool array (any shape, read flat)"""
+        array = np.asarray(array, dtype=bool).ravel()
+        return cls(len(array), np.packbits(array))
+
+    def to_array(self) -> np.ndarray:
+        """Returns a flat bool array with one value per index"""
+        return np.unpackbits(self.bits, count=self.size).astype(bool)
+
+    def __getitem__(self, index: int) -> bool:
+        return bool(self.bits[index >> 3] & (128 >> (index & 7)))
+
+    def __setitem__(self, index: int, value: bool):
+        if value:
+            self.bits[index >> 3] |= 128 >> (index & 7)
+        else:
+            self.bits[index >> 3] &= ~np.uint8(128 >> (index & 7))
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Bitset) and self.size == other.size and np.array_equal(self.bits, other.bits)
+
+    def add(self, indices: np.ndarray) -> int:
+        """Sets the bits of all indices (may contain duplicates) at once.
+
+        Returns:
+            int: the number of bits that were not set before
+        """
+        indices = np.unique(np.asarray(indices, dtype=np.int64))
+        if len(indices) == 0:
+            return 0
+        where, mask = indices >> 3, (128 >> (indices & 7)).astype(np.uint8)
+        new = int(np.count_nonzero((self.bits[where] & mask) == 0))
+        np.bitwise_or.at(self.bits, where, mask)
+        return new
+
+    def discard(self, indices: np.ndarray):
+        """Clears the bits of all indices at once"""
+        indices = np.asarray(indices, dtype=np.int64)
+        np.bitwise_and.at(self.bits, indices >> 3, ~(128 >> (indices & 7)).astype(np.uint8))
+
+    def count(self) -> int:
+        """Returns the number of set bits"""
+        return int(POPCOUNT[self.bits].sum(dtype=np.int64))
+
+    def clear(self):
+        self.bits.fill(0)
+
+
+class Exploration:
+    """Visited and seen state of every tile of a width x height map.
+
+    Read and write single tiles through visited[index(x, y)] and
+    seen[index(x, y)], or whole arrays of tiles with mark_visited() and
+    mark_seen().
+    """
+
+    __slots__ = ("width", "height", "visited", "seen")
+
+    # file header: magic, format version, width, height
+    HEADER = struct.Struct("<4sBII")
+    MAGIC = b"ODEX"
+    VERSION = 1
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.visited = Bitset(width * height)
+        self.seen = Bitset(width * height)
+
+    def index(self, x, y):
+        """Returns the bit index of tile (x, y), also for arrays of x and y"""
+        return x * self.height + y
+
+    def mark_visited(self, xs, ys) -> int:
+        """Marks tiles (xs, ys) as visited, returns how many were not before"""
+        return self.visited.add(self.index(np.asarray(xs), np.asarray(ys)))
+
+    def mark_seen(self, xs, ys) -> int:
+        """Marks tiles (xs, ys) as seen, returns how many were not before"""
+        return self.seen.add(self.index(np.asarray(xs), np.asarray(ys)))
+
+    @property
+    def visited_count(self) -> int:
+        return self.visited.count()
+
+    @property
+    def seen_count(self) -> int:
+        return self.seen.count()
+
+    @property
+    def progress(self) -> float:
+        """Fraction of the tiles that has been seen"""
+        return self.seen_count / max(1, self.width * self.height)
+
+    def visited_array(self) -> np.ndarray:
+        """Returns the visited state as a (width, height) bool array"""
+        return self.visited.to_array().reshape(self.width, self.height)
+
+    def seen_array(self) -> np.ndarray:
+        """Returns the seen state as a (width, height) bool array"""
+        return self.seen.to_array().reshape(self.width, self.height)
+
+    def clear(self):
+        self.visited.clear()
+        self.seen.clear()
+
+    def to_bytes(self) -> bytes:
+        """Returns the state as a small header plus the compressed bitsets"""
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, self.width, self.height)
+        return header + blosc.compress(self.visited.bits.tobytes() + self.seen.bits.tobytes())
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Exploration":
+        """Returns the Exploration stored in data by to_bytes()"""
+        magic, version, width, height = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError(f"Not an exploration state (version {cls.VERSION})")
+        obj = cls(width, height)
+        bits = np.frombuffer(blosc.decompress(data[cls.HEADER.size :]), dtype=np.uint8)
+        size = len(obj.visited.bits)
+        if len(bits) != 2 * size:
+            raise ValueError(f"Exploration state of {len(bits)} bytes does not fit {width}x{height}")
+        obj.visited.bits[...] = bits[:size]
+        obj.seen.bits[...] = bits[size:]
+        return obj
+
+    def save(self, filename: str):
+        with open(filename, "wb") as outfile:
+            outfile.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, filename: str) -> "Exploration":
+        with open(filename, "rb") as infile:
+            return cls.from_bytes(infile.read())
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""First person dungeon view
+
+Renders what the party sees: the walls and doors of the tiles in front of
+it, in perspective, using the wall sheets in data/dungeon_walls.
+
+All perspective work is done up front. Every wall/door slice that can show
+up in a frame, one per (texture, depth, plane), is warped once by PIL and
+cached, together with its mask and position in the view. Floor and ceiling
+do not depend on the map, so they are one cached background. Rendering a
+frame is then just a copy of the background plus pasting the slices of the
+visible edges back to front, which stays well within a 60 fps budget.
+
+The geometry, in tile units: the eye is in the middle of the back edge of
+the party tile, looking forward along z. The tile at depth d and offset l
+(negative is left) spans z in [d, d + 1] and x in [l - 0.5, l + 0.5].
+"""
+
+
+from ode.constants import *
+from PIL import Image
+import numpy as np
+
+
+# box of the flat front face of the wall straight ahead in the wall sheets
+SHEET_FACE_BOX = (201, 132, 279, 228)
+
+# sheet per edge style, without and with dev mode. Styles that are not in
+# here are not drawn
+EDGE_TEXTURES = [
+    {WALL: "wall", DOOR: "door", DOOR_HIDDEN: "wall"},
+    {WALL: "wall", DOOR: "door", DOOR_HIDDEN: "locked"},
+]
+
+
+def perspective_coeffs(target: list, source: list) -> list:
+    """Returns the Image.PERSPECTIVE data that maps the 4 source points onto
+    the 4 target points. PIL wants the inverse mapping, target to source."""
+    matrix = []
+    vector = []
+    for (x, y), (u, v) in zip(target, source):
+        matrix.append([x, y, 1, 0, 0, 0, -u * x, -u * y])
+        matrix.append([0, 0, 0, x, y, 1, -v * x, -v * y])
+        vector.extend([u, v])
+    return np.linalg.solve(np.array(matrix, dtype=float), np.array(vector, dtype=float)).tolist()
+
+
+class FirstPersonView:
+    """Renderer for the first person view of one wall theme and view size.
+
+    Args:
+        theme (str, optional): prefix of the sheets in PATH_DUNGEON_WALLS. Defaults to "monochrome".
+        size (tuple, optional): (width, height) of the view in pixels. Defaults to (480, 360).
+        depth (int, optional): number of tiles the party can see ahead, own tile included. Defaults to 5.
+    """
+
+    # side walls are cut off here, closer they are outside the view anyway
+    NEAR = 0.35
+    # shading is 1 at the eye and SHADE_FAR at the far end of the view
+    SHADE_FAR = 0.2
+    FLOOR_COLOR = (64, 56, 48)
+    CEILING_COLOR = (40, 40, 48)
+
+    def __init__(self, theme: str = "monochrome", size: tuple = (480, 360), depth: int = 5):
+        self.theme = theme
+        self.size = size
+        self.depth = depth
+        self.width, self.height = size
+        self.focal = self.width / 2
+        self.textures = {}
+        for name in set(EDGE_TEXTURES[0].values()) | set(EDGE_TEXTURES[1].values()):
+            with Image.open(f"{PATH_DUNGEON_WALLS}{theme}_{name}.png") as sheet:
+                self.textures[name] = sheet.convert("RGB").crop(SHEET_FACE_BOX)
+        texture_width, texture_height = next(iter(self.textures.values())).size
+        # half of the wall height, so the walls have the aspect of the textures
+        self.half_height = 0.5 * texture_height / texture_width
+        self._slices = {}
+        self._background = None
+
+    def project(self, x: float, y: float, z: float) -> tuple:
+        """Returns the view pixel of point (x, y, z), y is up"""
+        return (self.width / 2 + x * self.focal / z, self.height / 2 - y * self.focal / z)
+
+    def shade(self, z: float) -> float:
+        return 1 - (1 - self.SHADE_FAR) * min(1.0, z / self.depth)
+
+    def _warp(self, texture: str, corners: list, source: list, z: float):
+        """Warps source (quad in the texture) onto corners (quad in the view).
+
+        Returns:
+            tuple: (image, mask, position) to paste, None if it is not in the view
+        """
+        xs = [x for x, _ in corners]
+        ys = [y for _, y in corners]
+        left, top = max(0, int(min(xs))), max(0, int(min(ys)))
+        right, bottom = min(self.width, int(np.ceil(max(xs)))), min(self.height, int(np.ceil(max(ys))))
+        if right <= left or bottom <= top:
+            return None
+        box = (right - left, bottom - top)
+        coeffs = perspective_coeffs([(x - left, y - top) for x, y in corners], source)
+        image = self.textures[texture].transform(box, Image.PERSPECTIVE, coeffs, Image.NEAREST)
+        shade = self.shade(z)
+        image = image.point(lambda value: int(value * shade))
+        # everything outside the quad ends up 0 in the mask
+        mask = Image.new("L", self.textures[texture].size, 255)
+        mask = mask.transform(box, Image.PERSPECTIVE, coeffs, Image.NEAREST)
+        return (image, mask, (left, top))
+
+    def front_slice(self, texture: str, depth: int, offset: int):
+        """Returns the cached slice of the wall facing the eye at the far side
+        of the tile at (depth, offset), see _warp()"""
+        key = (texture, "front", depth, offset)
+        if key not in self._slices:
+            z = depth + 1
+            width, height = self.textures[texture].size
+            corners = [
+                self.project(offset - 0.5, self.half_height, z),
+                self.project(offset + 0.5, self.half_height, z),
+                self.project(offset + 0.5, -self.half_height, z),
+                self.project(offset - 0.5, -self.half_height, z),
+            ]
+            source = [(0, 0), (width, 0), (width, height), (0, height)]
+            self._slices[key] = self._warp(texture, corners, source, z)
+        return self._slices[key]
+
+    def side_slice(self, texture: str, depth: int, plane: float):
+        """Returns the cached slice of the side wall at x = plane along the
+        tiles at depth, see _warp()"""
+        key = (texture, "side", depth, plane)
+        if key not in self._slices:
+            near, far = max(depth, self.NEAR), depth + 1
+            width, height = self.textures[texture].size
+            corners = [
+                self.project(plane, self.half_height, near),
+                self.project(plane, self.half_height, far),
+                self.project(plane, -self.half_height, far),
+                self.project(plane, -self.half_height, near),
+            ]
+            # the texture runs from near to far, clipped the same as the wall
+            u = (near - depth) * width
+            source = [(u, 0), (width, 0), (width, height), (u, height)]
+            self._slices[key] = self._warp(texture, corners, source, (near + far) / 2)
+        return self._slices[key]
+
+    def background(self) -> Image:
+        """Returns the floor and ceiling, shaded by distance. Shared, do not modify."""
+        if self._background is None:
+            rows = np.arange(self.height, dtype=float) + 0.5 - self.height / 2
+            # distance of the floor/ceiling seen through each row of pixels
+            with np.errstate(divide="ignore"):
+                z = np.abs(self.half_height * self.focal / rows)
+            shade = 1 - (1 - self.SHADE_FAR) * np.minimum(1.0, z / self.depth)
+            colors = np.where(
+                (rows < 0)[:, None], np.array([self.CEILING_COLOR]), np.array([self.FLOOR_COLOR])
+            )
+            pixels = np.repeat((colors * shade[:, None])[:, None, :], self.width, axis=1)
+            self._background = Image.fromarray(pixels.astype(np.uint8))
+        return self._background
+
+    def max_offset(self, depth: int) -> int:
+        """Returns the largest tile offset that is (partly) in view at depth"""
+        return int(np.ceil((depth + 1) * self.width / (2 * self.focal) + 0.5))
+
+    def warm(self):
+        """Warps every slice in advance, so the first frames do not have to"""
+        self.background()
+        for texture in self.textures:
+            for depth in range(self.depth):
+                reach = self.max_offset(depth)
+                for offset in range(-reach, reach + 1):
+                    self.front_slice(texture, depth, offset)
+                for offset in range(-reach, reach):
+                    self.side_slice(texture, depth, offset + 0.5)
+
+    def visible_slices(self, map, x: int, y: int, facing: str, dev_mode: bool = False) -> list:
+        """Returns the slices to draw for the party at (x, y) looking at
+        facing, in drawing order (back to front)."""
+        reach = max(self.depth, self.max_offset(self.depth - 1)) + 1
+        map.require(x - reach, y - reach, x + reach + 1, y + reach + 1)
+        codes = map.codes
+        textures = EDGE_TEXTURES[int(dev_mode)]
+        (fx, fy), (rx, ry) = FACING_VECTORS[facing]
+        front_key = facing[0]
+        right_key = FACING_LIST[(FACING_LIST.index(facing) + 1) % 4][0]
+
+        def texture(tx: int, ty: int, key: str):
+            # edges live in the h/v planes of the codes, see TileCodes
+            if key == "n":
+                plane, px, py = codes.h, tx, ty
+            elif key == "s":
+                plane, px, py = codes.h, tx, ty + 1
+            elif key == "w":
+                plane, px, py = codes.v, tx, ty
+            else:
+                plane, px, py = codes.v, tx + 1, ty
+            if not (0 <= px < plane.shape[0] and 0 <= py < plane.shape[1]):
+                return None
+            return textures.get(EDGE_LIST[plane[px, py]])
+
+        result = []
+        for depth in range(self.depth - 1, -1, -1):
+            reach = self.max_offset(depth)
+            offsets = sorted(range(-reach, reach + 1), key=abs, reverse=True)
+            for offset in offsets:
+                name = texture(x + fx * depth + rx * offset, y + fy * depth + ry * offset, front_key)
+                if name is not None:
+                    result.append(self.front_slice(name, depth, offset))
+            # side walls of this depth are in front of its far walls, outer ones first.
+            # The right edge of the tile at offset is the plane at offset + 0.5
+            for offset in sorted(range(-reach, reach), key=lambda offset: abs(offset + 0.5), reverse=True):
+                plane = offset + 0.5
+                name = texture(x + fx * depth + rx * offset, y + fy * depth + ry * offset, right_key)
+                if name is not None:
+                    result.append(self.side_slice(name, depth, plane))
+        return [item for item in result if item is not None]
+
+    def render(self, map, x: int, y: int, facing: str, dev_mode: bool = False) -> Image:
+        """Returns the view of the party at (x, y) looking at facing as an RGB image"""
+        frame = self.background().copy()
+        for image, mask, position in self.visible_slices(map, x, y, facing, dev_mode):
+            frame.paste(image, position, mask)
+        return frame
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""Field of view
+
+Works out which tiles the party can see, to set MapTile.seen. Walls live on
+the edges between tiles here, so this is shadowcasting adapted to edges:
+light is a set of slope intervals, cast row by row away from the eye, and
+every blocking edge it passes takes an exact slice out of it. An edge blocks
+when its style is solid (WALL, DOOR, DOOR_HIDDEN), NONE and SEPA_INV let the
+light through. Outside the map is solid.
+
+The view is split into four quadrants, one per facing, each the 90 degree
+cone in front of the party when looking that way. Quadrants are cached per
+(x, y, facing), so turning on the spot costs nothing, moving only casts the
+new position, and going back and forth is all cache. A FieldOfView
+subscribes to the changes of its map and forgets the quadrants a change
+can be seen from.
+"""
+
+
+from collections import OrderedDict
+from ode.constants import *
+import numpy as np
+
+
+# edge code -> blocks the light
+EDGE_BLOCKS_LUT = np.array([bool(flags & FLAG_SOLID) for flags in EDGE_FLAGS])
+
+# slack for comparing slopes, so light does not leak through the corners of walls
+EPSILON = 1e-9
+
+
+def subtract_intervals(light: list, blocked: list) -> list:
+    """Returns the intervals of light minus those of blocked, both sorted
+    lists of (low, high)."""
+    result = []
+    blocked = sorted(blocked)
+    for low, high in light:
+        for block_low, block_high in blocked:
+            if block_high <= low or block_low >= high:
+                continue
+            if block_low > low + EPSILON:
+                result.append((low, block_low))
+            low = max(low, block_high)
+            if low >= high:
+                break
+        if high - low > EPSILON:
+            result.append((low, high))
+    return result
+
+
+class FieldOfView:
+    """Visible tiles of a map, per position of the party.
+
+    Args:
+        map (Map): the map to look at
+        radius (int, optional): number of rows the party can see away. Defaults to 16.
+        cone (bool, optional): only see the quadrant in front of the party
+                               instead of all around. Defaults to False.
+        maxsize (int, optional): number of quadrants to cache. Defaults to 4096.
+    """
+
+    def __init__(self, map, radius: int = 16, cone: bool = False, maxsize: int = 4096):
+        self.map = map
+        self.radius = radius
+        self.cone = cone
+        self.maxsize = maxsize
+        self._quadrants = OrderedDict()
+        self._position = None
+        map.subscribe(self.map_changed)
+
+    def _inside(self, tx: np.ndarray, ty: np.ndarray) -> np.ndarray:
+        codes = self.map.codes
+        return (tx >= 0) & (tx < codes.width) & (ty >= 0) & (ty < codes.height)
+
+    def _blocks(
+        self, tx: np.ndarray, ty: np.ndarray, key: str, inside: np.ndarray
+    ) -> np.ndarray:
+        """Returns whether edge key of each tile (tx, ty) blocks the light,
+        inside tells which tiles are on the map"""
+        codes = self.map.codes
+        # edges live in the h/v planes of the codes, see TileCodes
+        if key == "n":
+            plane, px, py = codes.h, tx, ty
+        elif key == "s":
+            plane, px, py = codes.h, tx, ty + 1
+        elif key == "w":
+            plane, px, py = codes.v, tx, ty
+        else:
+            plane, px, py = codes.v, tx + 1, ty
+        result = np.ones(tx.shape, dtype=bool)
+        result[inside] = EDGE_BLOCKS_LUT[plane[px[inside], py[inside]]]
+        return result
+
+    def cast(self, x: int, y: int, facing: str) -> tuple:
+        """Casts the quadrant of facing from tile (x, y), uncached.
+
+        Returns:
+            tuple: (xs, ys) NumPy arrays with the visible tiles
+        """
+        (fx, fy), (rx, ry) = FACING_VECTORS[facing]
+        front_key = facing[0]
+        right_key = FACING_LIST[(FACING_LIST.index(facing) + 1) % 4][0]
+        # the blocking edges of the whole quadrant in one go, as [depth, column + reach]
+        reach = self.radius + 1
+        self.map.require(x - reach, y - reach, x + reach + 1, y + reach + 1)
+        depths, columns = np.mgrid[0 : self.radius + 1, -reach : reach + 1]
+        quadrant_x, quadrant_y = (
+            x + fx * depths + rx * columns,
+            y + fy * depths + ry * columns,
+        )
+        quadrant_inside = self._inside(quadrant_x, quadrant_y)
+        # outside the map is solid, so light does not get in or out there
+        quadrant_front = (
+            self._blocks(quadrant_x, quadrant_y, front_key, quadrant_inside)
+            | ~quadrant_inside
+        )
+        quadrant_right = self._blocks(
+            quadrant_x, quadrant_y, right_key, quadrant_inside
+        )
+        quadrant_right[:, :-1] |= ~quadrant_inside[:, 1:]
+        quadrant_right |= ~quadrant_inside
+        xs, ys = [np.array([x])], [np.array([y])]
+        # the eye is in the middle of tile (x, y), slopes are lateral / forward
+        light = [] if quadrant_front[0, reach] else [(-1.0, 1.0)]
+        for depth in range(1, self.radius + 1):
+            if not light:
+                break
+            # the row of tiles at depth spans [near, far] forward
+            near, far = depth - 0.5, depth + 0.5
+            low = min(light[0][0] * near, light[0][0] * far)
+            high = max(light[-1][1] * near, light[-1][1] * far)
+            first, last = int(np.floor(low + 0.5)), int(np.ceil(high - 0.5))
+            columns = np.arange(first, last + 1)
+            window = slice(first + reach, last + reach + 1)
+            tx, ty = quadrant_x[depth, window], quadrant_y[depth, window]
+            inside = quadrant_inside[depth, window]
+            right = quadrant_right[depth, window]
+            front = quadrant_front[depth, window]
+            walls = np.where(right, columns + 0.5, 0.0)
+            # slopes that light each tile: coming in through its near side, or
+            # from its inner neighbour as long as no wall is in between. The
+            # walls in between are the right edges of columns 0 .. c - 1 for
+            # tiles on the right, c .. -1 for tiles on the left
+            inner_right = np.concatenate(
+                [[0.0], np.maximum.accumulate(np.maximum(walls, 0))[:-1]]
+            )
+            inner_left = np.minimum.accumulate(np.minimum(walls, 0)[::-1])[::-1]
+            lows = np.where(
+                columns > 0,
+                np.maximum((columns - 0.5) / far, inner_right / near),
+                np.where(columns < 0, (columns - 0.5) / near, -0.5 / near),
+            )
+            highs = np.where(
+                columns < 0,
+                np.minimum((columns + 0.5) / far, inner_left / near),
+                np.where(columns > 0, (columns + 0.5) / near, 0.5 / near),
+            )
+            lit = np.zeros(len(columns), dtype=bool)
+            for light_low, light_high in light:
+                lit |= (
+                    np.minimum(highs, light_high) - np.maximum(lows, light_low)
+                    > EPSILON
+                )
+            lit &= inside
+            xs.append(tx[lit])
+            ys.append(ty[lit])
+            # light that makes it through the row: not stopped by a wall
+            # between the tiles, nor by the far edges of the tiles
+            blocked = [
+                (wall / far, wall / near) if wall > 0 else (wall / near, wall / far)
+                for wall in walls[right].tolist()
+            ]
+            blocked.extend(
+                ((column - 0.5) / far, (column + 0.5) / far)
+                for column in columns[front].tolist()
+            )
+            light = subtract_intervals(light, blocked)
+        return (np.concatenate(xs), np.concatenate(ys))
+
+    def quadrant(self, x: int, y: int, facing: str) -> tuple:
+        """Returns the visible tiles (xs, ys) in the quadrant of facing from tile (x, y), cached"""
+        key = (x, y, facing)
+        result = self._quadrants.get(key)
+        if result is not None:
+            self._quadrants.move_to_end(key)
+            return result
+        result = self.cast(x, y, facing)
+        self._quadrants[key] = result
+        if len(self._quadrants) > self.maxsize:
+            self._quadrants.popitem(last=False)
+        return result
+
+    def visible(self, x: int, y: int, facing: str = NORTH) -> tuple:
+        """Returns the tiles (xs, ys) the party at (x, y) can see, looking at
+        facing. Tiles can be in there more than once."""
+        facings = [facing] if self.cone else FACING_LIST
+        quadrants = [self.quadrant(x, y, quadrant) for quadrant in facings]
+        return (
+            np.concatenate([xs for xs, _ in quadrants]),
+            np.concatenate([ys for _, ys in quadrants]),
+        )
+
+    def update(self, x: int, y: int, facing: str = NORTH) -> int:
+        """Marks the tiles the party at (x, y) can see as seen. Does nothing
+        if the party did not move (or turn, for a cone) since the previous
+        update.
+
+        Returns:
+            int: the number of tiles that were not seen before
+        """
+        position = (x, y, facing if self.cone else None)
+        if position == self._position:
+            return 0
+        self._position = position
+        return self.map.exploration.mark_seen(*self.visible(x, y, facing))
+
+    def map_changed(self, change):
+        """Map.subscribe() callback, drops the quadrants that may see the change"""
+        xt, yt, xb, yb = change.box
+        reach = self.radius + 1
+        for key in [
+            key
+            for key in self._quadrants
+            if xt - reach <= key[0] < xb + reach and yt - reach <= key[1] < yb + reach
+        ]:
+            del self._quadrants[key]
+        self._position = None
+
+    def clear(self):
+        self._quadrants.clear()
+        self._position = None
+
+    def close(self):
+        """Stops following the changes of the map"""
+        self.map.unsubscribe(self.map_changed)
+        self.clear()
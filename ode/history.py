@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""Undo history of a map
+
+A MapHistory keeps the codes of a map as it was at the latest undo point,
+cut into chunks of MAP_UNDO_CHUNK_SIZE x MAP_UNDO_CHUNK_SIZE tiles. The
+chunks are copies that never change once made (copy on write):
+
+    - changes of the map (see Map.subscribe()) only mark the chunks they
+      touch as pending
+    - commit() turns the pending chunks into an undo point: the chunks as
+      they were move into the undo point, fresh copies of the map take their
+      place. The other chunks are shared with every undo point before.
+
+So an undo point costs the chunks that changed, not the map. undo() writes
+the chunks of the latest undo point back into the map with
+Map.write_region(), which emits the change to the other subscribers (the
+framebuffer, the room index, a journal) as any edit would.
+
+Chunks hold the edges around their tiles, so the edges on the border of two
+chunks are in both. Changes mark the chunks of all tiles in their box, which
+for an edge are the tiles on both sides, so both copies change together.
+
+Only the tiles are part of the history, rooms and metadata are not.
+"""
+
+
+from collections import deque
+from ode.constants import *
+from ode.map import Map
+
+
+class MapHistory:
+    """Undo and redo for the tiles of map.
+
+    Args:
+        map (Map): the map to follow
+        levels (int, optional): number of undo points kept. Defaults to MAP_UNDO_LEVELS.
+        chunk_size (int, optional): number of tiles per side of a chunk.
+                                    Defaults to MAP_UNDO_CHUNK_SIZE.
+    """
+
+    def __init__(
+        self,
+        map: Map,
+        levels: int = MAP_UNDO_LEVELS,
+        chunk_size: int = MAP_UNDO_CHUNK_SIZE,
+    ):
+        if chunk_size < 1:
+            raise ValueError(f"Chunk size has to be at least 1, got {chunk_size}")
+        self.map = map
+        self.chunk_size = chunk_size
+        self.columns = -(-map.width // chunk_size)
+        self.rows = -(-map.height // chunk_size)
+        # the only full copy of the map, every later copy is of changed chunks
+        map.require()
+        self._chunks = {
+            (cx, cy): self._copy(cx, cy)
+            for cx in range(self.columns)
+            for cy in range(self.rows)
+        }
+        self._pending = set()
+        # undo points, each a dict of chunk (cx, cy) -> codes as in _copy()
+        self._undo = deque(maxlen=levels)
+        self._redo = []
+        # True while writing an undo point, those changes are no edits
+        self._applying = False
+        map.subscribe(self.map_changed)
+
+    @property
+    def can_undo(self) -> bool:
+        """True if undo() has anything to undo"""
+        return bool(self._undo or self._pending)
+
+    @property
+    def can_redo(self) -> bool:
+        """True if redo() has anything to redo"""
+        return bool(self._redo and not self._pending)
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the undo and redo points, without the shared chunks"""
+        return sum(
+            plane.nbytes
+            for point in (*self._undo, *self._redo)
+            for planes in point.values()
+            for plane in planes
+        )
+
+    def _box(self, cx: int, cy: int) -> tuple:
+        """Returns the tiles (xt, yt, xb, yb) of chunk (cx, cy)"""
+        size = self.chunk_size
+        return (
+            cx * size,
+            cy * size,
+            min(self.map.width, (cx + 1) * size),
+            min(self.map.height, (cy + 1) * size),
+        )
+
+    def _copy(self, cx: int, cy: int) -> tuple:
+        """Returns a copy of the (h, v, f) codes of chunk (cx, cy), edges included"""
+        return tuple(
+            plane.copy() for plane in self.map.codes.region(*self._box(cx, cy))
+        )
+
+    def map_changed(self, change):
+        """Map.subscribe() callback, marks the chunks of change as pending"""
+        if self._applying:
+            return
+        xt, yt, xb, yb = change.box
+        if xt >= xb or yt >= yb:
+            return
+        size = self.chunk_size
+        for cx in range(xt // size, (xb - 1) // size + 1):
+            for cy in range(yt // size, (yb - 1) // size + 1):
+                self._pending.add((cx, cy))
+
+    def commit(self) -> bool:
+        """Makes the changes since the previous commit one undo point, fe.
+        once per editor action. Forgets the redo points.
+
+        Returns:
+            bool: True if there were changes
+        """
+        if not self._pending:
+            return False
+        point = {}
+        for chunk in self._pending:
+            point[chunk] = self._chunks[chunk]
+            self._chunks[chunk] = self._copy(*chunk)
+        self._pending.clear()
+        self._undo.append(point)
+        self._redo.clear()
+        return True
+
+    def undo(self) -> bool:
+        """Reverts the map to the previous undo point. Uncommitted changes
+        get committed first, so they are what gets undone.
+
+        Returns:
+            bool: False if there is nothing to undo
+        """
+        self.commit()
+        if not self._undo:
+            return False
+        self._redo.append(self._apply(self._undo.pop()))
+        return True
+
+    def redo(self) -> bool:
+        """Applies the latest undone undo point again
+
+        Returns:
+            bool: False if there is nothing to redo
+        """
+        self.commit()
+        if not self._redo:
+            return False
+        self._undo.append(self._apply(self._redo.pop()))
+        return True
+
+    def clear(self):
+        """Forgets all undo and redo points"""
+        self.commit()
+        self._undo.clear()
+        self._redo.clear()
+
+    def close(self):
+        """Stops following the map"""
+        self.map.unsubscribe(self.map_changed)
+
+    def _apply(self, point: dict) -> dict:
+        """Writes the chunks of point into the map with a single write_region().
+
+        Returns:
+            dict: the chunks point replaced, the undo point to go back
+        """
+        boxes = [self._box(*chunk) for chunk in point]
+        xt, yt = min(box[0] for box in boxes), min(box[1] for box in boxes)
+        xb, yb = max(box[2] for box in boxes), max(box[3] for box in boxes)
+        # the chunks between the ones of point stay as they are
+        region = self.map.copy_region(xt, yt, xb, yb)
+        for (chunk, planes), (cxt, cyt, cxb, cyb) in zip(point.items(), boxes):
+            for dst, src in zip(
+                region.codes.region(cxt - xt, cyt - yt, cxb - xt, cyb - yt), planes
+            ):
+                dst[...] = src
+        replaced = {chunk: self._chunks[chunk] for chunk in point}
+        self._chunks.update(point)
+        self._applying = True
+        try:
+            self.map.write_region(xt, yt, region)
+        finally:
+            self._applying = False
+        return replaced
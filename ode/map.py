@@ -17,14 +17,21 @@ anymore...
 """
 
 
-from time import time
 from ode.constants import *
+from ode.exploration import Exploration
+from ode import mapfile, mapjson
+from ode.sprites import SPRITES, pack_tile_key
+from ode.render import MapFramebuffer
 
 # from ode.util import BaseLoader
 from PIL import Image
 from random import seed, choice
+from itertools import chain
+from ode.util import gc_paused
 import json
+import numpy as np
 import blosc
+import os
 import pickle
 
 
@@ -32,35 +39,184 @@ import pickle
 seed()
 
 
+def write_file(filename: str, data: bytes):
+    """Writes data to filename through a temporary file, so a crash never
+    leaves half a file behind, and a map that is still reading from
+    filename (see Map.open_chunked()) keeps reading the old one."""
+    with open(f"{filename}.tmp", "wb") as outfile:
+        outfile.write(data)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(f"{filename}.tmp", filename)
+
+
+# lookup tables to turn whole code arrays into flag arrays in one go
+EDGE_FLAGS_LUT = np.array(EDGE_FLAGS, dtype=np.uint8)
+FLOOR_FLAGS_LUT = np.array(FLOOR_FLAGS, dtype=np.uint8)
+
+# offset of the tile on the other side of each edge of a tile
+EDGE_OFFSETS = {"n": (0, -1), "e": (1, 0), "s": (0, 1), "w": (-1, 0)}
+
+
+class TileCodes:
+    """Compact storage for the edge and floor styles of a grid of tiles.
+
+    Every edge/floor style is stored as its ID from the style registry in
+    ode.constants (EDGE_ID/FLOOR_ID) in a NumPy uint8 array. The MapTile,
+    TileEdge and TileFloor classes are views over one cell of this storage,
+    so a Map no longer needs a Python object per tile.
+
+    Edges live in two planes so every wall segment is stored exactly once:
+        h: horizontal edges, shape (width, height + 1)
+           h[x, y] is the north edge of (x, y) and the south edge of (x, y - 1)
+        v: vertical edges, shape (width + 1, height)
+           v[x, y] is the west edge of (x, y) and the east edge of (x - 1, y)
+    The n/e/s/w properties return (width, height) views into those planes.
+    """
+
+    __slots__ = ("width", "height", "h", "v", "f")
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        shape = (width, height)
+        self.h = np.full((width, height + 1), EDGE_ID[NONE], dtype=np.uint8)
+        self.v = np.full((width + 1, height), EDGE_ID[NONE], dtype=np.uint8)
+        self.f = np.full(shape, FLOOR_ID[FLOOR], dtype=np.uint8)
+
+    @classmethod
+    def empty(cls, width: int, height: int) -> "TileCodes":
+        """Returns codes with uninitialized arrays, to be filled in piece by
+        piece, see Map.open_chunked(). The OS only commits the memory of the
+        pages that get written."""
+        obj = cls.__new__(cls)
+        obj.width = width
+        obj.height = height
+        obj.h = np.empty((width, height + 1), dtype=np.uint8)
+        obj.v = np.empty((width + 1, height), dtype=np.uint8)
+        obj.f = np.empty((width, height), dtype=np.uint8)
+        return obj
+
+    def __getstate__(self) -> dict:
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __setstate__(self, state: dict):
+        # pickles from before ode.exploration also hold visited/seen arrays
+        for key in self.__slots__:
+            setattr(self, key, state[key])
+
+    def clear(self):
+        """Resets every edge to NONE and every floor to FLOOR, in place"""
+        self.h.fill(EDGE_ID[NONE])
+        self.v.fill(EDGE_ID[NONE])
+        self.f.fill(FLOOR_ID[FLOOR])
+
+    def region(self, xt: int, yt: int, xb: int, yb: int) -> list:
+        """Returns the [h, v, f] views of the tiles in [xt, xb) x [yt, yb),
+        edges included, the same planes as those of Map.copy_region()"""
+        return [
+            self.h[xt:xb, yt : yb + 1],
+            self.v[xt : xb + 1, yt:yb],
+            self.f[xt:xb, yt:yb],
+        ]
+
+    @property
+    def n(self) -> np.ndarray:
+        return self.h[:, :-1]
+
+    @property
+    def s(self) -> np.ndarray:
+        return self.h[:, 1:]
+
+    @property
+    def w(self) -> np.ndarray:
+        return self.v[:-1, :]
+
+    @property
+    def e(self) -> np.ndarray:
+        return self.v[1:, :]
+
+
 class TileBase:
     """Base class for TileEdge and TileFloor.
 
     Mainly used to contain some methods/constants that are
     shared between the child classes.
 
+    Instances are views over one cell of a uint8 code array. Instances
+    created directly own a single cell array of their own.
+
     NOTE: Should not be instantiated itself, instead instantiate its
     child classes.
     """
 
-    DUMP_EXCLUDE_LIST = ["_dev_mode"]
+    __slots__ = ("_codes", "_index", "_dev_mode", "_on_change")
+
+    STYLE_LIST = EDGE_LIST
+    STYLE_ID = EDGE_ID
+    STYLE_FLAGS = EDGE_FLAGS
+    DEFAULT_STYLE = NONE
 
     def __init__(self, dev_mode=False, **kwargs):
-        if not hasattr(self, "style"):
-            self._style = NONE
-        if hasattr(self, "dev_mode"):
-            self._dev_mode = self.dev_mode or dev_mode
-        else:
-            self._dev_mode = dev_mode
+        self._codes = np.full(1, self.STYLE_ID[self.DEFAULT_STYLE], dtype=np.uint8)
+        self._index = 0
+        self._dev_mode = dev_mode
+        self._on_change = None
         for key, value in kwargs.items():
             if hasattr(self, key):
                 setattr(self, key, value)
 
+    @classmethod
+    def view(cls, codes, index, dev_mode=False, on_change=None):
+        """Returns an instance backed by codes[index] instead of its own storage
+
+        on_change(old, new) gets called with the old and new code whenever
+        the style actually changes.
+        """
+        obj = cls.__new__(cls)
+        obj._codes = codes
+        obj._index = index
+        obj._dev_mode = dev_mode
+        obj._on_change = on_change
+        return obj
+
+    def __getstate__(self) -> dict:
+        return {"_style": self._style, "_dev_mode": self._dev_mode}
+
+    def __setstate__(self, state: dict):
+        """Also restores the __dict__ state of pickles made before the views"""
+        self.__init__(dev_mode=state.get("_dev_mode", False))
+        self.style = state.get("_style", self.DEFAULT_STYLE)
+
     def __repr__(self) -> str:
         return self.dumps()
 
     def __str__(self) -> str:
         return self.dumps()
 
+    @property
+    def _style(self) -> str:
+        return self.STYLE_LIST[self._codes[self._index]]
+
+    @property
+    def code(self) -> int:
+        """Integer ID of the style, as stored in the code arrays"""
+        return int(self._codes[self._index])
+
+    @property
+    def flags(self) -> int:
+        """Property flags (ode.constants.FLAG_*) of the style"""
+        return self.STYLE_FLAGS[self._codes[self._index]]
+
+    def has_flag(self, flag: int) -> bool:
+        return bool(self.STYLE_FLAGS[self._codes[self._index]] & flag)
+
+    def _set_code(self, code: int):
+        old = self._codes[self._index]
+        self._codes[self._index] = code
+        if self._on_change is not None and old != code:
+            self._on_change(int(old), code)
+
     @property
     def dev_mode(self) -> bool:
         return self._dev_mode
@@ -73,15 +229,7 @@ class TileBase:
     @property
     def dump(self) -> dict:
         """Returns a dict representation of the instance"""
-        result = {}
-        for key, value in self.__dict__.items():
-            if (
-                key.startswith("_")
-                and not key.startswith("__")
-                and key not in self.DUMP_EXCLUDE_LIST
-            ):
-                result[key[1:]] = value
-        return result
+        return {"style": self._style}
 
     def dumps(self, **kwargs) -> str:
         """Returns a json string representation of the instance.
@@ -98,40 +246,40 @@ class TileBase:
 class TileEdge(TileBase):
     """Class to represent the edge of a MapTile"""
 
+    __slots__ = ()
+
     def __init__(self, dev_mode=False, **kwargs):
         super().__init__(dev_mode, **kwargs)
 
     @property
     def style(self) -> str:
-        if self._style not in EDGE_LIST:
-            self._style = NONE
         return self._style
 
     @style.setter
     def style(self, value: str) -> bool:
-        if value in EDGE_LIST:
-            self._style = value
+        if value in EDGE_ID:
+            self._set_code(EDGE_ID[value])
             return True
         return False
 
     @property
     def visible(self) -> bool:
         if self._dev_mode:
-            return self._style in EDGE_LIST_VISIBLE_DEV
+            return self.has_flag(FLAG_VISIBLE_DEV)
         else:
-            return self._style in EDGE_LIST_VISIBLE
+            return self.has_flag(FLAG_VISIBLE)
 
     @property
     def solid(self) -> bool:
-        return self._style in EDGE_LIST_SOLID
+        return self.has_flag(FLAG_SOLID)
 
     @property
     def solid_room(self) -> bool:
-        return self._style in EDGE_LIST_SOLID_ROOM
+        return self.has_flag(FLAG_SOLID_ROOM)
 
     @property
     def passable(self) -> bool:
-        return self._style in EDGE_LIST_PASSABLE
+        return self.has_flag(FLAG_PASSABLE)
 
     @property
     def filename(self) -> str:
@@ -147,10 +295,15 @@ class TileEdge(TileBase):
 class TileFloor(TileBase):
     """Class to represent the floor of a MapTile"""
 
+    __slots__ = ()
+
+    STYLE_LIST = FLOOR_LIST
+    STYLE_ID = FLOOR_ID
+    STYLE_FLAGS = FLOOR_FLAGS
+    # new tiles should start with floor instead of none
+    DEFAULT_STYLE = FLOOR
+
     def __init__(self, dev_mode=False, **kwargs):
-        # check because new tiles should start with floor instead of none
-        if "style" not in kwargs.keys():
-            kwargs["style"] = FLOOR
         super().__init__(dev_mode, **kwargs)
 
     @property
@@ -159,31 +312,31 @@ class TileFloor(TileBase):
 
     @style.setter
     def style(self, value: str) -> bool:
-        if value in FLOOR_LIST:
-            self._style = value
+        if value in FLOOR_ID:
+            self._set_code(FLOOR_ID[value])
             return True
-        self._style = FLOOR
+        self._set_code(FLOOR_ID[FLOOR])
         return False
 
     @property
     def dev_visible(self) -> bool:
         """only used for SEPA_INV for now, which is used to separate rooms"""
         if self._dev_mode:
-            return self._style in FLOOR_LIST_VISIBLE_DEV
+            return self.has_flag(FLAG_VISIBLE_DEV)
         else:
-            return self._style in FLOOR_LIST_VISIBLE
+            return self.has_flag(FLAG_VISIBLE)
 
     @property
     def solid(self) -> bool:
-        return self._style in FLOOR_LIST_SOLID
+        return self.has_flag(FLAG_SOLID)
 
     @property
     def passable(self) -> bool:
-        return self._style in FLOOR_LIST_PASSABLE
+        return self.has_flag(FLAG_PASSABLE)
 
     @property
     def passable_warn(self) -> bool:
-        return self._style in FLOOR_LIST_PASSABLE_WARN
+        return self.has_flag(FLAG_PASSABLE_WARN)
 
     @property
     def filename(self) -> str:
@@ -191,42 +344,102 @@ class TileFloor(TileBase):
 
 
 class MapTile:
-    """Class to represent a map tile."""
+    """Class to represent a map tile.
+
+    A MapTile is a lightweight view over one cell of a TileCodes storage.
+    Tiles taken from Map.tiles write straight through to the map, tiles
+    created directly own a 1x1 TileCodes of their own. The same goes for
+    visited/seen, which live in an Exploration.
+
+    The edges of a map tile are shared with its neighbours, so setting the
+    east edge of (x, y) also sets the west edge of (x + 1, y).
+    """
 
-    DUMP_EXCLUDE_LIST = ["_dev_mode", "_image"]
+    __slots__ = ("_store", "_explored", "_x", "_y", "_dev_mode", "_owner")
 
     def __init__(self, dev_mode=False, visited=False, seen=False, **kwargs):
-        if hasattr(self, "dev_mode"):
-            self._dev_mode = self.dev_mode or dev_mode
-        else:
-            self._dev_mode = dev_mode
+        self._store = TileCodes(1, 1)
+        self._explored = Exploration(1, 1)
+        self._x = 0
+        self._y = 0
+        self._dev_mode = dev_mode
+        self._owner = None
 
-        self._visited = visited
-        self._seen = seen
+        self.visited = visited
+        self.seen = seen
 
-        if "seen" in kwargs.keys():
-            self._seen = kwargs["seen"]
+        for edge in ["n", "e", "s", "w", "f"]:
+            if edge in kwargs.keys():
+                if type(kwargs[edge]) == str:
+                    getattr(self, edge).style = kwargs[edge]
+                elif "style" in kwargs[edge]:
+                    getattr(self, edge).style = kwargs[edge]["style"]
 
-        for edge in ["n", "e", "s", "w"]:
-            if not hasattr(self, edge):
-                if edge in kwargs.keys():
-                    if type(kwargs[edge]) == str:
-                        setattr(self, f"_{edge}", TileEdge(style=kwargs[edge]))
-                    else:
-                        setattr(self, f"_{edge}", TileEdge(**kwargs[edge]))
-                else:
-                    setattr(self, f"_{edge}", TileEdge())
-
-        # TODO: add roof
-        for floor in ["f"]:
-            if not hasattr(self, floor):
-                if floor in kwargs.keys():
-                    if type(kwargs[floor]) == str:
-                        setattr(self, f"_{floor}", TileFloor(style=kwargs[floor]))
-                    else:
-                        setattr(self, f"_{floor}", TileFloor(**kwargs[floor]))
-                else:
-                    setattr(self, f"_{floor}", TileFloor())
+    @classmethod
+    def view(
+        cls,
+        store: TileCodes,
+        x: int,
+        y: int,
+        dev_mode=False,
+        owner: "Map" = None,
+        explored: Exploration = None,
+    ) -> "MapTile":
+        """Returns an instance backed by cell (x, y) of store, and of explored
+        for visited/seen. explored defaults to the exploration of owner.
+
+        Edge changes made through the view are reported to owner, if provided.
+        """
+        obj = cls.__new__(cls)
+        obj._store = store
+        if explored is None:
+            explored = (
+                owner.exploration
+                if owner is not None
+                else Exploration(store.width, store.height)
+            )
+        obj._explored = explored
+        obj._x = x
+        obj._y = y
+        obj._dev_mode = dev_mode
+        obj._owner = owner
+        return obj
+
+    def __getstate__(self) -> dict:
+        return {"_dev_mode": self._dev_mode, **self.dump}
+
+    def __setstate__(self, state: dict):
+        """Also restores the __dict__ state of pickles made before the views.
+
+        Those stored the edges either as TileEdge/TileFloor or as str and
+        (in some versions) misspelled visited as visisted.
+        """
+        kwargs = {}
+        for key in ["n", "e", "s", "w", "f"]:
+            value = state.get(key, state.get(f"_{key}"))
+            if isinstance(value, TileBase):
+                value = value.style
+            if value is not None:
+                kwargs[key] = value
+        self.__init__(
+            dev_mode=state.get("_dev_mode", False),
+            visited=state.get(
+                "visited", state.get("_visited", state.get("_visisted", False))
+            ),
+            seen=state.get("seen", state.get("_seen", False)),
+            **kwargs,
+        )
+
+    def copy_from(self, other: "MapTile"):
+        """Copies edges, floor and state of other into this tile
+
+        Since edges are shared, this also changes the facing edges of the
+        neighbouring tiles.
+        """
+        for key in ["n", "e", "s", "w", "f"]:
+            getattr(self, key).style = getattr(other, key).style
+        self.visited = other.visited
+        self.seen = other.seen
 
     @classmethod
     def random(
@@ -270,73 +483,65 @@ class MapTile:
     @dev_mode.setter
     def dev_mode(self, value: bool) -> bool:
         self._dev_mode = value
-        for key in ['n', "e", "s", "w", "f"]:
-            obj = getattr(self, key)
-            setattr(obj, "dev_mode", self._dev_mode)
         return value
 
     @property
-    def visisted(self) -> bool:
-        """True if the MapTile has been visisted by player"""
-        return self._visisted
+    def visited(self) -> bool:
+        """True if the MapTile has been visited by player"""
+        return self._explored.visited[self._explored.index(self._x, self._y)]
 
-    @visisted.setter
-    def visisted(self, value: bool) -> bool:
-        self._visisted = value
-        return self._visisted
+    @visited.setter
+    def visited(self, value: bool) -> bool:
+        self._explored.visited[self._explored.index(self._x, self._y)] = value
+        return value
+
+    # kept for backwards compatibility
+    visisted = visited
 
     @property
     def seen(self) -> bool:
         """True if the MapTile has been seen by player"""
-        return self._seen
+        return self._explored.seen[self._explored.index(self._x, self._y)]
 
     @seen.setter
     def seen(self, value: bool) -> bool:
-        self._seen = value
-        return self._seen
+        self._explored.seen[self._explored.index(self._x, self._y)] = value
+        return value
 
     @property
     def image(self) -> Image:
         """Returns a PIL.Image() representation of the tile
 
+        The image comes from the shared sprite cache, do not modify it.
+
         TODO: implement logic for hidden doors etc.
         """
         # TODO: perhaps move to class Map due to corners
-        __image = Image.open(self._f.filename)
-        __paste = Image.open(self._n.filename)
-        __image.paste(__paste, (0, 0), __paste)
-        __paste = Image.open(self._e.filename).transpose(Image.ROTATE_270)
-        __image.paste(__paste, (TILESIZE - 2, 0), __paste)
-        __paste = Image.open(self._s.filename).transpose(Image.ROTATE_180)
-        __image.paste(__paste, (0, TILESIZE - 2), __paste)
-        __paste = Image.open(self._w.filename).transpose(Image.ROTATE_90)
-        __image.paste(__paste, (0, 0), __paste)
-        return __image
+        return SPRITES.tile(
+            self.f.style,
+            self.n.style,
+            self.e.style,
+            self.s.style,
+            self.w.style,
+            self._dev_mode,
+        )
 
     @property
     def dump_long_dict(self) -> dict:
-        return {
-            NORTH: self._n,
-            EAST:  self._e,
-            SOUTH: self._s,
-            WEST:  self._w
-        }
+        return {NORTH: self.n, EAST: self.e, SOUTH: self.s, WEST: self.w}
 
     @property
     def dump(self) -> dict:
         """Returns a dict representation of the instance"""
-        result = {}
-        for key, value in self.__dict__.items():
-            if (
-                key.startswith("_")
-                and not key.startswith("__")
-                and key not in self.DUMP_EXCLUDE_LIST
-            ):
-                if type(value) == TileEdge or type(value) == TileFloor:
-                    result[key[1:]] = value.dump
-                else:
-                    result[key[1:]] = value
-        return result
+        return {
+            "visited": self.visited,
+            "seen": self.seen,
+            "n": self.n.dump,
+            "e": self.e.dump,
+            "s": self.s.dump,
+            "w": self.w.dump,
+            "f": self.f.dump,
+        }
 
     def dumps(self, **kwargs) -> str:
         """Returns a json string representation of the instance
@@ -345,71 +550,197 @@ class MapTile:
         """
         return json.dumps(self.dump, **kwargs)
 
+    def _edge(self, key: str) -> TileEdge:
+        on_change = None
+        if self._owner is not None:
+            on_change = lambda old, new: self._owner._edge_changed(
+                key, self._x, self._y, old, new
+            )
+        return TileEdge.view(
+            getattr(self._store, key),
+            (self._x, self._y),
+            dev_mode=self._dev_mode,
+            on_change=on_change,
+        )
+
     @property
     def n(self) -> TileEdge:
-        return self._n
+        return self._edge("n")
 
     @n.setter
     def n(self, value: str) -> bool:
         if value in EDGE_LIST:
-            self._n = self._n.style(value)
+            self.n.style = value
         return value in EDGE_LIST
 
     @property
     def e(self) -> TileEdge:
-        return self._e
+        return self._edge("e")
 
     @e.setter
     def e(self, value: str) -> bool:
         if value in EDGE_LIST:
-            self._e = self._e.style(value)
+            self.e.style = value
         return value in EDGE_LIST
 
     @property
     def s(self) -> TileEdge:
-        return self._s
+        return self._edge("s")
 
     @s.setter
     def s(self, value: str) -> bool:
         if value in EDGE_LIST:
-            self._s = self._s.style(value)
+            self.s.style = value
         return value in EDGE_LIST
 
     @property
     def w(self) -> TileEdge:
-        return self._w
+        return self._edge("w")
 
     @w.setter
     def w(self, value: str) -> bool:
         if value in EDGE_LIST:
-            self._w = self._w.style(value)
+            self.w.style = value
         return value in EDGE_LIST
 
     @property
     def f(self) -> TileFloor:
-        return self._f
+        on_change = None
+        if self._owner is not None:
+            on_change = lambda old, new: self._owner._floor_changed(
+                self._x, self._y, old, new
+            )
+        return TileFloor.view(
+            self._store.f,
+            (self._x, self._y),
+            dev_mode=self._dev_mode,
+            on_change=on_change,
+        )
 
     @f.setter
     def f(self, value: str) -> bool:
         if value in FLOOR_LIST:
-            self._f = self._f.style(value)
+            self.f.style = value
         return value in FLOOR_LIST
 
+    # the attribute names from before MapTile became a view
+    _n = n
+    _e = e
+    _s = s
+    _w = w
+    _f = f
+
+
+class MapColumn:
+    """One column (fixed x) of Map.tiles, indexable by y"""
+
+    __slots__ = ("_map", "_x")
+
+    def __init__(self, map: "Map", x: int):
+        self._map = map
+        self._x = x
+
+    def __len__(self) -> int:
+        return self._map.height
+
+    def __getitem__(self, y: int) -> MapTile:
+        y = range(self._map.height)[y]
+        self._map.require(self._x, y, self._x + 1, y + 1)
+        return MapTile.view(
+            self._map._codes,
+            self._x,
+            y,
+            dev_mode=self._map.dev_mode,
+            owner=self._map,
+            explored=self._map._exploration,
+        )
+
+    def __setitem__(self, y: int, tile: MapTile):
+        self[y].copy_from(tile)
+
+    def __iter__(self):
+        for y in range(self._map.height):
+            yield self[y]
+
+
+class MapTiles:
+    """Map.tiles accessor, so map.tiles[x][y] keeps returning a MapTile"""
+
+    __slots__ = ("_map",)
+
+    def __init__(self, map: "Map"):
+        self._map = map
+
+    def __len__(self) -> int:
+        return self._map.width
+
+    def __getitem__(self, x: int) -> MapColumn:
+        return MapColumn(self._map, range(self._map.width)[x])
+
+    def __iter__(self):
+        for x in range(self._map.width):
+            yield self[x]
+
+
+# Coordinates packed into one int as (x << PACK_SHIFT) | y. Packed ints sort
+# the same way as (x, y) tuples, as long as x and y are not negative.
+PACK_SHIFT = 32
+PACK_MASK = (1 << PACK_SHIFT) - 1
+
+
+def pack_coords(x: int, y: int) -> int:
+    return (x << PACK_SHIFT) | y
+
+
+def unpack_coords(packed: int) -> tuple:
+    return (packed >> PACK_SHIFT, packed & PACK_MASK)
+
+
+def pack_coord_arrays(xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+    """pack_coords() for whole arrays of coordinates, returns an int64 array"""
+    return (xs.astype(np.int64) << PACK_SHIFT) | ys.astype(np.int64)
+
 
 class MapCoord:
-    """Simple class to represent and handle Map coordinates"""
+    """Simple class to represent and handle Map coordinates
+
+    Hashable (on its coordinates), so do not change a MapCoord while it
+    is used as a key in a set or dict.
+    """
+
+    __slots__ = ("_x", "_y")
 
     def __init__(self, x, y):
         self._x = x
         self._y = y
 
-    def __dict__(self) -> dict:
-        return self.dump
+    @classmethod
+    def unpack(cls, packed: int) -> "MapCoord":
+        return cls(*unpack_coords(packed))
+
+    def __getstate__(self) -> tuple:
+        return self.coords
+
+    def __setstate__(self, state: tuple or dict):
+        """Also restores the __dict__ state of pickles made before __slots__"""
+        if type(state) == dict:
+            state = (state["_x"], state["_y"])
+        self._x, self._y = state
+
+    def __repr__(self) -> str:
+        return f"MapCoord({self._x}, {self._y})"
+
+    def __hash__(self) -> int:
+        return hash(self.coords)
 
     def __eq__(self, other: "MapCoord") -> bool:
+        if type(other) != MapCoord:
+            return NotImplemented
         return self.coords == other.coords
 
     def __ne__(self, other: "MapCoord") -> bool:
+        if type(other) != MapCoord:
+            return NotImplemented
         return self.coords != other.coords
 
     def __lt__(self, other: "MapCoord") -> bool:
@@ -425,22 +756,17 @@ class MapCoord:
         return self.coords >= other.coords
 
     def __iter__(self):
-        self.__cnt = 0
-        return self
-
-    def __next__(self):
-        self.__cnt += 1
-        if self.__cnt == 1:
-            return self._x
-        elif self.__cnt == 2:
-            return self._y
-        else:
-            raise StopIteration
+        yield self._x
+        yield self._y
 
     @property
     def coords(self) -> tuple:
         return (self._x, self._y)
 
+    @property
+    def packed(self) -> int:
+        return pack_coords(self._x, self._y)
+
     @coords.setter
     def coords(self, coords: tuple) -> tuple:
         self._x, self._y = coords
@@ -491,146 +817,889 @@ class Room:
     Accepts coordinates as a list of tuples(x, y) or a list of dicts={x:int, y:int}
     The latter is needed for loading/saving to JSON
 
+    A Room is immutable and stores its coordinates as a frozenset of packed
+    ints (see pack_coords()), so `coords in room` is O(1), rooms are hashable
+    (the hash is cached) and support set algebra: room | other, room & other
+    and room - other return new rooms. The sorted list of MapCoord and the
+    bounding box are only built when asked for.
+
     Use to fe. place monster groups, and perhaps events."""
 
+    __slots__ = ("_cells", "_hash", "_coords", "_sorted", "_bbox")
+
     def __init__(self, coords: list or dict = []):
-        self._coords = []
         # TODO: this needs fixing
         if type(coords) == dict and "coords" in coords:
             _coords = coords['coords']
         else:
             _coords = coords
+        cells = []
         for element in _coords:
             if type(element) == dict:
-                self._coords.append(MapCoord(element["x"], element["y"]))
+                cells.append(pack_coords(element["x"], element["y"]))
+            elif type(element) == MapCoord:
+                cells.append(element.packed)
             else:
-                self._coords.append(MapCoord(*element))
-        self._coords.sort()
+                cells.append(pack_coords(*element))
+        self._set_cells(frozenset(cells))
+
+    def _set_cells(self, cells: frozenset):
+        self._cells = cells
+        self._hash = hash(cells)
+        self._coords = None
+        self._sorted = None
+        self._bbox = None
+
+    @classmethod
+    def from_packed(cls, cells) -> "Room":
+        """Constructs a Room from an iterable of packed coordinates"""
+        room = cls.__new__(cls)
+        room._set_cells(frozenset(cells))
+        return room
+
+    @classmethod
+    def from_packed_runs(cls, cells: list, bounds: list) -> list:
+        """Constructs a Room per run cells[bounds[i]:bounds[i + 1]] of packed
+        coordinates, for building many rooms at once, see Map.get_rooms_all()"""
+        rooms = []
+        new = cls.__new__
+        with gc_paused():
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                room = new(cls)
+                room._set_cells(frozenset(cells[start:end]))
+                rooms.append(room)
+        return rooms
+
+    def __getstate__(self) -> dict:
+        return {"cells": self._cells}
+
+    def __setstate__(self, state: dict):
+        """Also restores the __dict__ state of pickles made before __slots__"""
+        if "cells" in state:
+            self._set_cells(state["cells"])
+        else:
+            self._set_cells(frozenset(coord.packed for coord in state["_coords"]))
 
     def __len__(self) -> int:
         return self.size
 
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __contains__(self, coords: tuple or MapCoord) -> bool:
+        if type(coords) == MapCoord:
+            return coords.packed in self._cells
+        return pack_coords(*coords) in self._cells
+
     def __eq__(self, other: "Room") -> bool:
-        if self.size != other.size:
-            return False
-        # since self._coords is a sorted property we can just do direct
-        # comparison of elements by index.
-        # not sure if the below is faster than using indexes of both lists
-        # since this  is not a method that gets called often (likely never
-        # ingame) I don't care that much about performance
-        for index, element in enumerate(self.coords):
-            if element != other.coords[index]:
-                return False
-        return True
+        if type(other) != Room:
+            return NotImplemented
+        return self._hash == other._hash and self._cells == other._cells
 
     def __lt__(self, other: "Room") -> bool:
-        if self.coords > other.coords:
-            return True 
-        return False
-        
+        return self.sort_key > other.sort_key
+
     def __gt__(self, other: "Room") -> bool:
-        if self.coords < other.coords:
-            return True
-        return False
+        return self.sort_key < other.sort_key
+
+    def __or__(self, other: "Room") -> "Room":
+        return Room.from_packed(self._cells | other._cells)
+
+    def __and__(self, other: "Room") -> "Room":
+        return Room.from_packed(self._cells & other._cells)
+
+    def __sub__(self, other: "Room") -> "Room":
+        return Room.from_packed(self._cells - other._cells)
 
     def __iter__(self):
-        self.__cnt = 0
-        return self
-    
-    def __next__(self):
-        if self.__cnt >= self.size-1:
-            raise StopIteration
-        else:
-            self.__cnt += 1
-        return self._coords[self.__cnt]
+        return iter(self.coords)
 
     @property
     def size(self) -> int:
-        return len(self._coords)
+        return len(self._cells)
+
+    @property
+    def cells(self) -> frozenset:
+        """Returns the coordinates as a frozenset of packed ints"""
+        return self._cells
+
+    @property
+    def sort_key(self) -> tuple:
+        """Sorted packed coordinates, these order the same as the list of MapCoord"""
+        if self._sorted is None:
+            self._sorted = tuple(sorted(self._cells))
+        return self._sorted
 
     @property
     def coords(self) -> list[MapCoord]:
+        if self._coords is None:
+            self._coords = [MapCoord.unpack(packed) for packed in self.sort_key]
         return self._coords
 
+    @property
+    def coord_set(self) -> set:
+        """Returns the coordinates as a set of (x, y) tuples"""
+        return {unpack_coords(packed) for packed in self._cells}
+
+    @property
+    def coord_arrays(self) -> tuple:
+        """Returns the coordinates as a tuple of (xs, ys) NumPy arrays,
+        usable to index the [x, y] arrays of a Map directly"""
+        packed = np.fromiter(self._cells, dtype=np.int64, count=len(self._cells))
+        return (packed >> PACK_SHIFT, packed & PACK_MASK)
+
+    @property
+    def bbox(self) -> tuple:
+        """Returns the bounding box as (x_min, y_min, x_max, y_max), inclusive"""
+        if self._bbox is None and len(self._cells) > 0:
+            xs, ys = self.coord_arrays
+            self._bbox = (int(xs.min()), int(ys.min()), int(xs.max()), int(ys.max()))
+        return self._bbox
+
     @property
     def first(self) -> tuple:
-        if len(self._coords) > 0:
-            return self.coords[0].coords
+        if len(self._cells) > 0:
+            return unpack_coords(min(self._cells))
 
     @property
     def dump(self) -> dict:
-        return {"coords": [coord.dump for coord in self._coords]}
+        return {"coords": [coord.dump for coord in self.coords]}
 
     def dumps(self, **kwargs) -> str:
         return json.dumps(self.dump, **kwargs)
 
 
+def label_components(codes: TileCodes) -> np.ndarray:
+    """Connected-component labeling of the tiles in codes.
+
+    Two neighbouring tiles are connected when the edge between them does not
+    have FLAG_SOLID_ROOM. Works on the whole grid at once with a vectorized
+    union-find: every round hooks the larger root of each open edge onto the
+    smaller one, followed by pointer jumping until every tile points at its
+    root. This needs only a handful of rounds, even for 1000x1000 maps.
+
+    Args:
+        codes (TileCodes): the storage to label
+
+    Returns:
+        np.ndarray: int32 array of shape (width, height), indexed as [x, y].
+                    IDs are consecutive and ordered by the first tile (in x,
+                    then y order) of each room.
+    """
+    width, height = codes.width, codes.height
+    index = np.arange(width * height, dtype=np.int32).reshape(width, height)
+    open_v = (EDGE_FLAGS_LUT[codes.v[1:-1, :]] & FLAG_SOLID_ROOM) == 0
+    open_h = (EDGE_FLAGS_LUT[codes.h[:, 1:-1]] & FLAG_SOLID_ROOM) == 0
+    a = np.concatenate((index[:-1, :][open_v], index[:, :-1][open_h]))
+    b = np.concatenate((index[1:, :][open_v], index[:, 1:][open_h]))
+    parent = index.ravel().copy()
+    while True:
+        root_a = parent[a]
+        root_b = parent[b]
+        crossing = root_a != root_b
+        if not crossing.any():
+            break
+        a, b = a[crossing], b[crossing]
+        root_a, root_b = root_a[crossing], root_b[crossing]
+        np.minimum.at(parent, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+        while True:
+            jumped = parent[parent]
+            if np.array_equal(jumped, parent):
+                break
+            parent = jumped
+    # roots are the smallest index of their room, so this keeps that order
+    _, labels = np.unique(parent, return_inverse=True)
+    return labels.astype(np.int32).reshape(width, height)
+
+
+class RoomIndex:
+    """Keeps the room ID of every tile of a map up to date while edges change.
+
+    Built once with label_components(), after that edge_changed() only
+    relabels the rooms that are affected by the change:
+        placing a wall (or any FLAG_SOLID_ROOM edge) can split a room in two,
+        which is checked with a flood fill from both sides at the same time,
+        so the cost is bound by the smaller of the two parts. Should both
+        parts turn out large, one label_components() pass finishes the job.
+        removing a wall can merge two rooms, the smaller one gets relabeled.
+    Room IDs stay stable for the rooms that were not relabeled, but are not
+    consecutive after edits. IDs of merged rooms are reused.
+
+    Subscribe map_changed() to a Map to keep the index in sync with it, bulk
+    changes make it relabel everything on the next query.
+    """
+
+    # rooms of up to that many tiles are flood filled by room(), instead of
+    # scanning the labels of the whole map
+    FLOOD_MAX = 4096
+
+    def __init__(self, codes: TileCodes):
+        self._codes = codes
+        self._labels = None
+        self._rooms = {}
+
+    @property
+    def labels(self) -> np.ndarray:
+        """Room ID of every tile, int32 array of shape (width, height)"""
+        if self._labels is None:
+            self._labels = label_components(self._codes)
+            self._sizes = np.bincount(self._labels.ravel()).tolist()
+            self._free = []
+            self._rooms = {}
+        return self._labels
+
+    def map_changed(self, change: "MapChange"):
+        """Map.subscribe() callback"""
+        if change.kind == CHANGE_EDGE:
+            self.edge_changed(change.key, change.x, change.y, change.old, change.new)
+        elif change.kind == CHANGE_REGION:
+            self._labels = None
+
+    def room_id(self, x: int, y: int) -> int:
+        """Returns the room ID of tile (x, y), O(1)"""
+        return int(self.labels[x, y])
+
+    def room(self, x: int, y: int) -> "Room":
+        """Returns the Room containing tile (x, y), cached until the room changes.
+
+        Small rooms are flood filled, large ones are read from the labels in
+        one vectorized pass: every tile with the ID of a room is part of it."""
+        room_id = self.room_id(x, y)
+        if room_id not in self._rooms:
+            if self.size(room_id) <= self.FLOOD_MAX:
+                self._rooms[room_id] = Room(self._flood((x, y), room_id))
+            else:
+                xs, ys = np.nonzero(self.labels == room_id)
+                self._rooms[room_id] = Room.from_packed(
+                    pack_coord_arrays(xs, ys).tolist()
+                )
+        return self._rooms[room_id]
+
+    def size(self, room_id: int) -> int:
+        """Returns the number of tiles in room room_id"""
+        self.labels  # relabels first, if a bulk change made _sizes stale
+        return self._sizes[room_id]
+
+    def _neighbours(self, x: int, y: int) -> list:
+        """Returns the tiles connected to (x, y) by an edge without FLAG_SOLID_ROOM"""
+        h, v = self._codes.h, self._codes.v
+        result = []
+        if x > 0 and not EDGE_FLAGS[v[x, y]] & FLAG_SOLID_ROOM:
+            result.append((x - 1, y))
+        if x + 1 < self._codes.width and not EDGE_FLAGS[v[x + 1, y]] & FLAG_SOLID_ROOM:
+            result.append((x + 1, y))
+        if y > 0 and not EDGE_FLAGS[h[x, y]] & FLAG_SOLID_ROOM:
+            result.append((x, y - 1))
+        if y + 1 < self._codes.height and not EDGE_FLAGS[h[x, y + 1]] & FLAG_SOLID_ROOM:
+            result.append((x, y + 1))
+        return result
+
+    def _flood(self, start: tuple, room_id: int) -> list:
+        """Returns all tiles with room_id that are connected to start"""
+        visited = {start}
+        stack = [start]
+        while stack:
+            for cell in self._neighbours(*stack.pop()):
+                if cell not in visited and self.labels[cell] == room_id:
+                    visited.add(cell)
+                    stack.append(cell)
+        return list(visited)
+
+    def _relabel(self, cells: tuple, old_id: int, new_id: int):
+        """Moves cells, given as a tuple of (xs, ys), from old_id to new_id"""
+        self.labels[cells] = new_id
+        self._sizes[old_id] -= len(cells[0])
+        self._sizes[new_id] += len(cells[0])
+        self._rooms.pop(old_id, None)
+        self._rooms.pop(new_id, None)
+        if self._sizes[old_id] == 0:
+            self._free.append(old_id)
+
+    def _new_id(self) -> int:
+        if self._free:
+            return self._free.pop()
+        self._sizes.append(0)
+        return len(self._sizes) - 1
+
+    def edge_changed(self, key: str, x: int, y: int, old: int, new: int):
+        """Updates the index after edge key of tile (x, y) changed from code old to new"""
+        if self._labels is None:
+            # gets relabeled from scratch anyway
+            return
+        was_open = not EDGE_FLAGS[old] & FLAG_SOLID_ROOM
+        is_open = not EDGE_FLAGS[new] & FLAG_SOLID_ROOM
+        if was_open == is_open:
+            return
+        dx, dy = EDGE_OFFSETS[key]
+        a, b = (x, y), (x + dx, y + dy)
+        if not (0 <= b[0] < self._codes.width and 0 <= b[1] < self._codes.height):
+            # edge of the map, there is nothing on the other side
+            return
+        if is_open:
+            self._merge(a, b)
+        else:
+            self._split(a, b)
+
+    def _merge(self, a: tuple, b: tuple):
+        id_a, id_b = int(self.labels[a]), int(self.labels[b])
+        if id_a == id_b:
+            return
+        if self._sizes[id_a] < self._sizes[id_b]:
+            a, b, id_a, id_b = b, a, id_b, id_a
+        if self._sizes[id_b] * 64 > self.labels.size:
+            # large rooms are cheaper to relabel in one pass over the grid
+            cells = np.nonzero(self.labels == id_b)
+        else:
+            # the wall is gone already, so _flood() only stops on the label
+            cells = tuple(zip(*self._flood(b, id_b)))
+        self._relabel(cells, id_b, id_a)
+
+    def _split(self, a: tuple, b: tuple):
+        room_id = int(self.labels[a])
+        side_a = ({a}, [a])
+        side_b = ({b}, [b])
+        budget = max(1024, self.labels.size // 64)
+        while len(side_a[0]) + len(side_b[0]) < budget:
+            for (visited, queue), (other, _) in ((side_a, side_b), (side_b, side_a)):
+                if not queue:
+                    # this side ran out without meeting the other: it is a room now
+                    self._relabel(tuple(zip(*visited)), room_id, self._new_id())
+                    return
+                for cell in self._neighbours(*queue.pop()):
+                    if cell in other:
+                        return
+                    if cell not in visited:
+                        visited.add(cell)
+                        queue.append(cell)
+        # both sides are large, one vectorized pass over the grid is cheaper
+        # than finishing the flood fill. Only the room of b gets relabeled.
+        components = label_components(self._codes)
+        if components[a] != components[b]:
+            cells = np.nonzero((self.labels == room_id) & (components == components[b]))
+            self._relabel(cells, room_id, self._new_id())
+
+
+class MapChange:
+    """One change of a Map, as passed to the callbacks of Map.subscribe()
+
+    kind is one of ode.constants.CHANGE_*:
+        CHANGE_EDGE: edge key ("n", "e", "s" or "w") of tile (x, y) changed
+                     from code old to new
+        CHANGE_FLOOR: the floor of tile (x, y) changed from code old to new
+        CHANGE_REGION: anything within box may have changed, fe. after
+                       randomize() or write_region(). x, y, key, old and new
+                       are None.
+    box is (xt, yt, xb, yb): the tiles [xt, xb) x [yt, yb) that look different
+    now. For an edge those are both tiles that share it.
+    """
+
+    __slots__ = ("kind", "box", "x", "y", "key", "old", "new")
+
+    def __init__(
+        self, kind: str, box: tuple, x=None, y=None, key=None, old=None, new=None
+    ):
+        self.kind = kind
+        self.box = box
+        self.x = x
+        self.y = y
+        self.key = key
+        self.old = old
+        self.new = new
+
+    def __repr__(self) -> str:
+        if self.kind == CHANGE_REGION:
+            return f"MapChange({self.kind}, {self.box})"
+        return f"MapChange({self.kind}, ({self.x}, {self.y}), {self.key}, {self.old} -> {self.new})"
+
+    @property
+    def tiles(self):
+        """Generator over the (x, y) of every tile in box"""
+        xt, yt, xb, yb = self.box
+        for x in range(xt, xb):
+            for y in range(yt, yb):
+                yield (x, y)
+
+
 class Map:
-    """Main class in this module to represent a map."""
+    """Main class in this module to represent a map.
+
+    Changes to the tiles, either through the tile views (map.tiles[x][y].n.style
+    = WALL) or through the mutation methods (set_edge(), set_floor(),
+    paste_tile(), write_region()), are recorded as dirty tiles until
+    take_dirty() and emitted as MapChange events to the callbacks registered
+    with subscribe(). The room index and the framebuffer are kept up to date
+    that way, so their work is proportional to the change.
+    """
 
-    def __init__(self, width: int = 50, height: int = 50, tiles=None, dev_mode=False, room_list=[]):
+    # derived state that is rebuilt on demand instead of pickled
+    TRANSIENT_LIST = [
+        "_room_index",
+        "_room_list_grid",
+        "_framebuffer",
+        "_subscribers",
+        "_dirty",
+        "_dirty_all",
+        "_chunks",
+    ]
+
+    def __init__(
+        self,
+        width: int = 50,
+        height: int = 50,
+        tiles=None,
+        dev_mode=False,
+        room_list=[],
+        codes: TileCodes = None,
+    ):
         self.width = width
         self.height = height
         self._dev_mode = dev_mode
         # Load a dummy image for easy code completion (eg, set the type correctly)
         self._image = Image.open(PATH_DUMMY_IMAGE)
+        self._codes = TileCodes(self.width, self.height) if codes is None else codes
+        self._exploration = Exploration(self.width, self.height)
+        # free form data about the map, fe. a name, saved along with it
+        self.metadata = {}
+        self._init_transient()
         if tiles:
-            self.tiles = [
-                [MapTile(dev_mode=dev_mode, **tiles[x][y]) for x in range(self.width)]
-                for y in range(self.height)
-            ]
-        else:
-            self.tiles = [
-                [MapTile(dev_mode=dev_mode) for _ in range(self.width)]
-                for _ in range(self.height)
-            ]
+            self._load_tile_dicts(tiles)
         self._room_list = []
-        if len(room_list) > 0:
-            self._room_list = [Room(room) for room in room_list]
+        self._room_set = set()
+        self._room_list_sorted = True
+        self._room_list_grid = None
+        for room in room_list:
+            self.add_room(Room(room))
+
+    def __setstate__(self, state: dict):
+        """Restores pickled maps, including the ones pickled before the code arrays.
+
+        Those stored a list of lists of MapTile objects in tiles, which gets
+        copied into the code arrays here.
+        """
+        if "_codes" in state:
+            self.__dict__.update(state)
+            # dev mode is a render setting, older pickles have it too
+            self._dev_mode = False
+            self.__dict__.setdefault("metadata", {})
+            self._exploration = Exploration(self.width, self.height)
+            self._init_transient()
+            return
+        self.__init__(
+            state["width"],
+            state["height"],
+            dev_mode=state.get("_dev_mode", False),
+        )
+        for room in state.get("_room_list") or []:
+            self.add_room(room)
+        for x in range(self.width):
+            for y in range(self.height):
+                self.tiles[x][y] = state["tiles"][x][y]
+
+    def __getstate__(self) -> dict:
+        self.require()
+        state = self.__dict__.copy()
+        for key in self.TRANSIENT_LIST:
+            state.pop(key, None)
+        # progress, saved on its own, see exploration
+        state.pop("_exploration", None)
+        # a render setting, not part of the map
+        state.pop("_dev_mode", None)
+        return state
+
+    def _init_transient(self):
+        self._room_index = None
+        self._room_list_grid = None
+        self._framebuffer = None
+        self._subscribers = []
+        self._dirty = set()
+        # a new (or just loaded) map counts as changed everywhere
+        self._dirty_all = True
+        # the file of a map opened with open_chunked(), until it is read completely
+        self._chunks = None
+
+    def require(self, xt: int = 0, yt: int = 0, xb: int = None, yb: int = None):
+        """Makes sure the codes of the tiles in [xt, xb) x [yt, yb) are loaded,
+        edges included. Defaults to the full map.
+
+        Only maps opened with open_chunked() load lazily, for any other map
+        this does nothing. The tile views, the mutation methods and the
+        vectorized queries call it themselves, it only needs calling before
+        working on map.codes directly.
+        """
+        chunks = self._chunks
+        if chunks is None:
+            return
+        codes = self._codes
+        chunks.require(
+            (codes.h, codes.v, codes.f),
+            xt,
+            yt,
+            self.width if xb is None else xb,
+            self.height if yb is None else yb,
+        )
+        if chunks.complete:
+            self._chunks = None
+            chunks.close()
+
+    def _load_tile_dicts(self, tiles: list):
+        """Fills the codes and the exploration from tile dicts (see
+        MapTile.dump), as in the JSON layout from before ode.mapjson.
+
+        tiles is stored row by row, so tile (x, y) is tiles[y][x]. Should two
+        neighbours disagree on their shared edge, the tile that comes last
+        (east/south) wins. Unknown styles become NONE/FLOOR, the same as for
+        a MapTile.
+        """
+
+        def style(value, default: str) -> str:
+            if isinstance(value, str):
+                return value
+            if isinstance(value, dict):
+                return value.get("style", default)
+            return default
+
+        def plane(key: str, ids: dict, default: str) -> np.ndarray:
+            return np.array(
+                [
+                    [
+                        ids.get(style(tile.get(key), default), ids[default])
+                        for tile in row
+                    ]
+                    for row in tiles
+                ],
+                dtype=np.uint8,
+            ).T
+
+        codes = self._codes
+        n, e, s, w = (plane(key, EDGE_ID, NONE) for key in ["n", "e", "s", "w"])
+        codes.h[:, :-1] = n
+        codes.h[:, -1] = s[:, -1]
+        codes.v[:-1, :] = w
+        codes.v[-1, :] = e[-1, :]
+        codes.f[...] = plane("f", FLOOR_ID, FLOOR)
+        for key, mark in [
+            ("visited", self._exploration.mark_visited),
+            ("seen", self._exploration.mark_seen),
+        ]:
+            xs, ys = np.nonzero(
+                np.array(
+                    [[bool(tile.get(key, False)) for tile in row] for row in tiles]
+                ).T
+            )
+            mark(xs, ys)
+
+    def _drop_chunks(self):
+        """Forgets the file of the map, for changes that overwrite all codes"""
+        chunks, self._chunks = self._chunks, None
+        if chunks is not None:
+            chunks.close()
+
+    def subscribe(self, callback):
+        """Registers callback(change: MapChange), called after every change of
+        the tiles. Subscriptions are not pickled."""
+        if callback not in self._subscribers:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Removes a callback registered with subscribe()"""
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def _emit(self, change: MapChange):
+        """Records the tiles in change.box as dirty and passes change to the subscribers"""
+        if not self._dirty_all:
+            if change.box == (0, 0, self.width, self.height):
+                self._dirty_all = True
+                self._dirty.clear()
+            else:
+                self._dirty.update(change.tiles)
+        # callbacks may (un)subscribe, fe. by building the room index
+        for callback in tuple(self._subscribers):
+            callback(change)
+
+    def take_dirty(self) -> set:
+        """Returns the (x, y) of the tiles that changed since the previous
+        call, and starts recording anew.
+
+        Returns:
+            set: the changed tiles, or None if the whole map changed (fe. after
+                 randomize() or on a new map)
+        """
+        dirty = None if self._dirty_all else self._dirty
+        self._dirty = set()
+        self._dirty_all = False
+        return dirty
+
+    def _box(self, xt: int, yt: int, xb: int, yb: int) -> tuple:
+        """Clips a box of tiles to the map"""
+        return (max(0, xt), max(0, yt), min(self.width, xb), min(self.height, yb))
+
+    def set_edge(self, x: int, y: int, edge: str, style: str) -> bool:
+        """Sets one edge of tile (x, y)
+
+        Args:
+            x (int): x of the tile
+            y (int): y of the tile
+            edge (str): which edge, either a facing (NORTH, ...) or "n"/"e"/"s"/"w"
+            style (str): one of ode.constants.EDGE_LIST
+
+        Returns:
+            bool: True if the edge changed
+        """
+        if style not in EDGE_ID:
+            raise ValueError(f"Unknown edge style: {style}")
+        edge = getattr(self.tiles[x][y], edge[0])
+        old = edge.code
+        edge.style = style
+        return old != EDGE_ID[style]
+
+    def set_floor(self, x: int, y: int, style: str) -> bool:
+        """Sets the floor of tile (x, y) to style, one of ode.constants.FLOOR_LIST
+
+        Returns:
+            bool: True if the floor changed
+        """
+        if style not in FLOOR_ID:
+            raise ValueError(f"Unknown floor style: {style}")
+        floor = self.tiles[x][y].f
+        old = floor.code
+        floor.style = style
+        return old != FLOOR_ID[style]
+
+    def paste_tile(self, x: int, y: int, tile: MapTile):
+        """Copies edges, floor and state of tile into tile (x, y), same as
+        map.tiles[x][y] = tile. The edges shared with the neighbours change too."""
+        self.tiles[x][y].copy_from(tile)
+
+    def copy_region(self, xt: int, yt: int, xb: int, yb: int) -> "Map":
+        """Returns the tiles in [xt, xb) x [yt, yb) as a new Map, without rooms
+        and exploration state"""
+        xt, yt, xb, yb = self._box(xt, yt, xb, yb)
+        if xt > xb or yt > yb:
+            raise ValueError(f"Empty region: ({xt}, {yt}) - ({xb}, {yb})")
+        self.require(xt, yt, xb, yb)
+        region = Map(xb - xt, yb - yt, dev_mode=self.dev_mode)
+        for dst, src in zip(
+            region._codes.region(0, 0, xb - xt, yb - yt),
+            self._codes.region(xt, yt, xb, yb),
+        ):
+            dst[...] = src
+        return region
+
+    def write_region(self, x: int, y: int, source: "Map"):
+        """Bulk write: pastes all tiles of source with its top left tile at (x, y).
+
+        One vectorized copy and a single CHANGE_REGION event, whatever the size.
+        Like paste_tile(), the outer edges of source replace the edges shared
+        with the tiles around the region. Whatever falls outside the map is
+        clipped off. The exploration state of the map stays as it is.
+        """
+        xt, yt, xb, yb = self._box(x, y, x + source.width, y + source.height)
+        if xt >= xb or yt >= yb:
+            return
+        # the codes around the region have to be there before writing next to them
+        self.require(xt, yt, xb, yb)
+        sx, sy = xt - x, yt - y
+        width, height = xb - xt, yb - yt
+        src, dst = source._codes, self._codes
+        dst.h[xt:xb, yt : yb + 1] = src.h[sx : sx + width, sy : sy + height + 1]
+        dst.v[xt : xb + 1, yt:yb] = src.v[sx : sx + width + 1, sy : sy + height]
+        dst.f[xt:xb, yt:yb] = src.f[sx : sx + width, sy : sy + height]
+        self._emit(MapChange(CHANGE_REGION, self._box(xt - 1, yt - 1, xb + 1, yb + 1)))
+
+    @property
+    def tiles(self) -> MapTiles:
+        """Returns the tiles of the map, indexable as tiles[x][y]"""
+        return MapTiles(self)
+
+    @property
+    def codes(self) -> TileCodes:
+        """The code arrays of the map, for vectorized reads.
+
+        Write through the tile views or the mutation methods instead, so the
+        change gets emitted to the subscribers. For a map opened with
+        open_chunked(), call require() for the region to read first.
+        """
+        return self._codes
+
+    @property
+    def exploration(self) -> Exploration:
+        """Visited/seen state of the tiles.
+
+        Not pickled with the map, save it on its own with exploration.save()
+        and put it back with map.exploration = Exploration.load(filename).
+        """
+        return self._exploration
+
+    @exploration.setter
+    def exploration(self, value: Exploration):
+        if (value.width, value.height) != (self.width, self.height):
+            raise ValueError(
+                f"Exploration of {value.width}x{value.height} does not fit map of {self.width}x{self.height}"
+            )
+        self._exploration = value
 
     @property
     def dev_mode(self) -> bool:
+        """Only a render setting: the default for get_image() and the tile
+        views. It is not saved with the map, so switching it is O(1) and does
+        not touch the map data."""
         return self._dev_mode
-    
+
     @dev_mode.setter
     def dev_mode(self, value: bool):
+        # the tiles are views that pick this up when they get created
         self._dev_mode = value
-        for row in self.tiles:
-            for tile in row:
-                tile.dev_mode = value
+
+    def edge_mask(self, edge: str, flag: int) -> np.ndarray:
+        """Vectorized flag query over one edge of every tile.
+
+        Args:
+            edge (str): which edge, either a facing (NORTH, ...) or "n"/"e"/"s"/"w"
+            flag (int): ode.constants.FLAG_* (or several or-ed together)
+
+        Returns:
+            np.ndarray: bool array of shape (width, height), indexed as [x, y]
+                        fe. edge_mask(EAST, FLAG_PASSABLE) for every passable east edge
+        """
+        self.require()
+        return (EDGE_FLAGS_LUT[getattr(self._codes, edge[0])] & flag) != 0
+
+    def floor_mask(self, flag: int) -> np.ndarray:
+        """Same as edge_mask(), but for the floor of every tile"""
+        self.require()
+        return (FLOOR_FLAGS_LUT[self._codes.f] & flag) != 0
+
+    def tile_keys(
+        self, xt: int = 0, yt: int = 0, xb: int = None, yb: int = None
+    ) -> np.ndarray:
+        """Packs floor and edges of every tile in [xt, xb) x [yt, yb) into one
+        int per tile, see ode.sprites.pack_tile_key(). Defaults to the full map.
+
+        Returns:
+            np.ndarray: int32 array of shape (xb - xt, yb - yt), indexed as [x - xt, y - yt]
+        """
+        self.require(
+            xt, yt, self.width if xb is None else xb, self.height if yb is None else yb
+        )
+        codes = self._codes
+        return pack_tile_key(
+            *(
+                plane[xt:xb, yt:yb].astype(np.int32)
+                for plane in [codes.f, codes.n, codes.e, codes.s, codes.w]
+            )
+        )
+
+    def _json_fields(self) -> list:
+        """Returns the (key, value) fields of the JSON layout (see ode.mapjson),
+        with the rows as generators"""
+        self.require()
+        codes = self._codes
+        return [
+            ("format", mapjson.FORMAT),
+            ("version", mapjson.VERSION),
+            ("width", self.width),
+            ("height", self.height),
+            ("edge_styles", EDGE_LIST),
+            ("floor_styles", FLOOR_LIST),
+            ("h", mapjson.encode_plane(codes.h)),
+            ("v", mapjson.encode_plane(codes.v)),
+            ("f", mapjson.encode_plane(codes.f)),
+            ("rooms", (self._room_json(room) for room in self.room_list)),
+            ("metadata", self.metadata),
+        ]
+
+    @staticmethod
+    def _room_json(room: Room) -> list:
+        """Returns the coordinates of room as a flat [x, y, x, y, ...] list, sorted"""
+        packed = np.sort(
+            np.fromiter(room._cells, dtype=np.int64, count=len(room._cells))
+        )
+        return (
+            np.stack([packed >> PACK_SHIFT, packed & PACK_MASK], axis=1)
+            .ravel()
+            .tolist()
+        )
 
     @property
     def dump(self) -> dict:
-        """Returns a dict representation of the instance"""
+        """Returns a dict representation of the instance, in the JSON layout of ode.mapjson"""
         return {
-            "width": self.width,
-            "height": self.height,
-            "tiles": [
-                [self.tiles[x][y].dump for x in range(self.width)]
-                for y in range(self.height)
-            ],
-            "room_list": [room.dump for room in self._room_list]
+            key: list(value) if hasattr(value, "__next__") else value
+            for key, value in self._json_fields()
         }
 
     def dumps(self, **kwargs) -> str:
-        """Returns a json string representation of the instance
+        """Returns a json string representation of the instance, see dump_json()
         kwargs get passed to the used json.dumps()
         """
-        return json.dumps(self.dump, **kwargs)
+        return "".join(mapjson.iterencode(self._json_fields(), **kwargs))
+
+    def dump_json(self, outfile, **kwargs):
+        """Writes the map as JSON to file object outfile, in the layout of
+        ode.mapjson. Streamed row by row, the map is never a dict as a whole.
+        kwargs get passed to the used json.dumps()
+        """
+        for piece in mapjson.iterencode(self._json_fields(), **kwargs):
+            outfile.write(piece)
 
     @property
     def room_list(self) -> list:
         """Returns a list of Room objects"""
+        if not self._room_list_sorted:
+            self._room_list.sort(key=lambda room: room.sort_key, reverse=True)
+            self._room_list_sorted = True
         return self._room_list
 
     def add_room(self, room: Room):
-        if room not in self._room_list:
+        """Adds room to room_list, unless it is in there already. O(1) amortized,
+        room_list only gets sorted again the next time it is read."""
+        if room not in self._room_set:
+            self._room_set.add(room)
             self._room_list.append(room)
-            self._room_list.sort()
+            self._room_list_sorted = False
+            self._room_list_grid = None
+
+    @property
+    def room_list_grid(self) -> np.ndarray:
+        """Per tile index into room_list, -1 for tiles that are in none of them.
+
+        int32 array of shape (width, height), indexed as [x, y]. Built on first
+        use after room_list changed. Should rooms overlap, the first one wins.
+        """
+        if self._room_list_grid is None:
+            grid = np.full((self.width, self.height), -1, dtype=np.int32)
+            room_list = self.room_list
+            for index in range(len(room_list) - 1, -1, -1):
+                grid[room_list[index].coord_arrays] = index
+            self._room_list_grid = grid
+        return self._room_list_grid
+
+    def room_of(self, coords: tuple) -> Room:
+        """Returns the Room in room_list that contains coords, None if there is none. O(1)"""
+        x, y = coords
+        index = self.room_list_grid[x, y]
+        if index < 0:
+            return None
+        return self.room_list[index]
 
     def get_image(
-        self, xt: int = None, yt: int = None, xb: int = None, yb: int = None
+        self,
+        xt: int = None,
+        yt: int = None,
+        xb: int = None,
+        yb: int = None,
+        dev_mode: bool = None,
     ) -> Image:
+        """Returns an image of the tiles in [xt, xb) x [yt, yb), defaults to the full map.
+
+        Rendering goes through a persistent framebuffer that only repaints the
+        tiles that changed since the previous call. The full map image is that
+        framebuffer itself, so do not modify it.
+
+        dev_mode defaults to the dev_mode of the map. The framebuffer keeps
+        both modes, so switching between them does not repaint anything.
+        """
         if xt:
             xt = max(0, xt)
         else:
@@ -651,30 +1720,52 @@ class Map:
             yb = self.height
         if yt > yb:
             raise ValueError(f"Top Left Y ({yt}) > Bottom Left Y ({yb})")
-        # print(xt, yt, xb, yb)
-        img_size = lambda a, b: (a - b) * TILESIZE
-        tile_mult = lambda a: a * TILESIZE
-        paste_coord = lambda x, y: (tile_mult(x), tile_mult(y))
-        # print(cf(xb, xt))
-        # print(cf(yb, yt))
-        self._image = Image.new("RGB", (img_size(xb, xt), img_size(yb, yt)))
-        for x in range(xt, xb):
-            for y in range(yt, yb):
-                # print(self.tiles[x][y].dump, cc(x, y), ct(y))
-                self._image.paste(self.tiles[x][y].image, paste_coord(x,y), self.tiles[x][y].image)
+        if self._framebuffer is None:
+            self._framebuffer = MapFramebuffer(self)
+        self._image = self._framebuffer.get_image(xt, yt, xb, yb, dev_mode)
         return self._image
 
-    def randomize(self, fix_edges=True):
+    def randomize(
+        self,
+        fix_edges=True,
+        edge_list: list = EDGE_LIST_SIMPLE,
+        floor_list: list = FLOOR_LIST_SIMPLE,
+        floor_random: bool = False,
+        seed: int = None,
+    ):
         """Randomizes the map.
 
+        All edges (and floors) are drawn in one batched call to a NumPy random
+        generator, so this stays fast for very large maps.
+
         Args:
             fix_edges (bool, optional): Set to true to call fix_edges() after randomization. Defaults to True.
+            edge_list (list, optional): List of edges to choose from. Defaults to EDGE_LIST_SIMPLE.
+            floor_list (list, optional): List of floors to choose from. Only used when floor_random==True. Defaults to FLOOR_LIST_SIMPLE.
+            floor_random (bool, optional): Whether or not to randomize the floors. If False, floor=ode.constants.FLOOR. Defaults to False.
+            seed (int, optional): Seed for the generator, for reproducible maps. Defaults to None.
         """
-        self.tiles = [
-            [MapTile().random() for _ in range(self.width)] for _ in range(self.height)
+        rng = np.random.default_rng(seed)
+        self._drop_chunks()
+        codes = self._codes
+        codes.clear()
+        self._exploration.clear()
+        edge_ids = np.array([EDGE_ID[style] for style in edge_list], dtype=np.uint8)
+        drawn = edge_ids[
+            rng.integers(0, len(edge_ids), size=codes.h.size + codes.v.size)
         ]
+        codes.h[...] = drawn[: codes.h.size].reshape(codes.h.shape)
+        codes.v[...] = drawn[codes.h.size :].reshape(codes.v.shape)
+        if floor_random:
+            floor_ids = np.array(
+                [FLOOR_ID[style] for style in floor_list], dtype=np.uint8
+            )
+            codes.f[...] = floor_ids[
+                rng.integers(0, len(floor_ids), size=codes.f.shape)
+            ]
         if fix_edges:
-            self.fix_edges()
+            self._wall_border()
+        self._bulk_changed()
 
     def clear(self, fix_edges=True):
         """Clears the map.
@@ -682,92 +1773,159 @@ class Map:
         Args:
             fix_edges (bool, optional): Set to true to call self.fix_edges() after clearing. Defaults to True.
         """
-        self.tiles = [
-            [MapTile(EMPTY_TILE) for _ in range(self.width)] for _ in range(self.height)
-        ]
+        self._drop_chunks()
+        self._codes.clear()
+        self._exploration.clear()
         if fix_edges:
-            self.fix_edges()
+            self._wall_border()
+        self._bulk_changed()
 
     def fix_edges(self):
-        """Makes sure the edges of the map have walls."""
-        for y in range(self.height):
-            self.tiles[0][y].w.style = WALL
-            self.tiles[-1][y].e.style = WALL
-        for x in range(self.width):
-            self.tiles[x][0].n.style = WALL
-            self.tiles[x][-1].s.style = WALL
+        """Makes sure the edges of the map have walls.
+
+        Only the edges that were no wall yet are written, each with its own
+        CHANGE_EDGE event.
+        """
+        wall = EDGE_ID[WALL]
+        for box in [
+            (0, 0, self.width, 1),
+            (0, self.height - 1, self.width, self.height),
+            (0, 0, 1, self.height),
+            (self.width - 1, 0, self.width, self.height),
+        ]:
+            self.require(*box)
+        h, v = self._codes.h, self._codes.v
+        for key, border, tile in [
+            ("n", h[:, 0], lambda i: (i, 0)),
+            ("s", h[:, -1], lambda i: (i, self.height - 1)),
+            ("w", v[0, :], lambda i: (0, i)),
+            ("e", v[-1, :], lambda i: (self.width - 1, i)),
+        ]:
+            for i in np.flatnonzero(border != wall).tolist():
+                old = int(border[i])
+                border[i] = wall
+                self._edge_changed(key, *tile(i), old, wall)
+
+    def _wall_border(self):
+        """Same as fix_edges(), without events, for changes that emit a
+        CHANGE_REGION of the whole map after"""
+        wall = EDGE_ID[WALL]
+        h, v = self._codes.h, self._codes.v
+        h[:, 0] = h[:, -1] = wall
+        v[0, :] = v[-1, :] = wall
 
     def adjust_surrounding(self, x, y):
-        """Makes the surrounding tiles' edges match the provided tile."""
-        if x - 1 >= 0:
-            self.tiles[x - 1][y].e.style = self.tiles[x][y].w.style
-        if x + 1 < self.width:
-            self.tiles[x + 1][y].w.style = self.tiles[x][y].e.style
-        if y - 1 >= 0:
-            self.tiles[x][y - 1].s.style = self.tiles[x][y].n.style
-        if y + 1 < self.width:
-            self.tiles[x][y + 1].n.style = self.tiles[x][y].s.style
+        """DEPRECATED.
+
+        Used to make the surrounding tiles' edges match the provided tile.
+        Edges are shared between neighbouring tiles now, so they always match.
+        """
+        pass
 
     def coord_in_all_rooms(self, coords: tuple) -> bool:
-        for room in self.all_rooms:
-            if coords in room:
-                return True
-        return False
+        """Returns True if coords is part of any room in room_list. O(1)"""
+        x, y = coords
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return False
+        return bool(self.room_list_grid[x, y] >= 0)
+
+    @property
+    def room_index(self) -> RoomIndex:
+        """Returns the RoomIndex of the map, built on first use and kept up to
+        date on every edge change after that."""
+        if self._room_index is None:
+            self.require()
+            self._room_index = RoomIndex(self._codes)
+            self.subscribe(self._room_index.map_changed)
+        return self._room_index
+
+    def room_id_at(self, x: int, y: int) -> int:
+        """Returns the ID of the room that contains tile (x, y), O(1)"""
+        return self.room_index.room_id(x, y)
+
+    def room_at(self, x: int, y: int) -> Room:
+        """Returns the Room that contains tile (x, y)
+
+        Unlike get_room(..., first=True) this does not add it to room_list."""
+        return self.room_index.room(x, y)
+
+    def _edge_changed(self, key: str, x: int, y: int, old: int, new: int):
+        """Called by the tile views whenever an edge of tile (x, y) changes"""
+        if self._dirty_all and not self._subscribers:
+            # nobody to tell, fe. while loading
+            return
+        dx, dy = EDGE_OFFSETS[key]
+        box = self._box(
+            min(x, x + dx), min(y, y + dy), max(x, x + dx) + 1, max(y, y + dy) + 1
+        )
+        self._emit(MapChange(CHANGE_EDGE, box, x, y, key, old, new))
+
+    def _floor_changed(self, x: int, y: int, old: int, new: int):
+        """Called by the tile views whenever the floor of tile (x, y) changes"""
+        if self._dirty_all and not self._subscribers:
+            return
+        self._emit(MapChange(CHANGE_FLOOR, (x, y, x + 1, y + 1), x, y, None, old, new))
+
+    def _bulk_changed(self):
+        """Called after changes to the whole map that bypass the tile views"""
+        self._emit(MapChange(CHANGE_REGION, (0, 0, self.width, self.height)))
+
+    def label_rooms(self) -> np.ndarray:
+        """Labels every tile with the ID of the room it belongs to.
+
+        Rooms are the connected components of tiles that are not separated
+        by an edge with FLAG_SOLID_ROOM. See label_components().
+
+        Returns:
+            np.ndarray: int32 array of shape (width, height), indexed as [x, y]
+        """
+        self.require()
+        return label_components(self._codes)
 
     def get_rooms_all(self) -> list:
-        """Currently borked, do not use"""
-        self.all_rooms_visisted = [
-            [False for _ in range(self.width)] for _ in range(self.height)
-        ]
-        self.all_rooms = []
-        for x in range(self.width):
-            for y in range(self.width):
-                room = self.get_room((x, y), check_all=True)
-                if len(room) > 0:
-                    self.all_rooms.append(room)
-        # print(len(self.all_rooms))
+        """Finds all rooms of the map in one pass.
+
+        Returns:
+            list: Room objects, where the index in the list is the room ID
+                  used by label_rooms()
+        """
+        labels = self.label_rooms()
+        flat = labels.ravel()
+        order = np.argsort(flat, kind="stable")
+        bounds = (
+            [0] + (np.flatnonzero(np.diff(flat[order])) + 1).tolist() + [len(order)]
+        )
+        # one list of packed coordinates, sliced per room, instead of a tuple per tile
+        cells = pack_coord_arrays(*np.unravel_index(order, labels.shape)).tolist()
+        self.all_rooms = Room.from_packed_runs(cells, bounds)
         return self.all_rooms
 
-    def get_room(self, start: tuple, visited_coords: list = [], first=False) -> list:
-        """Recursive function to find boundaries of a room.
+    def get_room(self, start: tuple, visited_coords: list = None, first=False) -> list:
+        """Finds the boundaries of the room that contains start.
+
+        Looked up in the room index (see room_at()), so no flood fill from
+        scratch.
 
         Args:
             start (tuple): start (x, y) coordinates
-            visited (list of tuples, optional): list to keep track of which tiles have been checked. Defaults to None.
+            visited_coords (list of tuples, optional): list the tiles of the room get added to,
+                                                       if not in there yet. Defaults to None.
+            first (bool, optional): Set to true to add the room to room_list. Defaults to False.
 
         Returns:
             list: (x, y) coordinates as a list
         """
-        x, y = start
-        # if check_all and self.all_rooms_visisted[x][y]:
-        #     return visited
-        # elif start in visited:
-        #     if check_all:
-        #         self.all_rooms_visisted[x][y] = True
-        #     return visited
-        # else:
-        # if check_all:
-        #     self.all_rooms_visisted[x][y] = True
-        visited_coords.append(start)
-        if not (self.tiles[x][y].w.solid_room) and x - 1 >= 0:
-            new_coords = (x - 1, y)
-            if not (new_coords in visited_coords):
-                self.get_room(new_coords, visited_coords=visited_coords)
-        if not (self.tiles[x][y].e.solid_room) and x + 1 < self.height:
-            new_coords = (x + 1, y)
-            if not (new_coords in visited_coords):
-                self.get_room(new_coords, visited_coords=visited_coords)
-        if not (self.tiles[x][y].n.solid_room) and y - 1 >= 0:
-            new_coords = (x, y - 1)
-            if not (new_coords in visited_coords):
-                self.get_room(new_coords, visited_coords=visited_coords)
-        if not (self.tiles[x][y].s.solid_room) and y + 1 < self.height:
-            new_coords = (x, y + 1)
-            if not (new_coords in visited_coords):
-                self.get_room(new_coords, visited_coords=visited_coords)
+        index = self.room_index
+        # every tile with the ID of the room is part of it, in (x, y) order
+        xs, ys = np.nonzero(index.labels == index.room_id(*start))
+        with gc_paused():
+            coords = list(zip(xs.tolist(), ys.tolist()))
+        if visited_coords is not None:
+            known = set(visited_coords)
+            visited_coords.extend(coord for coord in coords if coord not in known)
         if first:
-            self.add_room(Room(visited_coords))
-        return sorted(visited_coords)
+            self.add_room(self.room_at(*start))
+        return coords
 
     # @property
     # def randomtile(self):
@@ -783,24 +1941,208 @@ class Map:
     # def load_tiles(self):
     #     pass
 
+    def _sections(self) -> list:
+        """Returns the map file sections besides the code arrays, see ode.mapfile"""
+        rooms = self._room_list
+        room_table = np.fromiter(
+            chain(
+                [len(rooms)],
+                (len(room._cells) for room in rooms),
+                *(room._cells for room in rooms),
+            ),
+            dtype=np.int64,
+        )
+        meta = {
+            "edge_styles": EDGE_LIST,
+            "floor_styles": FLOOR_LIST,
+            "map": self.metadata,
+        }
+        return [
+            (mapfile.SECTION_ROOMS, room_table),
+            (mapfile.SECTION_META, json.dumps(meta).encode()),
+        ]
+
+    def _load_sections(self, sections: dict) -> tuple:
+        """Reads the rooms and metadata out of map file sections.
+
+        Returns:
+            tuple: (edge_lut, floor_lut), the code translation tables for the
+                   code arrays in the file, None where the codes can stay
+        """
+        meta = {}
+        if mapfile.SECTION_META in sections:
+            meta = json.loads(mapfile.decompress(sections[mapfile.SECTION_META]))
+        self.metadata = meta.get("map", {})
+        if mapfile.SECTION_ROOMS in sections:
+            table = np.frombuffer(
+                mapfile.decompress(sections[mapfile.SECTION_ROOMS]), dtype=np.int64
+            )
+            count = int(table[0])
+            offset = 1 + count
+            for size in table[1 : 1 + count].tolist():
+                self.add_room(Room.from_packed(table[offset : offset + size].tolist()))
+                offset += size
+        # codes refer to the style tables of whoever saved the map
+        edge_lut = floor_lut = None
+        edge_styles = meta.get("edge_styles", EDGE_LIST)
+        if edge_styles != EDGE_LIST:
+            edge_lut = np.array(
+                [EDGE_ID.get(style, EDGE_ID[NONE]) for style in edge_styles],
+                dtype=np.uint8,
+            )
+        floor_styles = meta.get("floor_styles", FLOOR_LIST)
+        if floor_styles != FLOOR_LIST:
+            floor_lut = np.array(
+                [FLOOR_ID.get(style, FLOOR_ID[FLOOR]) for style in floor_styles],
+                dtype=np.uint8,
+            )
+        return (edge_lut, floor_lut)
+
+    def to_bytes(self) -> bytes:
+        """Returns the map in the binary map file format, see ode.mapfile.
+
+        Only the map itself goes in there: no exploration state, dev mode
+        or anything derived from the tiles.
+        """
+        self.require()
+        return mapfile.pack(
+            self.width,
+            self.height,
+            [
+                (mapfile.SECTION_EDGES_H, self._codes.h),
+                (mapfile.SECTION_EDGES_V, self._codes.v),
+                (mapfile.SECTION_FLOORS, self._codes.f),
+            ]
+            + self._sections(),
+        )
+
+    def to_bytes_chunked(self, chunk_size: int = MAP_CHUNK_SIZE) -> bytes:
+        """Returns the map in the chunked layout of the map file format, see
+        ode.mapfile and open_chunked()"""
+        self.require()
+        codes = self._codes
+        return mapfile.pack_chunked(
+            self.width,
+            self.height,
+            (codes.h, codes.v, codes.f),
+            self._sections(),
+            chunk_size,
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Map":
+        """Returns the map stored in data by to_bytes().
+
+        The code arrays get decompressed into place, so this does not build
+        any per tile objects.
+        """
+        _, _, width, height, sections = mapfile.unpack(data)
+        for tag in [
+            mapfile.SECTION_EDGES_H,
+            mapfile.SECTION_EDGES_V,
+            mapfile.SECTION_FLOORS,
+        ]:
+            if tag not in sections:
+                raise ValueError(f"Map file has no {tag.decode()} section")
+        obj = cls(width, height)
+        codes = obj._codes
+        mapfile.decompress_into(sections[mapfile.SECTION_EDGES_H], codes.h)
+        mapfile.decompress_into(sections[mapfile.SECTION_EDGES_V], codes.v)
+        mapfile.decompress_into(sections[mapfile.SECTION_FLOORS], codes.f)
+        edge_lut, floor_lut = obj._load_sections(sections)
+        if edge_lut is not None:
+            codes.h[...] = edge_lut[codes.h]
+            codes.v[...] = edge_lut[codes.v]
+        if floor_lut is not None:
+            codes.f[...] = floor_lut[codes.f]
+        return obj
+
+    @classmethod
+    def open_chunked(cls, filename: str) -> "Map":
+        """Opens a map saved in the chunked layout (see save_chunked()) without
+        reading its tiles.
+
+        The file is memory mapped and the chunks get decoded into the code
+        arrays the first time their tiles are used, see require(). So opening
+        takes the same time for any size, and memory follows the part of the
+        map that has been looked at. The file stays open until every chunk
+        has been read, or until randomize()/clear() replace all tiles.
+        """
+        chunks = mapfile.ChunkedFile(filename)
+        try:
+            obj = cls(
+                chunks.width,
+                chunks.height,
+                codes=TileCodes.empty(chunks.width, chunks.height),
+            )
+            edge_lut, floor_lut = obj._load_sections(chunks.sections)
+        except Exception:
+            chunks.close()
+            raise
+        chunks.luts = [edge_lut, edge_lut, floor_lut]
+        obj._chunks = chunks
+        return obj
+
     @classmethod
     def load_blosc(cls, filename="test.map") -> "Map":
         """Load map object.
 
-        Maps is stored as a blosc compressed pickled Map object"""
+        Maps are stored in the binary map file format (see to_bytes()), large
+        maps in its chunked layout, which opens lazily (see open_chunked()).
+        Maps saved before that are a blosc compressed pickled Map object,
+        which still load."""
         with open(filename, "rb") as infile:
-            obj = pickle.loads(blosc.decompress(infile.read()))
-        return obj
+            data = infile.read(len(mapfile.CHUNK_MAGIC))
+            if mapfile.is_chunked_data(data):
+                return cls.open_chunked(filename)
+            data += infile.read()
+        if mapfile.is_map_data(data):
+            return cls.from_bytes(data)
+        return pickle.loads(blosc.decompress(data))
 
     @classmethod
     def from_json(cls, **kwargs) -> "Map":
-        return cls(**kwargs)
+        """Returns the map of a JSON object, either in the layout of
+        ode.mapjson or in the older one with a dict per tile"""
+        if not mapjson.is_compact(kwargs):
+            return cls(**kwargs)
+        if kwargs["version"] > mapjson.VERSION:
+            raise ValueError(
+                f"JSON map version {kwargs['version']} is newer than supported ({mapjson.VERSION})"
+            )
+        obj = cls(kwargs["width"], kwargs["height"])
+        codes = obj._codes
+        edge_lut = np.array(
+            [EDGE_ID.get(style, EDGE_ID[NONE]) for style in kwargs["edge_styles"]],
+            dtype=np.uint8,
+        )
+        floor_lut = np.array(
+            [FLOOR_ID.get(style, FLOOR_ID[FLOOR]) for style in kwargs["floor_styles"]],
+            dtype=np.uint8,
+        )
+        # codes outside of the style tables raise ValueError in decode_plane()
+        codes.h[...] = edge_lut[
+            mapjson.decode_plane(kwargs["h"], codes.h.shape, len(edge_lut))
+        ]
+        codes.v[...] = edge_lut[
+            mapjson.decode_plane(kwargs["v"], codes.v.shape, len(edge_lut))
+        ]
+        codes.f[...] = floor_lut[
+            mapjson.decode_plane(kwargs["f"], codes.f.shape, len(floor_lut))
+        ]
+        for cells in kwargs.get("rooms", []):
+            cells = np.asarray(cells, dtype=np.int64)
+            obj.add_room(
+                Room.from_packed(((cells[0::2] << PACK_SHIFT) | cells[1::2]).tolist())
+            )
+        obj.metadata = kwargs.get("metadata", {})
+        return obj
 
     @classmethod
     def from_json_file(cls, filename) -> "Map":
         with open(filename) as infile:
             data = json.load(infile)
-        return cls(**data)
+        return cls.from_json(**data)
 
     @classmethod
     def load_blosc_json(cls, filename="test.map") -> "Map":
@@ -825,15 +2167,22 @@ class Map:
     def save_blosc(self, filename="test.map"):
         """Save map object.
 
-        Maps is stored as a blosc compressed pickled Map object"""
-        start = time()
-        print(f"start: {start}")
-        old_dev = self._dev_mode
-        self._dev_mode = False
-        with open(filename, "wb") as outfile:
-            outfile.write(blosc.compress(pickle.dumps(self)))
-        self._dev_mode = old_dev
-        end = time()
-        print(f"end:   {end}")
-        print(f"diff:  {end-start}")
-
+        Maps are stored in the binary map file format, see to_bytes(). Maps
+        of at least MAP_CHUNKED_MIN_TILES tiles are saved chunked instead,
+        see save_chunked()."""
+        if self.width * self.height >= MAP_CHUNKED_MIN_TILES:
+            self.save_chunked(filename)
+            return
+        write_file(filename, self.to_bytes())
+
+    def save_chunked(self, filename="test.map", chunk_size: int = MAP_CHUNK_SIZE):
+        """Save map object in the chunked layout of the map file format, so
+        it can be opened lazily with open_chunked(). Also loads with
+        load_blosc()."""
+        write_file(filename, self.to_bytes_chunked(chunk_size))
+
+    def save_json(self, filename="test.json", **kwargs):
+        """Save map object as JSON, see dump_json(). kwargs get passed to the used json.dumps()"""
+        with open(f"{filename}.tmp", "w") as outfile:
+            self.dump_json(outfile, **kwargs)
+        os.replace(f"{filename}.tmp", filename)
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""Binary map file format
+
+Maps are saved as a small header followed by sections, each compressed on
+its own with blosc, instead of as a pickled object graph:
+
+    header:  magic "ODEM", version (u16), flags (u16), width (u32), height (u32)
+    section: tag (4 bytes), raw size (u64), compressed size (u64), data
+
+All numbers are little endian. Readers skip sections with tags they do not
+know, so newer versions can add sections without breaking older readers.
+The sections of a map (see ode.map.Map.to_bytes()):
+
+    EDGH: h edge codes, uint8 (width, height + 1), see ode.map.TileCodes
+    EDGV: v edge codes, uint8 (width + 1, height)
+    FLOR: floor codes, uint8 (width, height)
+    ROOM: room table, int64: room count, the size of each room, then the
+          packed coordinates (ode.map.pack_coords()) of all rooms
+    META: JSON object with the style tables the codes refer to
+          ("edge_styles", "floor_styles") and the map metadata ("map")
+
+Decompressing goes straight into a preallocated NumPy array with
+decompress_into(), so loading a map does not build any per tile objects.
+
+Large maps use the chunked layout instead, which can be read a piece at a
+time from a memory mapped file (see ChunkedFile):
+
+    header:   magic "ODEC", version (u16), chunk size (u16), width (u32),
+              height (u32), size of the sections (u64)
+    sections: as above, but without EDGH/EDGV/FLOR
+    index:    (chunk count + 1) u64 file offsets, chunk i is the data
+              between offsets i and i + 1
+    chunks:   per chunk the blosc compressed h, v and f codes it owns
+
+Chunk (cx, cy) holds the tiles of chunk_box() and is chunk number
+cx * rows + cy. It owns the north and west edges of its tiles, plus the
+south/east edges on the border of the map, see chunk_slices(). So every
+edge is stored exactly once, and to read the south/east edges of a tile
+the chunk of its neighbour is needed too.
+"""
+
+
+from threading import Lock
+import blosc
+import mmap
+import numpy as np
+import struct
+
+
+MAGIC = b"ODEM"
+VERSION = 1
+HEADER = struct.Struct("<4sHHII")
+SECTION = struct.Struct("<4sQQ")
+
+CHUNK_MAGIC = b"ODEC"
+CHUNK_VERSION = 1
+CHUNK_HEADER = struct.Struct("<4sHHIIQ")
+CHUNK_OFFSETS = struct.Struct("<QQ")
+
+SECTION_EDGES_H = b"EDGH"
+SECTION_EDGES_V = b"EDGV"
+SECTION_FLOORS = b"FLOR"
+SECTION_ROOMS = b"ROOM"
+SECTION_META = b"META"
+
+
+def is_map_data(data: bytes) -> bool:
+    """True if data starts like a map in this format, as opposed to fe. a pickle"""
+    return data[: len(MAGIC)] == MAGIC
+
+
+def is_chunked_data(data: bytes) -> bool:
+    """True if data starts like a map in the chunked layout"""
+    return data[: len(CHUNK_MAGIC)] == CHUNK_MAGIC
+
+
+def pack_sections(sections: list) -> list:
+    """Returns the parts (bytes) of sections, see pack()"""
+    parts = []
+    for tag, data in sections:
+        if isinstance(data, np.ndarray):
+            data = np.ascontiguousarray(data)
+            compressed = blosc.compress(data.tobytes(), typesize=data.itemsize)
+            size = data.nbytes
+        else:
+            compressed = blosc.compress(data, typesize=1)
+            size = len(data)
+        parts.append(SECTION.pack(tag, size, len(compressed)))
+        parts.append(compressed)
+    return parts
+
+
+def unpack_sections(data: bytes, offset: int, end: int) -> dict:
+    """Returns the sections in data[offset:end] as a dict of tag -> (raw
+    size, compressed data)"""
+    sections = {}
+    view = memoryview(data)
+    while offset < end:
+        if offset + SECTION.size > end:
+            raise ValueError("Map file is truncated in a section header")
+        tag, size, compressed_size = SECTION.unpack_from(data, offset)
+        offset += SECTION.size
+        if offset + compressed_size > end:
+            raise ValueError(f"Map file is truncated in section {tag!r}")
+        sections[tag] = (size, view[offset : offset + compressed_size])
+        offset += compressed_size
+    return sections
+
+
+def pack(width: int, height: int, sections: list, flags: int = 0) -> bytes:
+    """Returns the file contents for a map of width x height.
+
+    Args:
+        sections (list): (tag, data) tuples, data being bytes or a NumPy array.
+                         Arrays get compressed with their itemsize as blosc typesize.
+    """
+    return b"".join(
+        [HEADER.pack(MAGIC, VERSION, flags, width, height)] + pack_sections(sections)
+    )
+
+
+def unpack(data: bytes) -> tuple:
+    """Splits file contents made by pack() into its parts.
+
+    Returns:
+        tuple: (version, flags, width, height, sections), sections being a
+               dict of tag -> (raw size, compressed data)
+    """
+    if not is_map_data(data) or len(data) < HEADER.size:
+        raise ValueError("Not a map file")
+    _, version, flags, width, height = HEADER.unpack_from(data)
+    if version > VERSION:
+        raise ValueError(
+            f"Map file version {version} is newer than supported ({VERSION})"
+        )
+    return (
+        version,
+        flags,
+        width,
+        height,
+        unpack_sections(data, HEADER.size, len(data)),
+    )
+
+
+def decompress(section: tuple) -> bytes:
+    """Returns the data of a section as returned by unpack()"""
+    return blosc.decompress(bytes(section[1]))
+
+
+def decompress_into(section: tuple, array: np.ndarray):
+    """Decompresses a section as returned by unpack() into array, which has
+    to be contiguous and exactly as large as the section data."""
+    size, compressed = section
+    if not array.flags.c_contiguous or array.nbytes != size:
+        raise ValueError(
+            f"Section of {size} bytes does not fit array of {array.nbytes} bytes"
+        )
+    blosc.decompress_ptr(bytes(compressed), array.__array_interface__["data"][0])
+
+
+def chunk_grid(width: int, height: int, chunk_size: int) -> tuple:
+    """Returns the number of (columns, rows) of chunks of a map"""
+    return (-(-width // chunk_size), -(-height // chunk_size))
+
+
+def chunk_box(width: int, height: int, chunk_size: int, cx: int, cy: int) -> tuple:
+    """Returns the tiles (xt, yt, xb, yb) of chunk (cx, cy)"""
+    return (
+        cx * chunk_size,
+        cy * chunk_size,
+        min(width, (cx + 1) * chunk_size),
+        min(height, (cy + 1) * chunk_size),
+    )
+
+
+def chunk_slices(width: int, height: int, box: tuple) -> list:
+    """Returns the (x, y) slices of the h, v and f planes that the chunk of
+    box owns, see the module docstring"""
+    xt, yt, xb, yb = box
+    return [
+        (slice(xt, xb), slice(yt, yb + (yb == height))),
+        (slice(xt, xb + (xb == width)), slice(yt, yb)),
+        (slice(xt, xb), slice(yt, yb)),
+    ]
+
+
+def pack_chunked(
+    width: int, height: int, planes: tuple, sections: list, chunk_size: int
+) -> bytes:
+    """Returns the file contents for a map of width x height in the chunked layout.
+
+    Args:
+        planes (tuple): the (h, v, f) code arrays, see ode.map.TileCodes
+        sections (list): (tag, data) tuples of the other sections, see pack()
+        chunk_size (int): number of tiles per side of a chunk
+    """
+    columns, rows = chunk_grid(width, height, chunk_size)
+    section_parts = pack_sections(sections)
+    sections_size = sum(len(part) for part in section_parts)
+    chunks = []
+    for cx in range(columns):
+        for cy in range(rows):
+            slices = chunk_slices(
+                width, height, chunk_box(width, height, chunk_size, cx, cy)
+            )
+            data = b"".join(
+                np.ascontiguousarray(plane[xs, ys]).tobytes()
+                for plane, (xs, ys) in zip(planes, slices)
+            )
+            chunks.append(blosc.compress(data, typesize=1))
+    start = CHUNK_HEADER.size + sections_size + 8 * (len(chunks) + 1)
+    offsets = np.cumsum([start] + [len(chunk) for chunk in chunks], dtype=np.uint64)
+    header = CHUNK_HEADER.pack(
+        CHUNK_MAGIC, CHUNK_VERSION, chunk_size, width, height, sections_size
+    )
+    return b"".join(
+        [header] + section_parts + [offsets.astype("<u8").tobytes()] + chunks
+    )
+
+
+class ChunkedFile:
+    """Map file in the chunked layout, read lazily through a memory map.
+
+    Opening only reads the header and the (small) sections. require()
+    decodes the chunks of a region straight into the code arrays of a map,
+    the first time the region is asked for. Safe to use from several threads.
+
+    Args:
+        filename (str): the file, see pack_chunked()
+    """
+
+    def __init__(self, filename: str):
+        self._file = open(filename, "rb")
+        try:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file can not be mapped
+            self._file.close()
+            raise ValueError("Not a chunked map file")
+        try:
+            self._read_header()
+        except Exception:
+            self.close()
+            raise
+        # per plane (h, v, f): code in the file -> code to store, None to keep them
+        self.luts = [None, None, None]
+        self.loaded = np.zeros((self.columns, self.rows), dtype=bool)
+        self.missing = self.columns * self.rows
+        self._lock = Lock()
+
+    def _read_header(self):
+        data = self._data
+        if not is_chunked_data(data) or len(data) < CHUNK_HEADER.size:
+            raise ValueError("Not a chunked map file")
+        _, self.version, self.chunk_size, self.width, self.height, sections_size = (
+            CHUNK_HEADER.unpack_from(data)
+        )
+        if self.version > CHUNK_VERSION:
+            raise ValueError(
+                f"Map file version {self.version} is newer than supported ({CHUNK_VERSION})"
+            )
+        if self.chunk_size == 0:
+            raise ValueError("Chunked map file has a chunk size of 0")
+        self.columns, self.rows = chunk_grid(self.width, self.height, self.chunk_size)
+        self._index = CHUNK_HEADER.size + sections_size
+        if self._index + 8 * (self.columns * self.rows + 1) > len(data):
+            raise ValueError("Map file is truncated in the chunk index")
+        # a copy, so the memory map can be closed while the sections are in use
+        sections = data[CHUNK_HEADER.size : self._index]
+        self.sections = unpack_sections(sections, 0, len(sections))
+
+    @property
+    def complete(self) -> bool:
+        """True once every chunk has been decoded"""
+        return self.missing == 0
+
+    def close(self):
+        self._data.close()
+        self._file.close()
+
+    def chunk_range(self, xt: int, yt: int, xb: int, yb: int) -> tuple:
+        """Returns the (columns, rows) ranges of the chunks that hold the tiles
+        in [xt, xb) x [yt, yb) and all their edges"""
+        xt, yt = max(0, xt), max(0, yt)
+        xb, yb = min(self.width, xb), min(self.height, yb)
+        if xt >= xb or yt >= yb:
+            return (range(0), range(0))
+        # the south/east edges of the last tiles are owned by the next chunk over
+        return (
+            range(
+                xt // self.chunk_size, min(xb, self.width - 1) // self.chunk_size + 1
+            ),
+            range(
+                yt // self.chunk_size, min(yb, self.height - 1) // self.chunk_size + 1
+            ),
+        )
+
+    def require(self, planes: tuple, xt: int, yt: int, xb: int, yb: int) -> int:
+        """Decodes the chunks of the tiles in [xt, xb) x [yt, yb) into planes
+        (h, v, f), except the ones that were decoded before.
+
+        Returns:
+            int: the number of chunks that got decoded
+        """
+        columns, rows = self.chunk_range(xt, yt, xb, yb)
+        if not len(columns) or not len(rows):
+            return 0
+        window = (slice(columns.start, columns.stop), slice(rows.start, rows.stop))
+        if self.loaded[window].all():
+            return 0
+        with self._lock:
+            todo = np.argwhere(~self.loaded[window])
+            for cx, cy in (todo + (columns.start, rows.start)).tolist():
+                self._decode(planes, cx, cy)
+                self.loaded[cx, cy] = True
+            self.missing -= len(todo)
+        return len(todo)
+
+    def _decode(self, planes: tuple, cx: int, cy: int):
+        start, end = CHUNK_OFFSETS.unpack_from(
+            self._data, self._index + 8 * (cx * self.rows + cy)
+        )
+        data = blosc.decompress(self._data[start:end])
+        box = chunk_box(self.width, self.height, self.chunk_size, cx, cy)
+        offset = 0
+        for plane, (xs, ys), lut in zip(
+            planes, chunk_slices(self.width, self.height, box), self.luts
+        ):
+            shape = (xs.stop - xs.start, ys.stop - ys.start)
+            codes = np.frombuffer(
+                data, dtype=np.uint8, count=shape[0] * shape[1], offset=offset
+            ).reshape(shape)
+            plane[xs, ys] = codes if lut is None else lut[codes]
+            offset += codes.size
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""JSON map format
+
+The JSON layout of a map stores the code arrays (see ode.map.TileCodes) as
+run-length encoded rows, with the style names in a table up front instead
+of in every tile:
+
+    {
+        "format": "ode_map",
+        "version": 2,
+        "width": 20,
+        "height": 20,
+        "edge_styles": ["none", "wall", ...],
+        "floor_styles": ["floor", "pit", ...],
+        "h": [[20, 1], [3, 1, 1, 2, 16, 0], ...],
+        "v": [...],
+        "f": [...],
+        "rooms": [[x, y, x, y, ...], ...],
+        "metadata": {}
+    }
+
+h, v and f hold one row per y (height + 1 rows for h), every row being a
+flat list of (run length, code) pairs that add up to the width of the plane
+(width + 1 for v). The codes index edge_styles (h and v) or floor_styles
+(f). rooms has the coordinates of every room as a flat list.
+
+Version 1 is the layout from before this one, which has a dict per tile
+(see ode.map.MapTile.dump) and no "format" key. It still loads, see
+ode.map.Map.from_json().
+"""
+
+
+import json
+import numpy as np
+
+
+FORMAT = "ode_map"
+VERSION = 2
+
+
+def is_compact(data: dict) -> bool:
+    """True if data is a map in this layout, False for the version 1 layout"""
+    return data.get("format") == FORMAT
+
+
+def encode_row(row: np.ndarray) -> list:
+    """Returns row as a flat list of (run length, value) pairs"""
+    if len(row) == 0:
+        return []
+    starts = np.concatenate([[0], np.flatnonzero(row[1:] != row[:-1]) + 1])
+    runs = np.diff(np.append(starts, len(row)))
+    pairs = np.empty(2 * len(starts), dtype=np.int64)
+    pairs[0::2] = runs
+    pairs[1::2] = row[starts]
+    return pairs.tolist()
+
+
+def encode_plane(plane: np.ndarray):
+    """Generator over the rows (fixed y) of plane, indexed as [x, y], encoded with encode_row()"""
+    for y in range(plane.shape[1]):
+        yield encode_row(plane[:, y])
+
+
+def decode_plane(rows: list, shape: tuple, count: int = 256) -> np.ndarray:
+    """Returns the uint8 plane of shape (width, height), indexed as [x, y],
+    from the rows made by encode_plane()
+
+    Args:
+        count (int, optional): number of codes, fe. the length of the style
+                               table. Other values raise ValueError instead
+                               of wrapping around in the uint8 plane.
+                               Defaults to 256.
+    """
+    width, height = shape
+    if len(rows) != height:
+        raise ValueError(f"Expected {height} rows, got {len(rows)}")
+    count = min(count, 256)
+    plane = np.empty((height, width), dtype=np.uint8)
+    for y, row in enumerate(rows):
+        pairs = np.asarray(row, dtype=np.int64).reshape(-1, 2)
+        if pairs[:, 0].sum() != width or (pairs[:, 0] < 0).any():
+            raise ValueError(f"Row {y} does not add up to {width}")
+        if ((pairs[:, 1] < 0) | (pairs[:, 1] >= count)).any():
+            raise ValueError(f"Row {y} has codes outside of [0, {count})")
+        plane[y] = np.repeat(pairs[:, 1], pairs[:, 0])
+    return plane.T
+
+
+def iterencode(fields: list, **kwargs):
+    """Generator over the JSON text of an object with fields, piece by piece.
+
+    Args:
+        fields (list): (key, value) tuples in order. A value that is a
+                       generator is written as a list, one item per line,
+                       without building that list first.
+        kwargs: passed to json.dumps() for every key and value
+    """
+    _, key_separator = kwargs.get("separators", (", ", ": "))
+    yield "{"
+    for index, (key, value) in enumerate(fields):
+        yield f"{',' if index else ''}\n{json.dumps(key, **kwargs)}{key_separator}"
+        if not hasattr(value, "__next__"):
+            yield json.dumps(value, **kwargs)
+            continue
+        yield "["
+        for item_index, item in enumerate(value):
+            yield f"{',' if item_index else ''}\n{json.dumps(item, **kwargs)}"
+        yield "\n]"
+    yield "\n}"
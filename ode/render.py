@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+"""Map rendering
+
+The idea of this module is to keep the rendering of maps out of ode.map, and
+to make it incremental: a MapFramebuffer holds one persistent bitmap of the
+whole map and only repaints the tiles that changed since the last render.
+
+A MapFramebuffer subscribes to the changes of its Map (see Map.subscribe()),
+so normally the only thing to call is Map.get_image().
+
+Full repaints go through rasterize(), which builds the pixels of a whole map
+with one NumPy gather over the tile atlas instead of pasting tile by tile.
+
+For maps that are too large to show at once, there is the TilePyramid: zoom
+levels of the map, rendered chunk by chunk only when they are needed.
+"""
+
+
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Condition, Lock, Thread, get_ident
+from ode.constants import *
+from ode.sprites import (
+    ATLAS,
+    MAP_ATLASES,
+    MapSprites,
+    CORNER_NW,
+    CORNER_NE,
+    CORNER_SE,
+    CORNER_SW,
+)
+from PIL import Image
+import blosc
+import numpy as np
+import os
+
+
+# upper bound for the number of tile pixel rows per band in gather_tiles()
+RASTER_BAND_LINES = 1 << 22
+
+# edge codes that get drawn by MapSprites, without and with dev_mode
+EDGE_VISIBLE_LUT = np.array(
+    [
+        [
+            bool(EDGE_FLAGS[EDGE_ID[style]] & flag) and style in MapSprites.EDGE_STYLES
+            for style in EDGE_LIST
+        ]
+        for flag in [FLAG_VISIBLE, FLAG_VISIBLE_DEV]
+    ]
+)
+
+
+def gather_tiles(rows: np.ndarray, tiles: np.ndarray) -> np.ndarray:
+    """Builds an image out of atlas tiles without a Python loop over the tiles.
+
+    Every pixel row of every tile is gathered from the atlas with one
+    np.take() per band of tile rows.
+
+    Args:
+        rows (np.ndarray): atlas row of every tile, shape (width, height), indexed as [x, y]
+        tiles (np.ndarray): the atlas, shape (count, tilesize, tilesize, 3)
+
+    Returns:
+        np.ndarray: uint8 RGB array of shape (height * tilesize, width * tilesize, 3)
+    """
+    tilesize = tiles.shape[1]
+    rows = rows.T
+    height, width = rows.shape
+    result = np.empty((height * tilesize, width * tilesize, 3), dtype=np.uint8)
+    # one pixel row of a tile as a single item, so np.take copies whole rows
+    line = np.dtype((np.void, tilesize * 3))
+    atlas_lines = (
+        np.ascontiguousarray(tiles).reshape(-1, tilesize * 3).view(line).ravel()
+    )
+    result_lines = result.reshape(-1, tilesize * 3).view(line).ravel()
+    band = max(1, RASTER_BAND_LINES // max(1, width * tilesize))
+    for y0 in range(0, height, band):
+        y1 = min(height, y0 + band)
+        # atlas line of pixel row py of tile (x, y), ordered as (y, py, x)
+        index = rows[y0:y1, None, :] * tilesize + np.arange(tilesize)[None, :, None]
+        np.take(
+            atlas_lines,
+            index.ravel(),
+            out=result_lines[y0 * tilesize * width : y1 * tilesize * width],
+        )
+    return result
+
+
+def rasterize(
+    map, xt: int = 0, yt: int = 0, xb: int = None, yb: int = None, dev_mode: bool = None
+) -> np.ndarray:
+    """Renders the tiles in [xt, xb) x [yt, yb) of map, defaults to the full map.
+
+    The tile keys of the map are looked up in the atlas and the atlas tiles
+    are put together with gather_tiles().
+
+    Args:
+        map (Map): the map to render
+        dev_mode (bool, optional): render as dev mode or not. Defaults to map.dev_mode.
+
+    Returns:
+        np.ndarray: uint8 RGB array of shape ((yb - yt) * TILESIZE, (xb - xt) * TILESIZE, 3),
+                    use Image.fromarray() to turn it into an image
+    """
+    if dev_mode is None:
+        dev_mode = map.dev_mode
+    return gather_tiles(*ATLAS.rows(map.tile_keys(xt, yt, xb, yb), dev_mode))
+
+
+def _window(mask: np.ndarray, x0: int, x1: int, y0: int, y1: int) -> np.ndarray:
+    """Returns mask[x0:x1, y0:y1], where everything outside of mask is False"""
+    result = np.zeros((x1 - x0, y1 - y0), dtype=bool)
+    xa, ya = max(0, x0), max(0, y0)
+    xb, yb = min(mask.shape[0], x1), min(mask.shape[1], y1)
+    if xa < xb and ya < yb:
+        result[xa - x0 : xb - x0, ya - y0 : yb - y0] = mask[xa:xb, ya:yb]
+    return result
+
+
+def map_sprite_keys(
+    map, xt: int, yt: int, xb: int, yb: int, dev_mode: bool = False
+) -> np.ndarray:
+    """Returns the map sprite key (see ode.sprites.MapSprites) of every tile
+    in [xt, xb) x [yt, yb), as an int32 array indexed as [x - xt, y - yt]"""
+    # visible edges meeting in the grid points (xt .. xb, yt .. yb),
+    # where point (x, y) is the north west corner of tile (x, y). h edges
+    # come into a point from the west and east, v edges from north and south
+    lut = EDGE_VISIBLE_LUT[int(dev_mode)]
+    map.require(xt - 1, yt - 1, xb + 1, yb + 1)
+    hx, vy = max(0, xt - 1), max(0, yt - 1)
+    h = lut[map.codes.h[hx : xb + 1, yt : yb + 1]]
+    v = lut[map.codes.v[xt : xb + 1, vy : yb + 1]]
+    width, height = xb - xt + 1, yb - yt + 1
+    points = (
+        _window(h, xt - 1 - hx, xt - 1 - hx + width, 0, height)
+        | _window(h, xt - hx, xt - hx + width, 0, height)
+        | _window(v, 0, width, yt - 1 - vy, yt - 1 - vy + height)
+        | _window(v, 0, width, yt - vy, yt - vy + height)
+    )
+    corners = (
+        points[:-1, :-1] * CORNER_NW
+        + points[1:, :-1] * CORNER_NE
+        + points[1:, 1:] * CORNER_SE
+        + points[:-1, 1:] * CORNER_SW
+    )
+    return map.tile_keys(xt, yt, xb, yb) * 16 + corners
+
+
+class TilePyramid:
+    """Pre-rendered zoom levels of a map, split up in chunks.
+
+    Every level is identified by its tile size in pixels, see LEVELS. The
+    levels with a map_NxN sprite set are rendered from those, the smaller
+    ones from downsampled map_16x16 tiles (see ode.sprites.MapSprites), so
+    any chunk on any level is one gather_tiles() call. A chunk is
+    CHUNK_SIZE x CHUNK_SIZE pixels (less at the right and bottom of the map),
+    so a viewport only ever needs the few chunks it overlaps, at any level.
+
+    Chunks are kept in a LRU in memory and as files in cache_dir: the RGB
+    pixels, compressed with blosc (zstd), some 5 to 40 KB per chunk. The
+    files are named after a hash of the map sprite keys they were rendered
+    from, so they are valid for any map. They are in a directory per level
+    named after CACHE_VERSION and a hash of the sprites of the level (see
+    MapSprites.digest()), so changed sprites or a new rendering never pick
+    up stale chunks. Set cache_dir to None to not use the files. Chunks in
+    memory are dropped when their tiles change.
+    """
+
+    LEVELS = tuple(sorted(MAP_ATLASES, reverse=True))
+    # divisible by every level
+    CHUNK_SIZE = 384
+    # bump when the chunk files or the way chunks get rendered change
+    CACHE_VERSION = 2
+
+    def __init__(self, map, cache_dir: str = PATH_CACHE_PYRAMID, maxsize: int = 256):
+        self.map = map
+        self.cache_dir = cache_dir
+        self.maxsize = maxsize
+        self._chunks = OrderedDict()
+        # cache directory per level, see level_dir()
+        self._level_dirs = {}
+        self._lock = Lock()
+        # bumped on every change, so renders that started before it are not cached
+        self._generation = 0
+        map.subscribe(self.map_changed)
+
+    def close(self):
+        """Stops following the changes of the map"""
+        self.map.unsubscribe(self.map_changed)
+
+    def level_dir(self, level: int) -> str:
+        """Returns the directory in cache_dir with the chunk files of level"""
+        if level not in self._level_dirs:
+            digest = sha1(
+                f"{self.CACHE_VERSION}_{MapSprites(level).digest()}".encode()
+            ).hexdigest()[:16]
+            self._level_dirs[level] = f"{self.cache_dir}{level}_{digest}/"
+        return self._level_dirs[level]
+
+    def chunk_tiles(self, level: int) -> int:
+        """Returns the number of tiles per side of a chunk on level"""
+        return self.CHUNK_SIZE // level
+
+    def size(self, level: int) -> tuple:
+        """Returns the size of the whole map on level, in pixels"""
+        return (self.map.width * level, self.map.height * level)
+
+    def chunk_box(self, level: int, cx: int, cy: int) -> tuple:
+        """Returns the tiles (xt, yt, xb, yb) of chunk (cx, cy) on level"""
+        tiles = self.chunk_tiles(level)
+        return (
+            cx * tiles,
+            cy * tiles,
+            min(self.map.width, (cx + 1) * tiles),
+            min(self.map.height, (cy + 1) * tiles),
+        )
+
+    def visible_chunks(self, level: int, x0: int, y0: int, x1: int, y1: int) -> list:
+        """Returns the (cx, cy) of the chunks on level that overlap the pixels
+        [x0, x1) x [y0, y1) of the map. The image of chunk (cx, cy) goes at
+        pixel (cx * CHUNK_SIZE, cy * CHUNK_SIZE)."""
+        width, height = self.size(level)
+        x0, y0 = max(0, x0), max(0, y0)
+        x1, y1 = min(width, x1), min(height, y1)
+        return [
+            (cx, cy)
+            for cy in range(y0 // self.CHUNK_SIZE, (y1 - 1) // self.CHUNK_SIZE + 1)
+            for cx in range(x0 // self.CHUNK_SIZE, (x1 - 1) // self.CHUNK_SIZE + 1)
+            if x0 < x1 and y0 < y1
+        ]
+
+    def chunk(self, level: int, cx: int, cy: int) -> Image:
+        """Returns the image of chunk (cx, cy) on level, do not modify it.
+
+        Safe to call from another thread than the one changing the map.
+        """
+        key = (level, cx, cy, self.map.dev_mode)
+        with self._lock:
+            image = self._chunks.get(key)
+            if image is not None:
+                self._chunks.move_to_end(key)
+                return image
+            generation = self._generation
+        xt, yt, xb, yb = self.chunk_box(level, cx, cy)
+        keys = map_sprite_keys(self.map, xt, yt, xb, yb, self.map.dev_mode)
+        filename = None
+        pixels = None
+        if self.cache_dir is not None:
+            digest = sha1(np.ascontiguousarray(keys)).hexdigest()
+            filename = f"{self.level_dir(level)}{keys.shape[0]}x{keys.shape[1]}_{int(self.map.dev_mode)}_{digest}.blosc"
+            pixels = self._load(
+                filename, (keys.shape[1] * level, keys.shape[0] * level, 3)
+            )
+        if pixels is None:
+            pixels = self._render(level, keys)
+            if filename is not None:
+                self._save(filename, pixels)
+        image = Image.fromarray(pixels)
+        with self._lock:
+            # the map changed while rendering, the chunk may be stale already
+            if generation == self._generation:
+                self._chunks[key] = image
+                if len(self._chunks) > self.maxsize:
+                    self._chunks.popitem(last=False)
+        return image
+
+    @staticmethod
+    def _load(filename: str, shape: tuple) -> np.ndarray:
+        """Returns the pixels in chunk file filename, None if there is no
+        such file or it does not hold shape pixels"""
+        try:
+            with open(filename, "rb") as infile:
+                data = blosc.decompress(infile.read())
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # a damaged file gets rendered and written again
+            return None
+        if len(data) != np.prod(shape):
+            return None
+        return np.frombuffer(data, dtype=np.uint8).reshape(shape)
+
+    @staticmethod
+    def _save(filename: str, pixels: np.ndarray):
+        """Writes chunk file filename through a temporary file of this
+        thread, so other threads never read half a chunk"""
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        temporary = f"{filename}.{get_ident()}.tmp"
+        with open(temporary, "wb") as outfile:
+            outfile.write(
+                blosc.compress(pixels.tobytes(), typesize=1, cname="zstd", clevel=3)
+            )
+        os.replace(temporary, filename)
+
+    def _render(self, level: int, keys: np.ndarray) -> np.ndarray:
+        return gather_tiles(*MAP_ATLASES[level].rows(keys, self.map.dev_mode))
+
+    def map_changed(self, change):
+        """Map.subscribe() callback, drops the chunks of the changed tiles"""
+        # corners reach one tile into the neighbours
+        xt, yt, xb, yb = change.box
+        xt, yt, xb, yb = xt - 1, yt - 1, xb + 1, yb + 1
+        with self._lock:
+            self._generation += 1
+            for key in list(self._chunks):
+                level, cx, cy, _ = key
+                tiles = self.chunk_tiles(level)
+                if (
+                    cx * tiles < xb
+                    and (cx + 1) * tiles > xt
+                    and cy * tiles < yb
+                    and (cy + 1) * tiles > yt
+                ):
+                    del self._chunks[key]
+
+    def clear(self):
+        """Drops the chunks in memory, the files in cache_dir stay"""
+        with self._lock:
+            self._generation += 1
+            self._chunks.clear()
+
+
+class FrameRenderer:
+    """Renders views of a TilePyramid on a worker thread.
+
+    request() asks for a frame, a view of width x height pixels with its top
+    left at map pixel (x, y) of level. Requests that were not started yet
+    get replaced by newer ones, so the worker never falls behind. Finished
+    frames are picked up with latest(), which never blocks. That keeps the
+    (Tk) thread that asks for the frames responsive, however long rendering
+    the chunks takes.
+    """
+
+    def __init__(self, pyramid: TilePyramid):
+        self.pyramid = pyramid
+        self._condition = Condition()
+        self._request = None
+        self._frame = None
+        self._closed = False
+        self._thread = Thread(target=self._run, name="FrameRenderer", daemon=True)
+        self._thread.start()
+
+    def request(self, level: int, x: int, y: int, width: int, height: int):
+        """Asks for a frame, replaces the previous request if it was not started yet"""
+        with self._condition:
+            self._request = (level, x, y, width, height)
+            self._condition.notify()
+
+    def latest(self) -> tuple:
+        """Returns the newest finished frame as (request, image), None if
+        there is no new frame since the previous call. request is the tuple
+        of arguments that was passed to request()."""
+        with self._condition:
+            frame, self._frame = self._frame, None
+        return frame
+
+    def close(self):
+        """Stops the worker thread"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def render(self, level: int, x: int, y: int, width: int, height: int) -> Image:
+        """Composites one frame out of the chunks it overlaps, on the calling thread"""
+        frame = Image.new("RGB", (width, height))
+        for cx, cy in self.pyramid.visible_chunks(level, x, y, x + width, y + height):
+            frame.paste(
+                self.pyramid.chunk(level, cx, cy),
+                (cx * self.pyramid.CHUNK_SIZE - x, cy * self.pyramid.CHUNK_SIZE - y),
+            )
+        return frame
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._request is None and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                request, self._request = self._request, None
+            frame = self.render(*request)
+            with self._condition:
+                self._frame = (request, frame)
+
+
+class MapFramebuffer:
+    """Persistent full-map bitmap that only repaints dirty tiles.
+
+    Dev mode is a layer on top of the same map data, so there is a bitmap
+    per mode, each built on first use and kept up to date on its own.
+    Switching between the two costs nothing after that.
+    """
+
+    def __init__(self, map):
+        self._map = map
+        # per dev_mode: image, dirty tiles and whether all of it is dirty
+        self._images = [None, None]
+        self._dirty = [set(), set()]
+        self._all_dirty = [True, True]
+        map.subscribe(self.map_changed)
+
+    @property
+    def size(self) -> tuple:
+        return (self._map.width * TILESIZE, self._map.height * TILESIZE)
+
+    def mark_dirty(self, x: int, y: int):
+        """Marks tile (x, y) for repainting on the next update()"""
+        for mode in (0, 1):
+            if not self._all_dirty[mode]:
+                self._dirty[mode].add((x, y))
+
+    def mark_all_dirty(self, mode: int = None):
+        """Marks the whole map for repainting, fe. after a bulk change.
+        Both modes, unless mode (int(dev_mode)) is provided."""
+        for mode in (0, 1) if mode is None else (mode,):
+            self._all_dirty[mode] = True
+            self._dirty[mode].clear()
+
+    def map_changed(self, change):
+        """Map.subscribe() callback, marks the tiles of change dirty"""
+        xt, yt, xb, yb = change.box
+        if (xb - xt) * (yb - yt) * 4 > self._map.width * self._map.height:
+            # repainting everything is about as cheap by now
+            self.mark_all_dirty()
+            return
+        for mode in (0, 1):
+            if not self._all_dirty[mode]:
+                self._dirty[mode].update(change.tiles)
+
+    def update(self, dev_mode: bool = None) -> int:
+        """Repaints the dirty tiles of the bitmap for dev_mode, which defaults
+        to the dev_mode of the map.
+
+        Returns:
+            int: number of tiles that were repainted
+        """
+        if dev_mode is None:
+            dev_mode = self._map.dev_mode
+        mode = int(dev_mode)
+        image = self._images[mode]
+        if image is None or image.size != self.size:
+            self.mark_all_dirty(mode)
+        if self._all_dirty[mode]:
+            self._images[mode] = Image.fromarray(
+                rasterize(self._map, dev_mode=dev_mode)
+            )
+            count = self._map.width * self._map.height
+        else:
+            count = len(self._dirty[mode])
+            for x, y in self._dirty[mode]:
+                key = int(self._map.tile_keys(x, y, x + 1, y + 1)[0, 0])
+                image.paste(ATLAS.image(key, dev_mode), (x * TILESIZE, y * TILESIZE))
+        self._dirty[mode] = set()
+        self._all_dirty[mode] = False
+        return count
+
+    def get_image(
+        self, xt: int, yt: int, xb: int, yb: int, dev_mode: bool = None
+    ) -> Image:
+        """Returns the tiles in [xt, xb) x [yt, yb) as an image, in dev_mode
+        (defaults to the dev_mode of the map).
+
+        The full map is returned as the framebuffer itself, do not modify it.
+        Any other window is cropped out of it.
+        """
+        if dev_mode is None:
+            dev_mode = self._map.dev_mode
+        self.update(dev_mode)
+        image = self._images[int(dev_mode)]
+        if (xt, yt, xb, yb) == (0, 0, self._map.width, self._map.height):
+            return image
+        return image.crop((xt * TILESIZE, yt * TILESIZE, xb * TILESIZE, yb * TILESIZE))
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""Sprite cache for the map tiles
+
+Loads every edge and floor sprite from disk only once, with the edge sprites
+rotated for each side of the tile in advance. Composited tiles are memoized
+by (floor, n, e, s, w, dev_mode) with LRU eviction, so rendering a map does
+no disk I/O after warm-up.
+
+Use the shared instance SPRITES instead of constructing your own.
+
+For rendering whole maps there is the TileAtlas (shared instance ATLAS): the
+same composited tiles, flattened onto black and stacked into one NumPy array,
+so a renderer can gather every tile of a map in one go. Tiles are identified
+by a single int there, see pack_tile_key(). MAP_ATLASES does the same for the
+map_NxN sprite sets, see MapSprites.
+
+NOTE: the returned images are shared, do not modify them. Use .copy() when
+you need to.
+"""
+
+
+from collections import OrderedDict
+from hashlib import sha1
+from ode.constants import *
+from PIL import Image
+from threading import Lock
+import glob
+import numpy as np
+import os
+
+
+# rotation and paste position of the edge sprite for each side of a tile
+EDGE_SIDES = {
+    "n": (None, (0, 0)),
+    "e": (Image.ROTATE_270, (TILESIZE - 2, 0)),
+    "s": (Image.ROTATE_180, (0, TILESIZE - 2)),
+    "w": (Image.ROTATE_90, (0, 0)),
+}
+
+
+class SpriteCache:
+    """Cache for edge/floor sprites and the tiles composited from them."""
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._edges = {}
+        self._floors = {}
+        self._tiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _load(filename: str) -> Image:
+        with Image.open(filename) as image:
+            return image.convert("RGBA")
+
+    def edge(self, style: str, side: str, dev_mode: bool = False) -> Image:
+        """Returns the sprite for an edge, already rotated for side (n/e/s/w)"""
+        if style == SEPA_INV and not dev_mode:
+            # invisible separators are only drawn in dev mode
+            style = NONE
+        key = (style, side)
+        if key not in self._edges:
+            image = self._load(f"{PATH_IMAGES_EDGE}{style}.png")
+            rotation, _ = EDGE_SIDES[side]
+            if rotation is not None:
+                image = image.transpose(rotation)
+            self._edges[key] = image
+        return self._edges[key]
+
+    def floor(self, style: str) -> Image:
+        """Returns the sprite for a floor"""
+        if style not in self._floors:
+            self._floors[style] = self._load(f"{PATH_IMAGES_FLOOR}{style}.png")
+        return self._floors[style]
+
+    def tile(self, f: str, n: str, e: str, s: str, w: str, dev_mode: bool = False) -> Image:
+        """Returns the composited image of a tile with the provided styles"""
+        key = (f, n, e, s, w, dev_mode)
+        image = self._tiles.get(key)
+        if image is not None:
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return image
+        self.misses += 1
+        image = self.floor(f).copy()
+        for side, style in zip(["n", "e", "s", "w"], [n, e, s, w]):
+            paste = self.edge(style, side, dev_mode)
+            image.paste(paste, EDGE_SIDES[side][1], paste)
+        self._tiles[key] = image
+        if len(self._tiles) > self.maxsize:
+            self._tiles.popitem(last=False)
+        return image
+
+    def clear(self):
+        """Drops all cached sprites and tiles, fe. after the sprites changed on disk"""
+        self._edges.clear()
+        self._floors.clear()
+        self._tiles.clear()
+
+
+"""Shared instance of SpriteCache"""
+SPRITES = SpriteCache()
+
+
+# number of distinct tile keys, see pack_tile_key()
+TILE_KEY_COUNT = len(FLOOR_LIST) * len(EDGE_LIST) ** 4
+
+
+def pack_tile_key(f, n, e, s, w):
+    """Packs the floor and edge codes of a tile into one int in [0, TILE_KEY_COUNT)
+
+    Works on ints as well as on whole NumPy code arrays at once.
+    """
+    edges = len(EDGE_LIST)
+    return (((f * edges + n) * edges + e) * edges + s) * edges + w
+
+
+def unpack_tile_key(key: int) -> tuple:
+    """Returns the codes (f, n, e, s, w) packed into key by pack_tile_key()"""
+    edges = len(EDGE_LIST)
+    key, w = divmod(key, edges)
+    key, s = divmod(key, edges)
+    key, e = divmod(key, edges)
+    f, n = divmod(key, edges)
+    return (f, n, e, s, w)
+
+
+def composite_tile(key: int, dev_mode: bool = False) -> Image:
+    """Returns the tile with tile key key, composited by SPRITES"""
+    f, n, e, s, w = unpack_tile_key(key)
+    return SPRITES.tile(
+        FLOOR_LIST[f], EDGE_LIST[n], EDGE_LIST[e], EDGE_LIST[s], EDGE_LIST[w], dev_mode
+    )
+
+
+# corner bits of a map sprite key, see MapSprites
+CORNER_NW = 1
+CORNER_NE = 2
+CORNER_SE = 4
+CORNER_SW = 8
+CORNER_LIST = [(CORNER_NW, "nw"), (CORNER_NE, "ne"), (CORNER_SE, "se"), (CORNER_SW, "sw")]
+# number of distinct map sprite keys
+MAP_KEY_COUNT = TILE_KEY_COUNT * 16
+
+
+class MapSprites:
+    """One of the map_NxN sprite sets, as used for the zoom levels of maps.
+
+    Unlike the edge/floor sprites these are all full tile sized. Besides
+    the floor and edges of a tile, they draw the corners in which any of
+    the four meeting edges is visible, to close the gaps between walls.
+    Map sprite keys are tile key * 16 + the CORNER_* bits of the tile.
+
+    Sizes without a sprite set of their own are the map_16x16 tiles,
+    downsampled. Since the tiles are downsampled one by one, a map rendered
+    from them is the same as the map rendered at 16 and then downsampled.
+    """
+
+    # sprite set the smaller sizes are downsampled from
+    SOURCE_SIZE = 16
+
+    # floor sprite per floor style, floors that are not in here use map_floor
+    FLOOR_SPRITES = {NONE: "empty", SOLID: "solid"}
+    # edge styles that have sprites, when visible
+    EDGE_STYLES = [WALL, DOOR, DOOR_HIDDEN]
+
+    def __init__(self, size: int):
+        self.size = size
+        self.path = PATH_MAP_SPRITES.get(size, PATH_MAP_SPRITES[self.SOURCE_SIZE])
+        self._sprites = {}
+        self._digest = None
+
+    def digest(self) -> str:
+        """Returns a hash of the names and contents of the sprites of the set,
+        which changes whenever a sprite does. Computed once."""
+        if self._digest is None:
+            digest = sha1(str(self.size).encode())
+            for filename in sorted(glob.glob(f"{glob.escape(self.path)}map_*.png")):
+                digest.update(os.path.basename(filename).encode())
+                with open(filename, "rb") as infile:
+                    digest.update(infile.read())
+            self._digest = digest.hexdigest()
+        return self._digest
+
+    def sprite(self, name: str) -> Image:
+        """Returns sprite map_<name>.png of the set, None if it has no such sprite"""
+        if name not in self._sprites:
+            filename = f"{self.path}map_{name}.png"
+            self._sprites[name] = SpriteCache._load(filename) if os.path.isfile(filename) else None
+        return self._sprites[name]
+
+    def floor(self, style: str) -> Image:
+        sprite = self.sprite(self.FLOOR_SPRITES.get(style, "floor"))
+        return sprite if sprite is not None else self.sprite("empty")
+
+    def edge(self, style: str, side: str, dev_mode: bool = False) -> Image:
+        """Returns the sprite for an edge on side (n/e/s/w), None if it is not drawn"""
+        flag = FLAG_VISIBLE_DEV if dev_mode else FLAG_VISIBLE
+        if style not in self.EDGE_STYLES or not EDGE_FLAGS[EDGE_ID[style]] & flag:
+            return None
+        return self.sprite(f"{style}_{side}")
+
+    def tile(self, key: int, dev_mode: bool = False) -> Image:
+        """Returns the composited tile for map sprite key key"""
+        key, corners = divmod(key, 16)
+        f, n, e, s, w = unpack_tile_key(key)
+        image = self.floor(FLOOR_LIST[f]).copy()
+        for side, code in zip(["n", "e", "s", "w"], [n, e, s, w]):
+            paste = self.edge(EDGE_LIST[code], side, dev_mode)
+            if paste is not None:
+                image.alpha_composite(paste)
+        for bit, corner in CORNER_LIST:
+            if corners & bit:
+                image.alpha_composite(self.sprite(f"corner_{corner}"))
+        if image.width != self.size:
+            # flatten onto black first, same as a map rendered at full size
+            flat = Image.new("RGB", image.size)
+            flat.paste(image, (0, 0), image)
+            image = flat.reduce(image.width // self.size).convert("RGBA")
+        return image
+
+
+class TileAtlas:
+    """Every composited tile that is in use, flattened onto black, as rows of
+    one (count, tilesize, tilesize, 3) uint8 array.
+
+    Rows get added the first time a key is seen. The row table and the tiles
+    array are replaced together, never changed in place, so the rows and
+    tiles returned by rows() stay valid, also while other threads add rows. By
+    default the keys are tile keys composited by SPRITES, pass another
+    composite(key, dev_mode) function for other sprite sets.
+    """
+
+    def __init__(self, composite=composite_tile, tilesize: int = TILESIZE, key_count: int = TILE_KEY_COUNT):
+        self.composite = composite
+        self.tilesize = tilesize
+        self.key_count = key_count
+        self._lock = Lock()
+        # (row in tiles for every key per dev_mode, -1 if not in the atlas yet, tiles)
+        self._table = self._empty_table()
+
+    def _empty_table(self) -> tuple:
+        return (
+            np.full((2, self.key_count), -1, dtype=np.int32),
+            np.zeros((0, self.tilesize, self.tilesize, 3), dtype=np.uint8),
+        )
+
+    @property
+    def tiles(self) -> np.ndarray:
+        """The tiles array as it is now, use the one returned by rows() to look up rows"""
+        return self._table[1]
+
+    def _add(self, keys: list, dev_mode: bool):
+        new = np.empty((len(keys), self.tilesize, self.tilesize, 3), dtype=np.uint8)
+        for index, key in enumerate(keys):
+            tile = self.composite(key, dev_mode)
+            # same as pasting the tile onto the black background of a map
+            image = Image.new("RGB", tile.size)
+            image.paste(tile, (0, 0), tile)
+            new[index] = np.asarray(image)
+        table, tiles = self._table
+        table = table.copy()
+        table[int(dev_mode), keys] = np.arange(len(tiles), len(tiles) + len(keys))
+        # one assignment, so readers get either the old or the new pair
+        self._table = (table, np.concatenate([tiles, new]))
+
+    def rows(self, keys: np.ndarray, dev_mode: bool = False) -> tuple:
+        """Returns the row for every key in keys (any shape) and the tiles
+        array they index, compositing the tiles that are not in the atlas yet.
+
+        Returns:
+            tuple: (rows, tiles), use them together, fe. gather_tiles(*atlas.rows(keys))
+        """
+        table, tiles = self._table
+        rows = table[int(dev_mode)][keys]
+        if (rows < 0).any():
+            with self._lock:
+                table, tiles = self._table
+                rows = table[int(dev_mode)][keys]
+                if (rows < 0).any():
+                    self._add(np.unique(keys[rows < 0]).tolist(), dev_mode)
+                    table, tiles = self._table
+                    rows = table[int(dev_mode)][keys]
+        return rows, tiles
+
+    def image(self, key: int, dev_mode: bool = False) -> Image:
+        """Returns the tile with key as an RGB image"""
+        rows, tiles = self.rows(np.array([key]), dev_mode)
+        return Image.fromarray(tiles[rows[0]])
+
+    def clear(self):
+        """Drops all tiles, fe. after SPRITES.clear()"""
+        with self._lock:
+            self._table = self._empty_table()
+
+
+"""Shared instance of TileAtlas"""
+ATLAS = TileAtlas()
+
+"""Shared TileAtlas per map sprite size, see MapSprites"""
+MAP_ATLASES = {
+    size: TileAtlas(MapSprites(size).tile, size, MAP_KEY_COUNT) for size in [32, 24, 16, 8, 4, 2, 1]
+}
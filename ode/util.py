@@ -11,7 +11,9 @@ I move them to ode.obsolete every now and then, if I'm sure I
 do not want to use them anymore...
 """
 
+import gc
 import os
+from contextlib import contextmanager
 from ode.constants import *
 from random import randint, choice
 import json
@@ -54,6 +56,20 @@ def timer(func):
     return wrap
 
 
+@contextmanager
+def gc_paused():
+    """Context manager that pauses the cyclic garbage collector, for code
+    that makes many objects without cycles at once, fe. a list of a million
+    tuples. The collector would run over and over for nothing."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
 class BaseLoader(object):
     """DEPRECATED
     
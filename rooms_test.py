@@ -0,0 +1,49 @@
+# Room lookups on large maps, run with pytest.
+# The time limits are loose on purpose: building a Python object per tile
+# again (a tuple, a flood fill step) is several times slower than them.
+from ode.map import Map, Room
+from time import perf_counter
+import numpy as np
+
+
+def rooms_by_label(map: Map) -> dict:
+    """Returns the set of (x, y) per room label, the reference for the lookups"""
+    labels = map.label_rooms()
+    result = {}
+    for x, y in zip(*np.nonzero(np.ones(labels.shape, dtype=bool))):
+        result.setdefault(int(labels[x, y]), set()).add((int(x), int(y)))
+    return result
+
+
+def test_rooms_small():
+    map = Map(40, 30)
+    map.randomize(seed=3)
+    reference = rooms_by_label(map)
+    rooms = map.get_rooms_all()
+    assert [room.coord_set for room in rooms] == [reference[label] for label in range(len(rooms))]
+    labels = map.label_rooms()
+    for start in [(0, 0), (13, 7), (39, 29)]:
+        coords = map.get_room(start)
+        assert coords == sorted(reference[int(labels[start])])
+        assert map.room_at(*start) == Room(coords)
+
+
+def test_get_rooms_all_many_rooms():
+    map = Map(1000, 1000)
+    map.randomize(seed=1)
+    start = perf_counter()
+    rooms = map.get_rooms_all()
+    assert perf_counter() - start < 2.5
+    assert sum(room.size for room in rooms) == 1000 * 1000
+
+
+def test_get_room_open():
+    map = Map(1000, 1000)
+    map.clear()
+    start = perf_counter()
+    coords = map.get_room((500, 500))
+    assert perf_counter() - start < 2
+    assert len(coords) == 1000 * 1000 and coords[0] == (0, 0) and coords[-1] == (999, 999)
+    start = perf_counter()
+    assert map.room_at(10, 10).size == 1000 * 1000
+    assert perf_counter() - start < 2